@@ -1,11 +1,18 @@
-import os
+import os, time, random, multiprocessing
 from optparse import OptionParser
 from miphy_resources import phylo
-from miphy import __author__, __version__
+from miphy_resources.miphy_instance import MiphyInstance
+from miphy import __author__, __version__, generate_csv, load_gene_tree_data
 
 
+def load_gene_tree(gene_tree_file):
+    tree = phylo.load_tree(gene_tree_file)
+    if tree is None:
+        raise ValueError('could not identify the format of the gene tree at %s' % gene_tree_file)
+    return tree
+
 def group_names(gene_tree_file, prefix_size):
-    tree = phylo.load_newick(gene_tree_file)
+    tree = load_gene_tree(gene_tree_file)
     grouped_names = {}
     for node in tree.leaves:
         name = node.name
@@ -24,31 +31,241 @@ def save_info_file(output_file, grouped_names):
         f.write('\n'.join(buff))
     return len(species)
 
-def clean_tree(gene_tree_file, output_file):
-    tree = phylo.load_newick(gene_tree_file)
+def save_gene_tree(tree, gene_tree_file, output_file):
+    """Saves the tree in newick format to 'output_file', or overwrites 'gene_tree_file' if that is None. A binary tree is overwritten as a binary tree."""
     if output_file == None:
+        if phylo.is_binary_tree_file(gene_tree_file):
+            tree.save_binary(gene_tree_file)
+            return
         output_file = gene_tree_file
     tree.save_newick(output_file, support_values=False, comments=False, internal_names=False, support_as_comment=False)
 
+def clean_tree(gene_tree_file, output_file):
+    tree = load_gene_tree(gene_tree_file)
+    save_gene_tree(tree, gene_tree_file, output_file)
+
 def midpoint_root(gene_tree_file, output_file):
-    tree = phylo.load_newick(gene_tree_file)
+    tree = load_gene_tree(gene_tree_file)
     tree.root_midpoint()
-    if output_file == None:
-        output_file = gene_tree_file
-    tree.save_newick(output_file, support_values=False, comments=False, internal_names=False, support_as_comment=False)
+    save_gene_tree(tree, gene_tree_file, output_file)
+
+def convert_tree(gene_tree_file, output_file):
+    tree = load_gene_tree(gene_tree_file)
+    tree.save_binary(output_file)
+    return len(tree.leaves)
+
+def parse_manifest(manifest_file):
+    """Returns a list of (name, gene_tree_file, info_file) from a manifest with one gene family per line. Relative paths are taken from the manifest's directory."""
+    manifest_dir = os.path.dirname(manifest_file)
+    families, names = [], set()
+    for line in open(manifest_file):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t') if '\t' in line else line.split()
+        if len(fields) == 2:
+            gene_tree_file, info_file = fields
+            name = os.path.splitext(os.path.basename(gene_tree_file))[0]
+        elif len(fields) == 3:
+            gene_tree_file, info_file, name = fields
+        else:
+            raise ValueError('could not interpret the manifest line "%s"' % line)
+        gene_tree_file = os.path.join(manifest_dir, gene_tree_file.strip())
+        info_file = os.path.join(manifest_dir, info_file.strip())
+        name = name.strip()
+        if name in names:
+            raise ValueError('the family name "%s" appears more than once in the manifest' % name)
+        names.add(name)
+        families.append((name, gene_tree_file, info_file))
+    return families
+
+def run_batch(families, output_dir, params, use_coords, processes, timeout, consolidate):
+    """Runs MIPhy on each gene family, with up to 'processes' at once. Results are written as each family finishes, and its name is recorded in the checkpoint file so that a restarted batch skips it.
+    When consolidating, each checkpoint line also records the size of the results file once that family's rows were written. A restarted batch truncates the file to the last recorded size, so rows from a family that was not checkpointed are written only once."""
+    checkpoint_file = os.path.join(output_dir, 'batch_checkpoint.txt')
+    results_file = os.path.join(output_dir, 'batch_results.csv')
+    finished, results_size = set(), None
+    if os.path.isfile(checkpoint_file):
+        with open(checkpoint_file, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data): # The last line was only partly written.
+                f.truncate(end)
+        for line in data[:end].decode('utf-8').splitlines():
+            fields = line.split('\t')
+            if fields[1] == 'done':
+                finished.add(fields[0])
+            if len(fields) > 2:
+                results_size = int(fields[2])
+    if consolidate:
+        if results_size is not None and os.path.isfile(results_file) and os.path.getsize(results_file) > results_size:
+            with open(results_file, 'rb+') as f:
+                f.truncate(results_size)
+            print('Removed the rows of unfinished gene families from %s' % results_file)
+        results_size = os.path.getsize(results_file) if os.path.isfile(results_file) else 0
+        with open(checkpoint_file, 'a') as f:
+            f.write('\tstarted\t%i\n' % results_size) # Rows appended after this, but before their family's checkpoint line, are removed on restart.
+    pending = [family for family in families if family[0] not in finished]
+    print('Running %i gene families; %i were already finished.' % (len(pending), len(families) - len(pending)))
+    pending.reverse()
+    running, num_done, num_failed = {}, 0, 0
+    while pending or running:
+        while pending and len(running) < processes:
+            name, gene_tree_file, info_file = pending.pop()
+            recv_conn, send_conn = multiprocessing.Pipe(False)
+            proc = multiprocessing.Process(target=run_family, args=(send_conn, gene_tree_file, info_file, params, use_coords))
+            proc.daemon = True
+            proc.start()
+            send_conn.close()
+            running[name] = (proc, recv_conn, time.time())
+        time.sleep(0.05)
+        for name, (proc, recv_conn, start_time) in list(running.items()):
+            if recv_conn.poll():
+                try:
+                    status, data = recv_conn.recv()
+                except EOFError: # Exited without sending anything.
+                    proc.join()
+                    status, data = 'failed', 'the process exited with code %s' % proc.exitcode
+            elif timeout and time.time() - start_time > timeout:
+                proc.terminate()
+                status, data = 'failed', 'timed out after %g seconds' % timeout
+            else:
+                continue
+            proc.join()
+            recv_conn.close()
+            del running[name]
+            if status == 'done':
+                save_family_results(name, data, output_dir, consolidate)
+                num_done += 1
+                print('Finished %s (%i of %i)' % (name, num_done, len(pending) + len(running) + num_done + num_failed))
+            else:
+                num_failed += 1
+                print('Error: %s failed; %s' % (name, data))
+            with open(checkpoint_file, 'a') as f:
+                if consolidate:
+                    f.write('%s\t%s\t%i\n' % (name, status, os.path.getsize(results_file)))
+                else:
+                    f.write('%s\t%s\n' % (name, status))
+    return num_done, num_failed
+def run_family(conn, gene_tree_file, info_file, params, use_coords):
+    try:
+        gene_tree_data = load_gene_tree_data(gene_tree_file, 'auto')
+        info_data = open(info_file).read()
+        mi = MiphyInstance(gene_tree_data, info_data, gene_tree_format='auto', allowed_wait={}, merge_singletons=False, use_coords=use_coords, coords_file='', verbose=False)
+        mi.processed(params)
+        conn.send(('done', generate_csv(set(), mi, params)))
+    except Exception as err:
+        conn.send(('failed', str(err)))
+    conn.close()
+def save_family_results(name, data, output_dir, consolidate):
+    if consolidate:
+        lines = ['%s,%s' % (name, line) for line in data.splitlines()]
+        with open(os.path.join(output_dir, 'batch_results.csv'), 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+    else:
+        results_file = os.path.join(output_dir, name + '.csv')
+        with open(results_file + '.tmp', 'w') as f:
+            f.write(data)
+        os.rename(results_file + '.tmp', results_file) # So a partly written file is never mistaken for a result.
+
+def random_tree_string(names, rnd):
+    """Returns a Newick tree of the given leaf names, joined in random pairs so the shape is random."""
+    subtrees = ['%s:%.5f' % (name, rnd.random()) for name in names]
+    while len(subtrees) > 1:
+        i = rnd.randrange(len(subtrees))
+        subtrees[i], subtrees[-1] = subtrees[-1], subtrees[i]
+        subtree1 = subtrees.pop()
+        j = rnd.randrange(len(subtrees))
+        subtrees[j] = '(%s,%s)%i:%.5f' % (subtree1, subtrees[j], rnd.randrange(101), rnd.random())
+    return subtrees[0] + ';'
+def caterpillar_tree_string(names, rnd):
+    """Returns a Newick tree of the given leaf names, where each internal node has one leaf as a child. It is as deep as a tree of that many leaves can be."""
+    buff = ['('*(len(names)-1), names[0], ':0.1']
+    for name in names[1:]:
+        buff.append(',%s:%.5f)[&comment]:%.5f' % (name, rnd.random(), rnd.random()))
+    return ''.join(buff) + ';'
+def benchmark_parsing(num_leaves):
+    """Times loading and saving a random tree and a caterpillar tree of 'num_leaves' leaves in Newick format. The caterpillar is the worst case for parsers that rescan the string."""
+    rnd = random.Random(0)
+    names = ['seq_%i' % i for i in range(num_leaves)]
+    random_str = random_tree_string(names, rnd)
+    caterpillar_str = caterpillar_tree_string(names, rnd)
+    for tree_type, tree_str in (('random', random_str), ('caterpillar', caterpillar_str)):
+        t0 = time.time()
+        tree = phylo.load_newick_string(tree_str)
+        t1 = time.time()
+        tree.newick_string()
+        t2 = time.time()
+        print('%s tree of %i leaves (%.1f MB): parsed in %.2f seconds, saved in %.2f seconds' % (tree_type.capitalize(), len(tree.leaves), len(tree_str)/1e6, t1-t0, t2-t1))
+        tree_bytes = tree.binary_string()
+        t0 = time.time()
+        binary_tree = phylo.open_binary_string(tree_bytes)
+        binary_tree.get_named_leaves(), binary_tree.get_named_children(), binary_tree.get_postorder_names()
+        t1 = time.time()
+        binary_tree.tree
+        print('-- as a binary tree (%.1f MB): structure read in %.2f seconds, Tree built in %.2f seconds' % (len(tree_bytes)/1e6, t1-t0, time.time()-t1))
+def benchmark_coordinates(num_leaves, variance_target=0.9, max_dimensions=64):
+    """Times the coordinate points of a random tree of 'num_leaves' leaves, from the full eigendecomposition and truncated as MIPhy does above the refine limit. Both need the full distance matrix, so memory grows with the square of 'num_leaves'."""
+    tree = phylo.load_newick_string(random_tree_string(['seq_%i' % i for i in range(num_leaves)], random.Random(0)))
+    t0 = time.time()
+    tree.get_leaf_coordinate_points()
+    t1 = time.time()
+    names, coords, residuals = tree.get_truncated_leaf_coordinate_points(variance_target, max_dimensions)
+    t2 = time.time()
+    print('Coordinate points of a random tree of %i leaves: full decomposition in %.2f seconds, truncated to %i dimensions in %.2f seconds' % (num_leaves, t1-t0, coords.shape[1], t2-t1))
+def benchmark_distances(num_leaves, num_samples=1000):
+    """Times the distance matrix of the vert_cyps test tree, and of a random and a caterpillar tree of 'num_leaves' leaves. A sample of the distances is checked against Tree.node_distance(), which they should equal exactly."""
+    rnd = random.Random(0)
+    names = ['seq_%i' % i for i in range(num_leaves)]
+    test_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'miphy_resources', 'tests', 'vert_cyps.nwk')
+    for tree_type, tree_str in (('vert_cyps', open(test_file).read()), ('random', random_tree_string(names, rnd)), ('caterpillar', caterpillar_tree_string(names, rnd))):
+        tree = phylo.load_newick_string(tree_str)
+        t0 = time.time()
+        dist_names, dist_mat = tree.get_distance_matrix()
+        run_time = time.time() - t0
+        leaves = [tree.node_names[name] for name in dist_names]
+        num_different = 0
+        for k in range(num_samples):
+            i, j = rnd.randrange(len(leaves)), rnd.randrange(len(leaves))
+            if dist_mat[i,j] != tree.node_distance(leaves[i], leaves[j]):
+                num_different += 1
+        del dist_mat
+        print('Distance matrix of the %s tree of %i leaves: %.2f seconds. %i of %i sampled distances differed from node_distance()' % (tree_type, len(leaves), run_time, num_different, num_samples))
+        if num_different:
+            print('Warning: the distance matrix does not match node_distance().')
 
 
 def setup_parser():
     usage_str = "python %prog COMMAND ARGUMENTS\n" + \
         "Valid commands:\n" + \
-        "python %prog info GENE_TREE.nwk PREFIX_SIZE OUTPUT_FILE.txt\n\t-- Parse a phylogenetic tree in newick format, extracting the gene names, grouping those sharing a prefix of the given size, and generating an info file.\n" + \
-        "python %prog clean GENE_TREE.nwk [OUTPUT_FILE.nwk]\n\t-- Validates a phylogenetic tree in newick format, ensuring it is a binary tree, and sanitizing any forbidden characters from the gene names. If no OUTPUT_FILE is given, the original tree will be overwritten.\n" + \
-        "python %prog midpoint GENE_TREE.nwk [OUTPUT_FILE.nwk]\n\t-- Re-root the phylogenetic tree using the midpoint algorithm. If no OUTPUT_FILE is given, the original tree will be overwritten."
+        "python %prog info GENE_TREE.nwk PREFIX_SIZE OUTPUT_FILE.txt\n\t-- Parse a phylogenetic tree in any supported format, extracting the gene names, grouping those sharing a prefix of the given size, and generating an info file.\n" + \
+        "python %prog clean GENE_TREE.nwk [OUTPUT_FILE.nwk]\n\t-- Validates a phylogenetic tree in any supported format, ensuring it is a binary tree, and sanitizing any forbidden characters from the gene names. The result is saved in newick format. If no OUTPUT_FILE is given, the original tree will be overwritten, as a binary tree if it was one.\n" + \
+        "python %prog midpoint GENE_TREE.nwk [OUTPUT_FILE.nwk]\n\t-- Re-root the phylogenetic tree using the midpoint algorithm. The result is saved in newick format. If no OUTPUT_FILE is given, the original tree will be overwritten, as a binary tree if it was one.\n" + \
+        "python %prog batch MANIFEST.txt OUTPUT_DIR [OPTIONS]\n\t-- Run MIPhy on many gene families. Each line of MANIFEST gives a gene tree and its info file, and optionally a name for the family, separated by tabs or spaces. The results of each family are saved to OUTPUT_DIR as it finishes, and a checkpoint file there allows an interrupted batch to be restarted without repeating finished families.\n" + \
+        "python %prog convert GENE_TREE OUTPUT_FILE.npz\n\t-- Save a phylogenetic tree in any supported format as a binary tree file. MIPhy loads these much faster than the text formats, which helps when the same large tree is analyzed repeatedly.\n" + \
+        "python %prog benchmark [NUM_LEAVES] [COORD_LEAVES] [DIST_LEAVES]\n\t-- Time the parsing and saving of a random and a caterpillar tree in newick format, each with NUM_LEAVES leaves [default: 100000], and the loading of each as a binary tree. Then time the coordinate points of a random tree with COORD_LEAVES leaves [default: 4000], both in full and truncated as for trees above the refine limit. Finally time the distance matrix of the vert_cyps test tree, and of a random and a caterpillar tree with DIST_LEAVES leaves [default: 20000]; this needs about 8*DIST_LEAVES^2 bytes of memory."
     version_str = "%%prog %s" % __version__
     parser = OptionParser(usage=usage_str, version=version_str)
+    parser.set_defaults(dup_weight=1.0, inc_weight=0.5, loss_weight=1.0, spread_weight=1.0, use_coords=True, processes=0, timeout=0.0, consolidate=False)
+    parser.add_option('-i', '--inc_weight', dest='inc_weight', type='float',
+        help='batch: cost of an incongruence event [default: %default]')
+    parser.add_option('-d', '--duplication_weight', dest='dup_weight', type='float',
+        help='batch: cost of a duplication event [default: %default]')
+    parser.add_option('-l', '--loss_weight', dest='loss_weight', type='float',
+        help='batch: cost of a gene loss event [default: %default]')
+    parser.add_option('-s', '--spread_weight', dest='spread_weight', type='float',
+        help='batch: weight given to the spread of a MIG [default: %default]')
+    parser.add_option('-n', '--no_coords', dest='use_coords', action='store_false',
+        help="batch: don't calculate coordinate points for the gene trees. This will cause SPREAD_WEIGHT to be ignored")
+    parser.add_option('-j', '--processes', dest='processes', type='int',
+        help='batch: number of gene families run at once; setting to 0 will use one per CPU [default: %default]')
+    parser.add_option('-t', '--timeout', dest='timeout', type='float',
+        help='batch: seconds a gene family may run before it is stopped and recorded as failed; setting to 0 allows any length of time [default: %default]')
+    parser.add_option('-c', '--consolidate', dest='consolidate', action='store_true',
+        help='batch: save the results of every family to OUTPUT_DIR/batch_results.csv, with the family name as the first column, instead of one file per family')
     return parser
 def validate_args(parser, args):
-    commands = ['info', 'clean', 'midpoint']
+    commands = ['info', 'clean', 'midpoint', 'batch', 'convert', 'benchmark']
     if len(args) == 0:
         parser.error('incorrect arguments.')
     command = args[0].lower()
@@ -95,6 +312,57 @@ def validate_midpoint_args(parser, args):
     else:
         output_file = None
     return gene_tree_file, output_file
+def validate_batch_args(parser, args, options):
+    if not len(args) == 3:
+        parser.error('incorrect number of arguments for "batch". You must supply a manifest file and an output directory.')
+    manifest_file, output_dir = os.path.realpath(args[1]), os.path.realpath(args[2])
+    if not os.path.isfile(manifest_file):
+        parser.error('could not locate the manifest at %s' % manifest_file)
+    try:
+        families = parse_manifest(manifest_file)
+    except ValueError as err:
+        parser.error(str(err))
+    for name, gene_tree_file, info_file in families:
+        if not os.path.isfile(gene_tree_file):
+            parser.error('could not locate the gene tree at %s' % gene_tree_file)
+        elif not os.path.isfile(info_file):
+            parser.error('could not locate the info file at %s' % info_file)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    d_weight, i_weight = options.dup_weight, options.inc_weight
+    l_weight, spread_weight = options.loss_weight, options.spread_weight
+    if d_weight<0 or i_weight<0 or l_weight<0 or spread_weight<0:
+        parser.error('all weight values must be non-negative.')
+    if not options.use_coords:
+        spread_weight = 0.0
+    if options.processes < 0 or options.timeout < 0:
+        parser.error('the number of processes and the timeout must be non-negative.')
+    processes = options.processes or multiprocessing.cpu_count()
+    return families, output_dir, (i_weight, d_weight, l_weight, spread_weight), processes
+def validate_convert_args(parser, args):
+    if not len(args) == 3:
+        parser.error('incorrect number of arguments for "convert". You must supply a tree, and an output file name.')
+    gene_tree_file = os.path.realpath(args[1])
+    if not os.path.isfile(gene_tree_file):
+        parser.error('could not locate the gene tree at %s' % gene_tree_file)
+    output_file = args[2]
+    if not output_file.endswith('.npz'):
+        output_file += '.npz'
+    return gene_tree_file, output_file
+def validate_benchmark_args(parser, args):
+    if not 1 <= len(args) <= 4:
+        parser.error('incorrect number of arguments for "benchmark". You may optionally supply the number of leaves, the number of leaves for the coordinate points, and the number for the distance matrix.')
+    leaf_counts = [100000, 4000, 20000]
+    for ind, arg_name in enumerate(('NUM_LEAVES', 'COORD_LEAVES', 'DIST_LEAVES')):
+        if len(args) <= ind + 1:
+            break
+        try:
+            leaf_counts[ind] = int(args[ind+1])
+        except:
+            parser.error('could not convert %s "%s" to an integer.'%(arg_name, args[ind+1]))
+        if leaf_counts[ind] < 2:
+            parser.error('%s must be at least 2.' % arg_name)
+    return leaf_counts
 
 
 if __name__ == '__main__':
@@ -103,12 +371,37 @@ if __name__ == '__main__':
     command = validate_args(parser, args)
     if command == 'info':
         gene_tree_file, prefix_size, output_file = validate_info_args(parser, args)
-        grouped_names, num_genes = group_names(gene_tree_file, prefix_size)
+        try:
+            grouped_names, num_genes = group_names(gene_tree_file, prefix_size)
+        except (ValueError, phylo.PhyloParseError) as err:
+            parser.error(str(err))
         num_groups = save_info_file(output_file, grouped_names)
         print('Wrote info file for %i genes from %i groups to "%s"' % (num_genes, num_groups, output_file))
     elif command == 'clean':
         gene_tree_file, output_file = validate_clean_args(parser, args)
-        clean_tree(gene_tree_file, output_file)
+        try:
+            clean_tree(gene_tree_file, output_file)
+        except (ValueError, phylo.PhyloParseError) as err:
+            parser.error(str(err))
     elif command == 'midpoint':
         gene_tree_file, output_file = validate_midpoint_args(parser, args)
-        midpoint_root(gene_tree_file, output_file)
+        try:
+            midpoint_root(gene_tree_file, output_file)
+        except (ValueError, phylo.PhyloParseError) as err:
+            parser.error(str(err))
+    elif command == 'batch':
+        families, output_dir, params, processes = validate_batch_args(parser, args, options)
+        num_done, num_failed = run_batch(families, output_dir, params, options.use_coords, processes, options.timeout, options.consolidate)
+        print('Finished %i gene families, %i failed. Results saved to "%s"' % (num_done, num_failed, output_dir))
+    elif command == 'convert':
+        gene_tree_file, output_file = validate_convert_args(parser, args)
+        try:
+            num_leaves = convert_tree(gene_tree_file, output_file)
+        except (ValueError, phylo.PhyloParseError) as err:
+            parser.error(str(err))
+        print('Saved the tree of %i sequences as a binary tree to "%s"' % (num_leaves, output_file))
+    elif command == 'benchmark':
+        num_leaves, coord_leaves, dist_leaves = validate_benchmark_args(parser, args)
+        benchmark_parsing(num_leaves)
+        benchmark_coordinates(coord_leaves)
+        benchmark_distances(dist_leaves)
@@ -6,10 +6,15 @@ This program reconciles a multi-species phylogenetic tree of some gene family wi
 
 For full details read the publication "MIPhy: identify and quantify rapidly evolving members of large gene families"; Curran DM, Gilleard JS, Wasmuth JD; PeerJ; May 2018.
 """
-import os, webbrowser, socket
+import os, io, webbrowser, socket, multiprocessing, hashlib, tempfile
+import numpy as np
 from optparse import OptionParser, OptionGroup
 from miphy_resources import miphy_daemon
 from miphy_resources.miphy_instance import MiphyInstance
+from miphy_resources.tree_set import TreeSetInstance
+from miphy_resources.clusterer import Clusterer
+from miphy_resources.miphy_common import MiphyRuntimeError
+from miphy_resources import phylo
 
 
 __author__ = 'David Curran'
@@ -20,9 +25,9 @@ def setup_parser():
     usage_str = "python %prog GENE_TREE INFO_FILE [OPTIONS]\n\nCluster a gene tree into minimum instability groups (MIGs), and quantify the phylogenetic stability of each."
     version_str = "%%prog %s" % __version__
     parser = OptionParser(usage=usage_str, version=version_str)
-    parser.set_defaults(tree_format='a', dup_weight=1.0, inc_weight=0.5, loss_weight=1.0, spread_weight=1.0, downloads_dir='', use_coords=True, coords_file='', results_file='', only_species='', manual_browser=False, server_port=0, test=False, verbose=False)
+    parser.set_defaults(tree_format='a', dup_weight=1.0, inc_weight=0.5, loss_weight=1.0, spread_weight=1.0, downloads_dir='', use_coords=True, coords_file='', variance_target=0.0, results_file='', only_species='', manual_browser=False, phase_map=False, server_port=0, tree_set=False, processes=0, test=False, verbose=False)
     parser.add_option('-f', '--tree_format', dest='tree_format', type='string',
-        help='File format of the given gene tree. Must be one of: a (auto-detect), n (Newick), e (NEXUS), p (PhyloXML), or x (NeXML) [default: %default]')
+        help='File format of the given gene tree. Must be one of: a (auto-detect), n (Newick), e (NEXUS), p (PhyloXML), x (NeXML), or b (binary, as saved by the miphy-tools.py convert command) [default: %default]')
     parser.add_option('-i', '--inc_weight', dest='inc_weight', type='float',
         help='Cost of an incongruence event [default: %default]')
     parser.add_option('-d', '--duplication_weight', dest='dup_weight', type='float',
@@ -37,14 +42,22 @@ def setup_parser():
         help="Don't calculate the full pairwise distance matrix to generate coordinate points. This will cause SPREAD_WEIGHT to be ignored")
     parser.add_option('-c', '--coords_file', dest='coords_file', type='string',
         help="Load the coordinate points if COORDS_FILE exists, or calculate and save them if it does not. This prevents recalculation of the full pairwise distance matrix, which can be time-consuming for large trees. IMPORTANT: this must be recalculated if any sequences are added to or removed from the gene tree")
+    parser.add_option('--truncate', dest='variance_target', type='float',
+        help="Approximate the coordinate points with only the leading dimensions explaining this fraction of the variance (at most 64 dimensions), instead of the full eigenvalue decomposition. This is much faster for trees of several thousand sequences, but the spreads are approximate and so the clusters may change; the estimated error of the spreads is printed. Setting to 0 uses the full coordinates [default: %default]")
     parser.add_option('-r', '--results_file', dest='results_file', type='string',
         help="Save the clustering patterns and instability scores to this file, instead of visualizing the results in a web browser. Use the --only_species option to filter the results")
     parser.add_option('-o', '--only_species', dest='only_species', type='string',
         help='A comma-separated list of species names, exactly as they appear in INFO_FILE. The clustering information from only these species will be saved to RESULTS_FILE; if not supplied all species will be saved. IMPORTANT: --results_file must be supplied with this option.')
     parser.add_option('-m', '--manual_browser', dest='manual_browser', action='store_true',
         help="Starts the MIPhy daemon, but doesn't automatically open the results with your default web browser. A URL will be printed allowing you to access the results as normal using your web browser of choice")
+    parser.add_option('--phase_map', dest='phase_map', action='store_true',
+        help="Map out the clusterings around the initial weights in the background, for up to 10 seconds, so the results page responds instantly as the weights are changed. Weights outside of the map are clustered as normal")
     parser.add_option('-p', '--port', dest='server_port', type='int',
         help='Port used by MIPhy to communicate with the visualization page; setting to 0 will cause your OS to pick one at random [default: %default]')
+    parser.add_option('-t', '--tree_set', dest='tree_set', action='store_true',
+        help="GENE_TREE is a NEXUS or Newick file holding a set of trees, such as bootstrap replicates or posterior samples. Each tree is clustered, and the fraction of trees in which each pair of sequences shared a MIG is saved to RESULTS_FILE as a matrix. The trees are read one at a time, so the set may be larger than the available memory. IMPORTANT: --results_file must be supplied with this option")
+    parser.add_option('-j', '--processes', dest='processes', type='int',
+        help='Number of processes used to cluster the trees with --tree_set, or to reconcile a very large gene tree; setting to 0 will use one per CPU [default: %default]')
     parser.add_option('--test', dest='test', action='store_true',
         help="Run MIPhy on included test data and exit")
     parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
@@ -61,9 +74,9 @@ def validate_args(parser, args):
     return gene_tree_file, info_file
 def validate_options(parser, opts):
     # Validate tree formats
-    if opts.tree_format.lower() not in ('a', 'n', 'e', 'p', 'x'):
-        parser.error('the tree format option (-f; --tree_format) must be one of: a (auto-detect), n (Newick), e (NEXUS), p (PhyloXML), or x (NeXML)')
-    tree_format = {'a':'auto', 'n':'newick', 'e':'nexus', 'p':'phyloxml', 'x':'nexml'}[opts.tree_format.lower()]
+    if opts.tree_format.lower() not in ('a', 'n', 'e', 'p', 'x', 'b'):
+        parser.error('the tree format option (-f; --tree_format) must be one of: a (auto-detect), n (Newick), e (NEXUS), p (PhyloXML), x (NeXML), or b (binary)')
+    tree_format = {'a':'auto', 'n':'newick', 'e':'nexus', 'p':'phyloxml', 'x':'nexml', 'b':'binary'}[opts.tree_format.lower()]
     # Validate weights.
     d_weight, i_weight = opts.dup_weight, opts.inc_weight
     l_weight, spread_weight = opts.loss_weight, opts.spread_weight
@@ -84,6 +97,11 @@ def validate_options(parser, opts):
         coords_file = os.path.abspath(coords_file)
         if not use_coords:
             parser.error('if you specify -n, you should not give a coords file with -c')
+    variance_target = opts.variance_target
+    if not 0 <= variance_target <= 1:
+        parser.error('the --truncate value must be between 0 and 1.')
+    if variance_target and not use_coords:
+        parser.error('if you specify -n, you should not give a --truncate value')
     if not use_coords:
         spread_weight = 0.0
     # Validate results file options.
@@ -96,12 +114,23 @@ def validate_options(parser, opts):
             parser.error('if --only_species is given, a results file must be specified with --results_file')
         only_species = only_species.split(',')
     only_species = set(only_species)
+    # Validate tree set options.
+    processes = opts.processes
+    if opts.tree_set:
+        if not results_file:
+            parser.error('if --tree_set is given, a results file must be specified with --results_file')
+        if tree_format not in ('auto', 'nexus', 'newick'):
+            parser.error('the trees given with --tree_set must be in NEXUS or Newick format')
+        if coords_file:
+            parser.error('if --tree_set is given, you should not give a coords file with -c, as each tree has its own coordinates')
+    if processes < 0:
+        parser.error('the number of processes must be non-negative.')
     downloads_dir = opts.downloads_dir.strip()
     if downloads_dir:
         downloads_dir = os.path.abspath(downloads_dir)
         if results_file:
             parser.error('if --results_file is given, you should not give a downloads destination with --downloads_dir')
-    return {'tree_format':tree_format, 'params':(i_weight,d_weight,l_weight,spread_weight), 'downloads_dir':downloads_dir, 'server_port':server_port, 'coords_file':coords_file, 'use_coords':use_coords, 'results_file':results_file, 'only_species':only_species}
+    return {'tree_format':tree_format, 'params':(i_weight,d_weight,l_weight,spread_weight), 'downloads_dir':downloads_dir, 'server_port':server_port, 'coords_file':coords_file, 'use_coords':use_coords, 'variance_target':variance_target or None, 'results_file':results_file, 'only_species':only_species, 'processes':processes or multiprocessing.cpu_count()}
 
 def generate_csv(only_species, mi, params):
     # This should return the same data as the #exportButton.click() call inside setupExportPane() in results.js
@@ -119,6 +148,28 @@ def generate_csv(only_species, mi, params):
                 csv_data.append('%s,%s,%s,%.2f' % (seqID, spc, clustID, round(clust_score, 2)))
     return '\n'.join(csv_data[::-1])
 
+def print_spread_errors(mi, params):
+    """Reports the estimated error of the spreads, if they were calculated from truncated coordinate points."""
+    errors = mi.clusterer.spread_errors(mi.clusters[params])
+    if errors:
+        print('\nThe coordinate points were truncated to %i dimensions. Estimated relative error of the cluster spreads: median %.3f, max %.3f' % (mi.clusterer.coords.shape[1], errors[(len(errors)-1)//2], errors[-1]))
+def load_gene_tree_data(gene_tree_file, tree_format):
+    """Returns the contents of the gene tree file as text. Binary trees are instead memory-mapped, and returned as a phylo.BinaryTree."""
+    if tree_format == 'binary' or (tree_format == 'auto' and phylo.is_binary_tree_file(gene_tree_file)):
+        return phylo.open_binary(gene_tree_file)
+    return open(gene_tree_file).read().strip()
+def generate_tree_set_csv(only_species, ts):
+    unknown_species = only_species - set(ts.species)
+    if unknown_species:
+        print('\nError: these species specified by --only_species were not found in the information file: %s' % (', '.join(unknown_species)))
+        exit()
+    inds = [i for i, seqID in enumerate(ts.sequence_names) if not only_species or ts.species_mapping[seqID] in only_species]
+    freqs = ts.co_clusters.frequencies()
+    csv_data = [','.join(['sequence'] + [ts.sequence_names[i] for i in inds])]
+    for i in inds:
+        csv_data.append(','.join([ts.sequence_names[i]] + ['%.3f' % freqs[i,j] for j in inds]))
+    return '\n'.join(csv_data)
+
 def port_available(server_port):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     result = sock.connect_ex(('127.0.0.1', server_port))
@@ -140,7 +191,150 @@ def test_miphy():
     # repeated gene name - test_info.txt & test_unique_names.nwk -> Cre-ugt-18
     # gene missing from info - test_missing_name.txt & test_tree.nwk -> Cbn-ugt-23
     # non-binary tree -
-    print('in test. will be implemented soon.')
+    test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'miphy_resources', 'tests')
+    merged_clusters = { # Number of clusters and md5 of the sorted clusters after merging singletons, from the original implementation.
+        ('ugts_small.nwk', (0.5, 1.0, 1.0, 1.0)): (12, '67fd713c9321a893434e75a8c6785f6e'),
+        ('ugts_small.nwk', (2.0, 0.5, 1.0, 3.0)): (15, '74fd463f698647d76af2520c807e4247'),
+        ('vert_cyps.nwk', (0.5, 1.0, 1.0, 1.0)): (39, 'a7e74ca1896af84111b6c31bc9a1f31c'),
+        ('vert_cyps.nwk', (2.0, 0.5, 1.0, 3.0)): (86, '0d94932880ed5f9c9ee998f334263305')}
+    merged_clusters_no_coords = { # The same without coordinates. The original implementation failed to merge without them, so these are from this one.
+        ('ugts_small.nwk', (0.5, 1.0, 1.0, 1.0)): (12, '67fd713c9321a893434e75a8c6785f6e'),
+        ('ugts_small.nwk', (2.0, 0.5, 1.0, 3.0)): (12, '67fd713c9321a893434e75a8c6785f6e'),
+        ('vert_cyps.nwk', (0.5, 1.0, 1.0, 1.0)): (39, 'a7e74ca1896af84111b6c31bc9a1f31c'),
+        ('vert_cyps.nwk', (2.0, 0.5, 1.0, 3.0)): (37, '813f808d3a9e276196451c2cd22ad396')}
+    for tree_file, info_file in (('ugts_small.nwk', 'ugt_info.txt'), ('vert_cyps.nwk', 'vert_cyps_info.txt')):
+        gene_tree_data = open(os.path.join(test_dir, tree_file)).read().strip()
+        info_data = open(os.path.join(test_dir, info_file)).read()
+        for use_coords in (True, False):
+            print('Testing %s with use_coords=%s...' % (tree_file, use_coords))
+            mi = MiphyInstance(gene_tree_data, info_data, gene_tree_format='auto', allowed_wait={}, merge_singletons=False, use_coords=use_coords, coords_file='', verbose=False)
+            params = (0.5, 1.0, 1.0, 1.0)
+            mi.processed(params)
+            check_test_clusters(mi.clusters[params], mi.sequence_names)
+            for weights in (params, (4.2, 1.1, 1.4, 3.5), (0.3, 1.2, 0.4, 1.3), (4.6, 0.1, 0.1, 5.0)): # The last 3 tie in floating point.
+                if mi.clusterer.phase_cluster(*weights) != mi.clusterer.cluster(*weights):
+                    raise MiphyRuntimeError('the phase map did not reproduce the clustering.')
+            weight_grid = [params, (2.0, 0.5, 1.0, 3.0), (4.2, 1.1, 1.4, 3.5), (2.0, 0.5, 1.0, 3.0, True)]
+            if mi.clusterer.cluster_many(weight_grid) != [mi.clusterer.cluster(*weights) for weights in weight_grid]:
+                raise MiphyRuntimeError('clustering a grid of weights gave different results.')
+            phase_mi = MiphyInstance(gene_tree_data, info_data, gene_tree_format='auto', allowed_wait={}, merge_singletons=False, use_coords=use_coords, coords_file='', verbose=False, phase_map=True)
+            phase_mi.processed(params)
+            for weights in (params, (2.0, 0.5, 1.0, 3.0), (4.2, 1.1, 1.4, 3.5), (0.5, 1.0, 1.0, 1.0, True)):
+                phase_mi.cluster(weights)
+                if (phase_mi.clusters[weights], phase_mi.scores[weights]) != phase_mi.clusterer.cluster(*weights):
+                    raise MiphyRuntimeError('the MIPhy instance did not reproduce the clustering from its phase map.')
+            if not phase_mi.clusterer.phase_regions:
+                raise MiphyRuntimeError('the MIPhy instance did not use its phase map.')
+            clusters, scores = mi.clusterer.cluster(*params, merge_singletons=True)
+            check_test_clusters(clusters, mi.sequence_names)
+            if min(len(clstr) for clstr in clusters) == 1:
+                raise MiphyRuntimeError('a singleton cluster was not merged.')
+            for weights in (params, (2.0, 0.5, 1.0, 3.0)):
+                clusters, scores = mi.clusterer.cluster(*weights, merge_singletons=True)
+                clusters_hash = hashlib.md5(repr(sorted(sorted(clstr) for clstr in clusters)).encode()).hexdigest()
+                expected = merged_clusters[(tree_file, weights)] if use_coords else merged_clusters_no_coords[(tree_file, weights)]
+                if (len(clusters), clusters_hash) != expected:
+                    raise MiphyRuntimeError('merging the singletons of %s with weights %s gave %i clusters (md5 %s), expected %i (md5 %s).' % ((tree_file, weights, len(clusters), clusters_hash) + expected))
+            if use_coords:
+                mi.clusterer.spread_calc = mi.clusterer._tree_std_dev # Spreads from the branch lengths, calculated when first needed.
+                clusters, scores = mi.clusterer.cluster(*params)
+                check_test_clusters(clusters, mi.sequence_names)
+                if mi.clusterer.phase_cluster(*params) != (clusters, scores):
+                    raise MiphyRuntimeError('the phase map was not rebuilt after changing the spread calculation.')
+    print('Testing a tree clustered into singletons...')
+    gene_tree = phylo.load_newick_string('((A_1:0.1,A_2:0.2):0.1,(A_3:0.3,A_4:0.1):0.2);')
+    clusterer = Clusterer(gene_tree, '(A,B);', dict((name, 'A') for name in gene_tree.get_named_leaves()), use_coords=True, coords_file='')
+    weight_grid = [(0.5, 5.0, 1.0, 1.0), (0.5, 1.0, 1.0, 1.0), (0.5, 5.0, 1.0, 1.0, True)] # The first clusters every sequence alone, so can't be refined.
+    if clusterer.cluster_many(weight_grid) != [clusterer.cluster(*weights) for weights in weight_grid]:
+        raise MiphyRuntimeError('clustering a grid of weights gave different results.')
+    if clusterer.phase_cluster(*weight_grid[2]) != clusterer.cluster(*weight_grid[2]):
+        raise MiphyRuntimeError('the phase map did not reproduce the merged clustering.')
+    check_test_clusters(clusterer.cluster(*weight_grid[0])[0], gene_tree.get_named_leaves())
+    print('Testing a binary tree...')
+    gene_tree_data = open(os.path.join(test_dir, 'ugts_small.nwk')).read().strip()
+    info_data = open(os.path.join(test_dir, 'ugt_info.txt')).read()
+    gene_tree_bytes = phylo.load_newick_string(gene_tree_data).binary_string()
+    mi = MiphyInstance(gene_tree_bytes, info_data, gene_tree_format='binary', allowed_wait={}, merge_singletons=False, use_coords=True, coords_file='', verbose=False)
+    params = (0.5, 1.0, 1.0, 1.0)
+    mi.processed(params)
+    check_test_clusters(mi.clusters[params], mi.sequence_names)
+    newick_mi = MiphyInstance(gene_tree_data, info_data, gene_tree_format='newick', allowed_wait={}, merge_singletons=False, use_coords=False, coords_file='', verbose=False)
+    newick_mi.processed(params)
+    tree_file = tempfile.NamedTemporaryFile(suffix='.npz', delete=False)
+    try:
+        tree_file.write(gene_tree_bytes)
+        tree_file.close()
+        binary_tree = load_gene_tree_data(tree_file.name, 'auto') # Memory-mapped, as MIPhy opens binary tree files.
+        mi = MiphyInstance(binary_tree, info_data, gene_tree_format='auto', allowed_wait={}, merge_singletons=False, use_coords=False, coords_file='', verbose=False)
+        mi.processed(params)
+        if binary_tree._tree is not None:
+            raise MiphyRuntimeError('the binary tree was built, though clustering without coordinates only needs its arrays.')
+        if (mi.clusters[params], mi.scores[params]) != (newick_mi.clusters[params], newick_mi.scores[params]):
+            raise MiphyRuntimeError('the memory-mapped binary tree did not reproduce the clustering of the newick tree.')
+        if binary_tree.get_named_children() != binary_tree.tree.get_named_children() or binary_tree.get_postorder_names() != binary_tree.tree.get_postorder_names():
+            raise MiphyRuntimeError('the arrays of the binary tree did not match the tree built from them.')
+        del mi, binary_tree # Releases the memory map, so the file can be removed.
+    finally:
+        os.remove(tree_file.name)
+    print('-- passed; %i sequences were loaded.' % len(newick_mi.sequence_names))
+    print('Testing a set of trees...')
+    gene_tree = phylo.load_newick_string(gene_tree_data)
+    ts = TreeSetInstance(io.StringIO(phylo.multiple_nexus_string([gene_tree]*3)), info_data, use_coords=True, verbose=False, processes=2)
+    params = (0.5, 1.0, 1.0, 1.0)
+    ts.processed(params)
+    mi = MiphyInstance(gene_tree_data, info_data, gene_tree_format='auto', allowed_wait={}, merge_singletons=False, use_coords=True, coords_file='', verbose=False)
+    mi.processed(params)
+    seq_inds = dict((name, i) for i, name in enumerate(ts.sequence_names))
+    expected = np.zeros((len(seq_inds), len(seq_inds)))
+    for clstr in mi.clusters[params]:
+        inds = [seq_inds[name] for name in clstr]
+        expected[np.ix_(inds, inds)] = 1.0
+    if ts.co_clusters.num_clusterings != 3 or not np.array_equal(ts.co_clusters.frequencies(), expected):
+        raise MiphyRuntimeError('the co-clustering frequencies of the tree set were incorrect.')
+    print('-- passed; %i trees were clustered.' % ts.num_trees)
+    # A caterpillar tree far deeper than Python's recursion limit.
+    num_leaves, species = 50000, ('A', 'B', 'C', 'D', 'E')
+    print('Testing a caterpillar tree with %i leaves...' % num_leaves)
+    names = ['%s_%i' % (species[i % len(species)], i) for i in range(num_leaves)]
+    tree_buff = ['('*(num_leaves-1), names[0], ':0.1']
+    for i, name in enumerate(names[1:]):
+        tree_buff.append(',%s:%.2f):%.2f' % (name, 0.1 + (i % 7) * 0.05, 0.05 + (i % 3) * 0.1))
+    gene_tree = phylo.load_newick_string(''.join(tree_buff) + ';')
+    if len(gene_tree.get_postorder_nodes()) != 2*num_leaves - 1 or gene_tree.copy().get_ordered_names() != names or gene_tree.newick_string().count(',') != num_leaves - 1:
+        raise MiphyRuntimeError('traversal of the caterpillar tree failed.')
+    species_map = dict((name, name.partition('_')[0]) for name in names)
+    clusterer = Clusterer(gene_tree, '((A,B),(C,(D,E)));', species_map, use_coords=False, coords_file='')
+    clusters, scores = clusterer.cluster()
+    check_test_clusters(clusters, names)
+    parallel_clusterer = Clusterer(gene_tree, '((A,B),(C,(D,E)));', species_map, use_coords=False, coords_file='', processes=2)
+    if not np.array_equal(parallel_clusterer.node_counts, clusterer.node_counts) or parallel_clusterer.cluster() != (clusters, scores):
+        raise MiphyRuntimeError('reconciling the caterpillar tree in parallel gave different results.')
+    info_data = '[species tree]\n((A,B),(C,(D,E)));\n[species assignments]\n' + '\n'.join('%s = %s' % (spc, ', '.join(names[i::len(species)])) for i, spc in enumerate(species))
+    mi = MiphyInstance(''.join(tree_buff) + ';', info_data, gene_tree_format='auto', allowed_wait={}, merge_singletons=False, use_coords=False, coords_file='', verbose=False)
+    params = (0.5, 1.0, 1.0, 1.0)
+    mi.processed(params)
+    if mi.clusters[params] != clusters or phylo.load_phyloxml_string(mi.tree_data).get_ordered_names() != names:
+        raise MiphyRuntimeError('the MIPhy instance of the caterpillar tree gave different results.')
+    print('-- passed; the results page data was generated.')
+    num_leaves = 400
+    print('Testing the distance matrix of a caterpillar tree with %i leaves...' % num_leaves)
+    tree_buff = ['('*(num_leaves-1), names[0], ':0.1']
+    for i, name in enumerate(names[1:num_leaves]):
+        tree_buff.append(',%s:%.4f):%.4f' % (name, (i * 0.618) % 1, (i * 0.414) % 1))
+    gene_tree = phylo.load_newick_string(''.join(tree_buff) + ';')
+    dist_names, dist_mat = gene_tree.get_distance_matrix()
+    leaves = [gene_tree.node_names[name] for name in dist_names]
+    for i in range(0, num_leaves, 5):
+        expected = np.array([gene_tree.node_distance(leaves[i], leaf) for leaf in leaves])
+        if not np.array_equal(dist_mat[i], expected):
+            raise MiphyRuntimeError('the distance matrix differed from node_distance().')
+    print('-- passed; the distances were identical to node_distance().')
+    print('All tests passed.')
+def check_test_clusters(clusters, names):
+    clustered = [name for clstr in clusters for name in clstr]
+    if len(clustered) != len(names) or set(clustered) != set(names):
+        raise MiphyRuntimeError('the clusters do not contain each sequence exactly once.')
+    print('-- passed; %i sequences were grouped into %i clusters.' % (len(names), len(clusters)))
 
 # If clusterer.py finds a validation error, such as sequences classified as some species but that species is missing from the species tree, it gives an appropriate error message on the local version. the online version just crashes with a generic 502 error. Fix that.
 # For the local version, if you upload and run miphy, but neer click view, then closet he browser, it hangs.
@@ -159,23 +353,33 @@ if __name__ == '__main__':
         test_miphy()
         exit()
     gene_tree_file, info_file = validate_args(parser, args)
-    gene_tree_data = open(gene_tree_file).read().strip()
     info_data = open(info_file).read()
     options = validate_options(parser, opts)
+    if not opts.tree_set: # A set of trees is streamed from the file instead.
+        gene_tree_data = load_gene_tree_data(gene_tree_file, options['tree_format'])
 
     merge_singles = False
 
-    if options['results_file']: # Don't need to start the MIPhy server.
-        mi = MiphyInstance(gene_tree_data, info_data, gene_tree_format=options['tree_format'], allowed_wait={}, merge_singletons=merge_singles, use_coords=options['use_coords'], coords_file=options['coords_file'], verbose=opts.verbose)
+    if opts.tree_set: # Cluster every tree in the set, without the MIPhy server.
+        ts = TreeSetInstance(gene_tree_file, info_data, use_coords=options['use_coords'], verbose=opts.verbose, processes=options['processes'], variance_target=options['variance_target'], tree_format=options['tree_format'])
+        ts.processed(options['params'])
+        data = generate_tree_set_csv(options['only_species'], ts)
+        with open(options['results_file'], 'w') as f:
+            f.write(data)
+        print('\nCo-clustering frequencies of %i trees saved to %s' % (ts.num_trees, options['results_file']))
+    elif options['results_file']: # Don't need to start the MIPhy server.
+        mi = MiphyInstance(gene_tree_data, info_data, gene_tree_format=options['tree_format'], allowed_wait={}, merge_singletons=merge_singles, use_coords=options['use_coords'], coords_file=options['coords_file'], verbose=opts.verbose, processes=options['processes'], variance_target=options['variance_target'])
         mi.processed(options['params'])
+        print_spread_errors(mi, options['params'])
         data = generate_csv(options['only_species'], mi, options['params'])
         with open(options['results_file'], 'w') as f:
             f.write(data)
         print('\nInstability scores saved to %s' % options['results_file'])
     else: # Start the MIPhy server.
-        daemon = miphy_daemon.Daemon(options['server_port'], web_server=False, instance_timeout_inf=opts.manual_browser, verbose=opts.verbose, downloads_dir=options['downloads_dir'])
-        idnum = daemon.new_instance(gene_tree_data, info_data, gene_tree_format=options['tree_format'], merge_singletons=merge_singles, use_coords=options['use_coords'], coords_file=options['coords_file'])
+        daemon = miphy_daemon.Daemon(options['server_port'], web_server=False, instance_timeout_inf=opts.manual_browser, verbose=opts.verbose, downloads_dir=options['downloads_dir'], phase_map=opts.phase_map)
+        idnum = daemon.new_instance(gene_tree_data, info_data, gene_tree_format=options['tree_format'], merge_singletons=merge_singles, use_coords=options['use_coords'], coords_file=options['coords_file'], processes=options['processes'], variance_target=options['variance_target'])
         daemon.process_instance(idnum, options['params'])
+        print_spread_errors(daemon.sessions[idnum], options['params'])
         results_url = 'http://127.0.0.1:%i/results?%s' % (options['server_port'], idnum)
         if opts.manual_browser:
             print('\nMIPhy daemon started. Use the following URL to access the results:\n%s' % results_url)
@@ -1,61 +1,371 @@
 """MIPhy class that performs the clustering and stability analysis.
 """
 
-import os
+import os, time, threading, multiprocessing
+from fractions import Fraction
 import numpy as np
 from miphy_resources.miphy_common import MiphyValidationError, MiphyRuntimeError
 from miphy_resources import phylo
 
 
 class Clusterer(object):
-    def __init__(self, gene_tree, species_tree_data, species_map, use_coords, coords_file, verbose=False):
+    def __init__(self, gene_tree, species_tree_data, species_map, use_coords, coords_file, verbose=False, variance_target=None, clade_memo=None, processes=1):
         self.species_map = species_map
         self.use_coords = use_coords
         self.verbose = verbose
+        self.variance_target = variance_target # If given, coordinates are truncated to the dimensions explaining this fraction of the variance.
+        self.max_dimensions = 64 # Limit on the truncated dimensions. Tree distance spectra decay slowly, so without it the randomized solver grows until it is slower than the full decomposition.
         # #  Options for spread calculation
-        self.spread_calc = self._cluster_std_dev # Swap method if desired.
+        self.spread_calc = self._cluster_std_dev # Swap method if desired. self._tree_std_dev calculates spreads from the gene tree's branch lengths, without any coordinates.
         self.singleton_spread = 0.0
         self.relative_avg = 'median' # One of: 'mean' or 'median'. Specifies how the average spread is calculated.
-        # Could add an option to iterate refinement.
+        # #  Options for loss counting
+        self.loss_memo_size = 2**18 # Maximum number of loss counts kept; the memo is cleared when full.
+        self._loss_memo, self._loss_memo_hits, self._loss_memo_misses = {}, 0, 0
+        self.clade_memo = clade_memo # A CladeMemo, which may be shared with the clusterers of related gene trees.
+        # #  Options for parallel reconciliation
+        self.processes = processes # Number of processes reconciling the gene tree. Above 1, the tree is cut into disjoint subtrees that are reconciled at the same time.
+        self.parallel_min_nodes = 20000 # Smaller gene trees are always reconciled in this process, as starting the workers would cost more than it saves.
+        self._lock = threading.RLock() # Guards the caches that are filled as needed, so concurrent calls are safe.
+        # #  Options for the phase map
+        self.phase_box = (0.0, 10.0) # Range of each weight swept by build_phase_map(); matches the limits of the results page.
+        self.phase_resolution = 0.1 # Smallest step taken by build_phase_map(); narrower regions are only calculated when asked for.
+        self.phase_map_time = 10.0 # Seconds build_phase_map() may run for.
+        self.phase_map_size = 1000 # Maximum number of regions kept; the map is cleared when full.
+        self.clear_phase_map()
+        # #  Options for refinement
+        self.refine_iterations = 1 # Maximum rounds of refinement. Each round recalculates the average spread from the clusters of the last round, stopping early once the clusters no longer change.
         if verbose: print('Setting up the clusterer...')
         self.parse_gene_tree(gene_tree, coords_file)
         self.parse_species_tree(species_tree_data)
         self.validate_data() # Gene tree has already been checked, this checks species tree.
+        self.reconcile_gene_tree()
         if verbose: print('Finished setting up the clusterer.')
+    def __getstate__(self):
+        # The lock can't be pickled, so a clusterer sent to another process gets a new one. Nor is the gene tree sent, so the spreads that need it are calculated first.
+        self._get_tree_spreads()
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_gene_tree'] = None
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
 
     # # # # #  Main method:
     def cluster(self, i_coefficient=0.5, d_coefficient=1.0, l_coefficient=1.0, spread_coefficient=1.0, merge_singletons=False):
-        self.nodes = {}
         params = {'i_coef':float(i_coefficient), 'd_coef':float(d_coefficient),
             'l_coef':float(l_coefficient), 'm_coef':float(l_coefficient),
             'spread_coef':float(spread_coefficient)}
-        self._calc_clusters(self.gene_root, params)
+        ctx = _ClusterContext() # Holds the state of this call, so the clusterer itself is never modified.
+        self._calc_clusters(ctx, params)
         # Refine clusters
         avg_spread = None
+        cluster_roots = self._collect_cluster_roots(ctx.is_cluster.tolist())
         if self.use_coords:
-            spreads = [self.spread_calc(clstr) for clstr in self.nodes[self.gene_root].clusters if len(clstr) != 1]
-            if self.relative_avg == 'median':
-                spreads.sort()
-                med_i = (len(spreads)+1)//2-1
-                avg_spread = (spreads[med_i] + spreads[-med_i-1])/2.0
-            elif self.relative_avg == 'mean':
-                avg_spread = sum(spreads) / float(len(spreads))
-            self._recalc_clusters(self.gene_root, params, avg_spread)
+            seen_roots, iteration, converged = set(), 0, False
+            for iteration in range(self.refine_iterations):
+                roots_avg = self._roots_average_spread(cluster_roots)
+                if roots_avg is None:
+                    break # Every cluster is a singleton, so there is nothing to refine with.
+                avg_spread = roots_avg
+                self._recalc_clusters(ctx, params, avg_spread)
+                refined_roots = self._collect_cluster_roots(ctx.is_cluster.tolist())
+                seen_roots.add(tuple(cluster_roots))
+                converged = refined_roots == cluster_roots
+                cluster_roots = refined_roots
+                if converged or tuple(cluster_roots) in seen_roots: # Stable, or cycling between clusterings.
+                    break
+            if self.verbose and self.refine_iterations > 1:
+                print('-- Refined the clusters over %i rounds%s' % (iteration+1, '' if converged else ', without converging'))
         # Merge singletons
+        merged_spreads = {}
         if merge_singletons:
-            self._merge_singletons(avg_spread)
+            cluster_roots, merged = self._merge_singletons(cluster_roots)
+            for parent_node in merged: # Update parent to force combined MIG instead of separate
+                ind = self.node_inds[parent_node]
+                ctx.total_scores[ind] = ctx.comb_scores[ind]
+                ctx.is_cluster[ind] = True
+                if self.use_coords: # Without coordinates no cluster has a spread, merged or not.
+                    merged_spreads[parent_node] = self.spread_calc(parent_node, avg_spread)
         # Process clusters and scores
-        self.nodes[self.gene_root].cluster_roots.sort(key=lambda n: self.nodes[n].total_score)
-        self.nodes[self.gene_root].clusters = [sorted(self.nodes[node].clusters[0]) \
-            for node in self.nodes[self.gene_root].cluster_roots]
-        clusters = [clstr[:] for clstr in self.nodes[self.gene_root].clusters]
-        scores = {}
-        for clstr_root in self.nodes[self.gene_root].cluster_roots:
-            for name in self.nodes[clstr_root].clusters[0]:
-                n = self.nodes[clstr_root]
-                scores[name] = (self.nodes[clstr_root].total_score, [n.i, n.d, n.l+n.m, n.spread])
-        clusters.sort(key=lambda c: -scores[c[0]][0])
+        root_info = {}
+        for node in cluster_roots:
+            ind = self.node_inds[node]
+            if node in merged_spreads:
+                spread = merged_spreads[node]
+            elif ctx.comb_spreads is None or node in self.gene_leaves_set:
+                spread = None
+            else:
+                spread = ctx.comb_spreads[ind]
+            root_info[node] = (ctx.total_scores[ind], spread)
+        clusters, scores = self._format_clusters(cluster_roots, root_info)
+        if self.verbose and self.coord_residuals is not None:
+            errors = self.spread_errors(clusters)
+            if errors:
+                print('-- Estimated relative error of the truncated spreads: median %.3f, max %.3f' % (errors[(len(errors)-1)//2], errors[-1]))
         return clusters, scores
+    def cluster_many(self, param_grid):
+        """Clusters the gene tree under each parameter set in 'param_grid', a sequence of tuples of arguments for cluster(). Returns a list with the (clusters, scores) from each, the same as cluster() would return.
+        The scores of each node are held as vectors over the whole grid, so all parameter sets are scored in one pass over the tree. With more than one round of refinement, each parameter set is clustered separately."""
+        if self.use_coords and self.refine_iterations > 1:
+            return [self.cluster(*params) for params in param_grid]
+        defaults = (0.5, 1.0, 1.0, 1.0, False)
+        param_grid = [tuple(params) + defaults[len(params):] for params in param_grid]
+        i_coefs, d_coefs, l_coefs, spread_coefs = (np.array(coefs, dtype=float) for coefs in list(zip(*param_grid))[:4])
+        m_coefs = l_coefs
+        num_nodes, num_params = len(self.gene_postorder), len(param_grid)
+        inds = self.node_inds
+        children = [[inds[child] for child in self.gene_children[node]] for node in self.gene_postorder]
+        # Score events, as in _calc_clusters(). Rows of these arrays are nodes, columns are parameter sets.
+        comb_scores, scores = np.empty((num_nodes, num_params)), np.empty((num_nodes, num_params))
+        is_cluster = np.ones((num_nodes, num_params), dtype=bool)
+        for ind, node in enumerate(self.gene_postorder):
+            d, i, l, m = self.node_events[node]
+            if node in self.gene_leaves_set:
+                scores[ind] = comb_scores[ind] = m * m_coefs
+                continue
+            child1, child2 = children[ind]
+            comb_scores[ind] = d*d_coefs + i*i_coefs + l*l_coefs + m*m_coefs
+            separate = scores[child1] + scores[child2]
+            is_cluster[ind] = ~(separate < comb_scores[ind])
+            scores[ind] = np.where(is_cluster[ind], comb_scores[ind], separate)
+        # Refine clusters, as in _recalc_clusters().
+        avg_spreads, comb_spreads = [None]*num_params, None
+        if self.use_coords:
+            root_mask = self._grid_cluster_roots(is_cluster, children)
+            internal = np.array([node not in self.gene_leaves_set for node in self.gene_postorder])
+            raw_spreads = np.array([self.spread_calc(node) if internal[ind] else 0.0 for ind, node in enumerate(self.gene_postorder)])
+            for k in range(num_params):
+                root_spreads = raw_spreads[root_mask[:,k] & internal].tolist()
+                if root_spreads: # Otherwise every cluster is a singleton, so there is nothing to refine with.
+                    avg_spreads[k] = self._average_spread(root_spreads)
+            cols = np.array([k for k in range(num_params) if avg_spreads[k] is not None], dtype=int) # The parameter sets that are refined.
+            avg_vector = np.array([avg_spreads[k] for k in cols], dtype=float)
+            comb_spreads = np.zeros((num_nodes, num_params))
+            for ind, node in enumerate(self.gene_postorder):
+                comb_spreads[ind,cols] = self.spread_calc(node, avg_vector)
+                spread_scores = comb_spreads[ind,cols]*spread_coefs[cols]
+                if not internal[ind]:
+                    scores[ind,cols] = comb_scores[ind,cols] = scores[ind,cols] + spread_scores
+                    continue
+                child1, child2 = children[ind]
+                comb_scores[ind,cols] = comb_scores[ind,cols] + spread_scores
+                separate = scores[child1,cols] + scores[child2,cols]
+                is_cluster[ind,cols] = ~(separate < comb_scores[ind,cols])
+                scores[ind,cols] = np.where(is_cluster[ind,cols], comb_scores[ind,cols], separate)
+        # Collect the clusters of each parameter set.
+        root_mask = self._grid_cluster_roots(is_cluster, children)
+        results = []
+        for k, params in enumerate(param_grid):
+            cluster_roots = [self.gene_postorder[ind] for ind in self._preorder_inds(np.nonzero(root_mask[:,k])[0])]
+            merged = []
+            if params[4]:
+                cluster_roots, merged = self._merge_singletons(cluster_roots)
+            root_info = {}
+            for node in cluster_roots:
+                ind = inds[node]
+                if node in merged and self.use_coords:
+                    spread = self.spread_calc(node, avg_spreads[k])
+                elif comb_spreads is None or avg_spreads[k] is None or node in self.gene_leaves_set:
+                    spread = None
+                else:
+                    spread = comb_spreads[ind,k]
+                root_info[node] = (comb_scores[ind,k], spread)
+            results.append(self._format_clusters(cluster_roots, root_info))
+        return results
+
+    # # # # #  Phase map methods:
+    def build_phase_map(self, weights=(0.5, 1.0, 1.0, 1.0)):
+        """Sweeps each weight across self.phase_box starting from 'weights', with the other weights held fixed, and stores the regions of the parameter space passed through. Returns the number of stored regions.
+        Every score is linear in the weights, so the parameter space is divided into regions in which no node's separate-vs-merge decision changes. The end of a region along a weight is found directly from its constraints, so the tree is only processed once per region. The sweeps take turns, so stopping after self.phase_map_time seconds leaves the regions closest to 'weights'."""
+        t0 = time.time()
+        low, high = self.phase_box
+        sweeps = []
+        for axis in range(4):
+            for direction in (1.0, -1.0):
+                point = [float(w) for w in weights[:4]]
+                sweeps.append((axis, direction, point, self._phase_region(point)))
+        while sweeps and time.time() - t0 < self.phase_map_time:
+            next_sweeps = []
+            for axis, direction, point, region in sweeps:
+                dist, inside = self._phase_region_exit(region, point, axis, direction)
+                if dist is None or len(self.phase_regions) >= self.phase_map_size:
+                    continue
+                if inside: # The boundary still belongs to this region.
+                    dist += self.phase_resolution * 1e-6
+                point = point[::]
+                point[axis] += direction * max(dist, self.phase_resolution)
+                if low <= point[axis] <= high:
+                    next_sweeps.append((axis, direction, point, self._phase_region(point)))
+            sweeps = next_sweeps
+        if self.verbose: print('-- Phase map holds %i regions, built in %.1f seconds' % (len(self.phase_regions), time.time()-t0))
+        return len(self.phase_regions)
+    def phase_cluster(self, i_coefficient=0.5, d_coefficient=1.0, l_coefficient=1.0, spread_coefficient=1.0, merge_singletons=False):
+        """Returns the (clusters, scores) of cluster(), taken from the stored region of the phase map containing the weights. If no region contains them, it is calculated from one pass over the tree and stored.
+        Weights on or very near the boundary of their region are passed to cluster() instead. There a node's separate and merged scores tie, and cluster() decides the tie with its own floating point sums (3*1.4 < 4.2, for example), which the region can't reproduce."""
+        i_coef, d_coef, l_coef, spread_coef = weights = [float(i_coefficient), float(d_coefficient), float(l_coefficient), float(spread_coefficient)]
+        region = self._phase_region(weights)
+        if self._phase_near_boundary(region, weights):
+            return self.cluster(i_coefficient, d_coefficient, l_coefficient, spread_coefficient, merge_singletons)
+        cluster_roots, merged = region.cluster_roots, []
+        if merge_singletons:
+            cluster_roots, merged = self._merge_singletons(cluster_roots)
+        root_info = {}
+        for node in cluster_roots: # Scored in the same order of operations as cluster().
+            d, i, l, m = self.node_events[node]
+            if node in self.gene_leaves_set:
+                total_score = m*l_coef
+            else:
+                total_score = d*d_coef + i*i_coef + l*l_coef + m*l_coef
+            spread = None
+            if self.use_coords:
+                comb_spread = self.spread_calc(node, region.avg_spread)
+                if region.avg_spread is not None: # Otherwise the clusters weren't refined, so cluster() scores them without their spreads.
+                    total_score = total_score + comb_spread*spread_coef
+                if node not in self.gene_leaves_set:
+                    spread = comb_spread
+            root_info[node] = (total_score, spread)
+        return self._format_clusters(cluster_roots, root_info)
+    def clear_phase_map(self):
+        with self._lock:
+            self.phase_regions = []
+            self._phase_row_inds = {} # The constraints of every region, {row:index, ...}. Neighbouring regions share most of theirs.
+            self._phase_rows = np.zeros((1024, 4))
+            self._phase_owners = None # The rows of all regions in single arrays, built as needed by _phase_region().
+            self._phase_last = None
+            self._phase_spread_calc = self.spread_calc # The regions depend on the spreads, so the map is cleared if the method changes.
+    def _phase_region(self, weights):
+        """Returns the stored region containing 'weights', calculating and storing it if needed. The region returned last is checked first, as the weights usually change by small steps. Holds the lock, as the map is shared by every call."""
+        with self._lock:
+            if self._phase_spread_calc != self.spread_calc:
+                self.clear_phase_map()
+            exact_weights = self._phase_exact_weights(weights)
+            if self._phase_last is not None:
+                region = self._phase_last
+                positive, nonnegative = self._phase_row_signs(self._phase_rows[region.strict_inds], weights, exact_weights)
+                if np.all(positive):
+                    positive, nonnegative = self._phase_row_signs(self._phase_rows[region.loose_inds], weights, exact_weights)
+                    if np.all(nonnegative):
+                        return region
+            if self.phase_regions:
+                if self._phase_owners is None:
+                    self._phase_owners = [(np.concatenate([getattr(region, att) for region in self.phase_regions]),
+                        np.concatenate([np.full(len(getattr(region, att)), ind, dtype=int) for ind, region in enumerate(self.phase_regions)]))
+                        for att in ('strict_inds', 'loose_inds')]
+                (strict_inds, strict_owners), (loose_inds, loose_owners) = self._phase_owners
+                positive, nonnegative = self._phase_row_signs(self._phase_rows[:len(self._phase_row_inds)], weights, exact_weights)
+                outside = np.zeros(len(self.phase_regions), dtype=bool)
+                outside[strict_owners[~positive[strict_inds]]] = True
+                outside[loose_owners[~nonnegative[loose_inds]]] = True
+                inside = np.nonzero(~outside)[0]
+                if len(inside):
+                    self._phase_last = self.phase_regions[inside[0]]
+                    return self._phase_last
+            if len(self.phase_regions) >= self.phase_map_size:
+                self.clear_phase_map()
+            region = _PhaseRegion()
+            strict_rows, loose_rows, scale = set(), set(), [0.0]*4
+            is_cluster = self._phase_decisions(weights, exact_weights, None, strict_rows, loose_rows, scale)
+            region.cluster_roots = self._collect_cluster_roots(is_cluster)
+            if self.use_coords: # Refined as in cluster(); the constraints of every round apply to the region.
+                seen_roots = set()
+                for iteration in range(self.refine_iterations):
+                    roots_avg = self._roots_average_spread(region.cluster_roots)
+                    if roots_avg is None:
+                        break
+                    region.avg_spread = roots_avg
+                    is_cluster = self._phase_decisions(weights, exact_weights, region.avg_spread, strict_rows, loose_rows, scale)
+                    refined_roots = self._collect_cluster_roots(is_cluster)
+                    seen_roots.add(tuple(region.cluster_roots))
+                    converged = refined_roots == region.cluster_roots
+                    region.cluster_roots = refined_roots
+                    if converged or tuple(refined_roots) in seen_roots:
+                        break
+            region.strict_inds, region.loose_inds = self._phase_row_indices(strict_rows), self._phase_row_indices(loose_rows)
+            region.scale = np.array(scale)
+            self.phase_regions.append(region)
+            self._phase_owners, self._phase_last = None, region
+            return region
+    def _phase_row_signs(self, rows, weights, exact_weights):
+        """Returns boolean arrays marking the rows whose dot product with the weights is > 0, and those where it is >= 0."""
+        values = rows.dot(weights)
+        tols = 1e-9 * np.abs(rows).dot(np.abs(weights))
+        positive, nonnegative = values > tols, values >= -tols
+        for ind in np.nonzero(np.abs(values) <= tols)[0]: # Too close to 0 to trust the floating point result.
+            value = self._phase_sign(rows[ind].tolist(), weights, exact_weights)
+            positive[ind], nonnegative[ind] = value > 0, value >= 0
+        return positive, nonnegative
+    def _phase_decisions(self, weights, exact_weights, avg_spread, strict_rows, loose_rows, scale):
+        """Runs the clustering pass of _calc_clusters(), or of _recalc_clusters() if 'avg_spread' is given, at 'weights'. Each score is kept as its coefficients of the weights (i, d, l, spread), and the constraints fixing each decision are added to 'strict_rows' (dot product with the weights must be > 0) or 'loose_rows' (>= 0). The coefficients of every node are added to 'scale', so it bounds those of any score in the tree. Returns a list of the is_cluster decision of each node in self.gene_postorder."""
+        coefs, is_cluster = {}, [True]*len(self.gene_postorder)
+        for ind, node in enumerate(self.gene_postorder):
+            d, i, l, m = self.node_events[node]
+            spread = 0.0 if avg_spread is None else self.spread_calc(node, avg_spread)
+            if node in self.gene_leaves_set:
+                coefs[node] = (0, 0, m, spread)
+                scale[2] += m
+                scale[3] += spread
+                continue
+            comb = (i, d, l+m, spread)
+            for k in range(4):
+                scale[k] += comb[k]
+            child1, child2 = self.gene_children[node]
+            separate = tuple(a + b for a, b in zip(coefs[child1], coefs[child2]))
+            diff = tuple(a - b for a, b in zip(separate, comb))
+            if self._phase_sign(diff, weights, exact_weights) < 0:
+                coefs[node], is_cluster[ind] = separate, False
+                strict_rows.add(tuple(-a for a in diff))
+            else:
+                coefs[node] = comb
+                if any(diff) or any(comb): # A zero row is always tied; cluster() may still decide it either way.
+                    loose_rows.add(diff)
+        return is_cluster
+    def _phase_near_boundary(self, region, weights):
+        """Returns True if the weights are close enough to a constraint of 'region' that cluster() might decide the tie differently. The floating point error of cluster() grows with the size of its scores, so the tolerance is taken from region.scale."""
+        rows = self._phase_rows[np.concatenate((region.strict_inds, region.loose_inds))]
+        tol = 1e-9 * region.scale.dot(np.abs(weights))
+        return bool(np.any(np.abs(rows.dot(weights)) <= tol))
+    def _phase_exact_weights(self, weights):
+        """Returns the weights as integers over a common denominator, treating them as the decimals they were entered as."""
+        fracs = [Fraction(repr(float(w))) for w in weights]
+        denom = 1
+        for frac in fracs:
+            denom *= frac.denominator
+        return [int(frac * denom) for frac in fracs]
+    def _phase_sign(self, row, weights, exact_weights):
+        """Returns a number with the sign of the dot product of 'row' and the weights. Values too close to 0 to trust the floating point result are recalculated exactly."""
+        value = sum(a*w for a, w in zip(row, weights))
+        if abs(value) > 1e-9 * sum(abs(a*w) for a, w in zip(row, weights)):
+            return value
+        if all(a == int(a) for a in row):
+            return sum(int(a)*w for a, w in zip(row, exact_weights))
+        return sum(Fraction(a)*w for a, w in zip(row, exact_weights))
+    def _phase_row_indices(self, rows):
+        """Returns an array of the indices of 'rows' in self._phase_rows, adding any that are new."""
+        inds = []
+        for row in rows:
+            ind = self._phase_row_inds.get(row)
+            if ind is None:
+                ind = self._phase_row_inds[row] = len(self._phase_row_inds)
+                if ind == len(self._phase_rows):
+                    self._phase_rows = np.concatenate((self._phase_rows, np.zeros(self._phase_rows.shape)))
+                self._phase_rows[ind] = row
+            inds.append(ind)
+        return np.array(inds, dtype=int)
+    def _phase_region_exit(self, region, weights, axis, direction):
+        """Returns how far the weights can move along 'axis' in 'direction' (1.0 or -1.0) before leaving 'region', and if the boundary itself is part of the region. Returns None, False if they never leave."""
+        best, inside = None, False
+        for inds, strict in ((region.strict_inds, True), (region.loose_inds, False)):
+            rows = self._phase_rows[inds]
+            slopes = rows[:,axis] * direction
+            leaving = slopes < 0
+            if not np.any(leaving):
+                continue
+            dist = max(float(np.min(rows[leaving].dot(weights) / -slopes[leaving])), 0.0)
+            if best is None or dist < best or (dist == best and strict):
+                best, inside = dist, not strict
+        return best, inside
 
     # # # # #  Option parsing and checking methods:
     def parse_gene_tree(self, gene_tree, coords_file):
@@ -63,11 +373,31 @@ class Clusterer(object):
             raise MiphyValidationError('the given gene tree contains polytomies; MIPhy currently cannot handle non-binary gene trees. If this functionality would be useful to you, please contact the authors to request it.')
         self.gene_leaves = gene_tree.get_named_leaves()
         self.gene_leaves_set = set(self.gene_leaves)
-        self.gene_root = gene_tree.root.name
         self.gene_children = gene_tree.get_named_children()
-        if self.use_coords:
+        self.gene_parents = dict((child, parent) for parent, children in self.gene_children.items() for child in children)
+        self.gene_postorder = gene_tree.get_postorder_names() # Every node comes after its children.
+        self.gene_root = self.gene_postorder[-1]
+        self.node_inds = dict((name, ind) for ind, name in enumerate(self.gene_postorder))
+        self.node_clade_keys = None
+        if self.clade_memo is not None:
+            clade_keys = gene_tree.get_clade_keys()
+            self.node_clade_keys = [clade_keys[node] for node in gene_tree.get_postorder_nodes()]
+        self.node_children, self.node_levels = self._calc_node_levels()
+        self.leaf_mask = self.node_children[:,0] < 0
+        self._raw_spreads, self._raw_spreads_calc = None, None
+        self.leaf_order, self.leaf_ranges = self._calc_leaf_ranges()
+        self.gene_leaf_inds = dict((name, i) for i, name in enumerate(self.leaf_order)) # Row of each leaf in self.coords
+        self.coord_residuals = None
+        self._gene_tree, self.tree_spreads = gene_tree, None # The spreads from the tree's branch lengths are only calculated if self._tree_std_dev is used.
+        if self.use_coords and self.spread_calc == self._tree_std_dev:
+            self.coords = None
+        elif self.use_coords:
             if not coords_file or not os.path.isfile(coords_file):
-                _, self.coords = gene_tree.get_leaf_coordinate_points()
+                if self.variance_target:
+                    _, self.coords, self.coord_residuals = gene_tree.get_truncated_leaf_coordinate_points(self.variance_target, self.max_dimensions)
+                    if self.verbose: print('-- Truncated the coordinate points to %i dimensions' % self.coords.shape[1])
+                else:
+                    _, self.coords = gene_tree.get_leaf_coordinate_points()
             else:
                 if self.verbose: print('-- Loading coordinate points from %s...' % coords_file)
                 try:
@@ -80,28 +410,165 @@ class Clusterer(object):
             if coords_file and not os.path.isfile(coords_file):
                 self._save_coords(self.coords, coords_file)
                 print('Saved coordinate points to %s' % coords_file)
+            # Reorder the rows to match self.leaf_order, so the points of any cluster are a slice of self.coords.
+            gene_inds = dict((name, i) for i, name in enumerate(self.gene_leaves))
+            order = [gene_inds[name] for name in self.leaf_order]
+            self.coords = self.coords[order]
+            if self.coord_residuals is not None:
+                self.coord_residuals = self.coord_residuals[order]
+            self.coord_spreads = self._calc_coord_spreads()
         else:
             self.coords = None
     def parse_species_tree(self, species_tree_data):
-        spc_tree = phylo.load_newick_string(species_tree_data)
+        if isinstance(species_tree_data, phylo.Tree): # Already parsed, as when clustering a set of gene trees.
+            spc_tree = species_tree_data
+        else:
+            spc_tree = phylo.load_newick_string(species_tree_data)
         self.species = spc_tree.get_named_leaves()
-        self.species_paths = spc_tree.get_named_paths()
         self.num_species = len(self.species)
+        self._build_species_index(spc_tree)
+        self.species_leaf_ids = [self.species_ids[spc] for spc in self.species]
+        # Species compositions are bitmasks, where bit i represents self.species_leaf_ids[i].
+        self.species_bits = dict((spc_id, 1 << i) for i, spc_id in enumerate(self.species_leaf_ids))
+        self.all_species_mask = (1 << self.num_species) - 1
     def validate_data(self):
         for gene in self.gene_leaves:
             if gene not in self.species_map:
                 raise MiphyValidationError('A sequence named "{}" was not mapped to a species in the information file'.format(gene))
             elif self.species_map[gene] not in self.species:
                 raise MiphyValidationError('"{}" from the species assignments was not found in the given species tree in the information file'.format(self.species_map[gene]))
+    def reconcile_gene_tree(self):
+        """Fills out self.node_events {node_name:(d, i, l, m), ...}, as well as the recent common ancestor and species composition of each node. None of these depend on the weights, so they are only counted once, and cluster() only has to score them."""
+        children = self.node_children.tolist()
+        leaf_rcas = [self.species_ids[self.species_map[node]] if node in self.gene_leaves_set else -1 for node in self.gene_postorder]
+        known, memo = {}, self.clade_memo # known is {ind:(rca, comp, (d, i, l, m)), ...} for nodes already reconciled.
+        if memo is not None:
+            memo.check_species((tuple(self.species_names), tuple(self._species_last_desc), frozenset(self.species_map.items())))
+            for ind, clade_key in enumerate(self.node_clade_keys):
+                reconciled = memo.get(clade_key)
+                if reconciled is not None:
+                    known[ind] = reconciled
+        if self.processes > 1 and len(children) >= self.parallel_min_nodes:
+            known.update(self._reconcile_subtrees(children, leaf_rcas, known))
+        rcas, comps, events = self._reconcile_block(children, leaf_rcas, known)
+        if memo is not None:
+            for ind, clade_key in enumerate(self.node_clade_keys):
+                memo.add(clade_key, (rcas[ind], comps[ind], events[ind]))
+        self.node_rcas = dict(zip(self.gene_postorder, rcas))
+        self.node_species_comps = dict(zip(self.gene_postorder, comps))
+        self.node_events = dict(zip(self.gene_postorder, events))
+        self.node_counts = np.array(events, dtype=int).reshape(-1, 4) # Columns are d, i, l, m.
+        if self.verbose: print('-- Loss count memo: %i hits, %i misses' % (self._loss_memo_hits, self._loss_memo_misses))
+        if self.verbose and memo is not None: print('-- Clade memo: %i hits, %i misses' % (memo.hits, memo.misses))
 
     # # # # #  Misc methods:
     def recent_common_ancestor(self, species):
-        if len(set(species)) == 1:
-            return species[0]
-        for nodes in zip(*map(self.species_paths.get, species)):
-            if len(set(nodes)) != 1: break
-            ancestor = nodes[0]
-        return ancestor
+        ids = [self.species_ids[spc] for spc in species]
+        ancestor = ids[0]
+        for spc_id in ids[1:]:
+            ancestor = self._species_rca(ancestor, spc_id)
+        return self.species_names[ancestor]
+    def _build_species_index(self, spc_tree):
+        """Numbers the species tree nodes in pre-order (self.species_ids and self.species_names), and builds a sparse table over an Euler tour of the tree to find recent common ancestors in constant time.
+        As an ancestor is numbered before its descendants, the ancestor of two nodes is the smallest id in the tour between them, and a node's subtree is the range from its own id to self._species_last_desc[id]."""
+        self.species_ids, self.species_names, parents = {}, [], []
+        euler, first = [], []
+        to_visit = [(spc_tree.root, -1)]
+        while to_visit:
+            node, parent_id = to_visit.pop()
+            if node is None: # Returned to the parent from one of its children.
+                euler.append(parent_id)
+                continue
+            spc_id = len(self.species_names)
+            self.species_ids[node.name] = spc_id
+            self.species_names.append(node.name)
+            parents.append(parent_id)
+            first.append(len(euler))
+            euler.append(spc_id)
+            for child in node.children[::-1]:
+                to_visit.extend(((None, spc_id), (child, spc_id)))
+        self._species_last_desc = list(range(len(parents)))
+        for spc_id in range(len(parents)-1, 0, -1):
+            parent_id = parents[spc_id]
+            self._species_last_desc[parent_id] = max(self._species_last_desc[parent_id], self._species_last_desc[spc_id])
+        self._euler_first = first
+        self._euler_table = [euler] # _euler_table[k][i] is the smallest id in euler[i:i+2**k]
+        width = 1
+        while 2*width <= len(euler):
+            prev = self._euler_table[-1]
+            self._euler_table.append([min(prev[i], prev[i+width]) for i in range(len(euler) - 2*width + 1)])
+            width *= 2
+    def _species_rca(self, id1, id2):
+        """Returns the id of the recent common ancestor of the species tree nodes with ids 'id1' and 'id2'."""
+        left, right = self._euler_first[id1], self._euler_first[id2]
+        if left > right:
+            left, right = right, left
+        k = (right - left + 1).bit_length() - 1
+        row = self._euler_table[k]
+        return min(row[left], row[right - (1 << k) + 1])
+    def _is_species_ancestor(self, id1, id2):
+        """Returns True if the species tree node with id 'id1' is 'id2' or one of its ancestors."""
+        return id1 <= id2 <= self._species_last_desc[id1]
+
+    def _calc_leaf_ranges(self):
+        """Numbers the gene leaves in the order they appear in the tree, so the leaves under every node form a contiguous block. Returns the leaf names in that order, and a dict {node_name:(start, end), ...} giving each node's block as a half-open range."""
+        leaf_order, ranges = [], {}
+        for node in self.gene_postorder:
+            if node in self.gene_leaves_set:
+                ranges[node] = (len(leaf_order), len(leaf_order)+1)
+                leaf_order.append(node)
+            else:
+                child1, child2 = self.gene_children[node]
+                ranges[node] = (ranges[child1][0], ranges[child2][1])
+        return leaf_order, ranges
+    def _format_clusters(self, cluster_roots, root_info):
+        """Returns the (clusters, scores) reported by cluster(), given the cluster roots in tree order and a dict {root:(total_score, spread), ...}."""
+        cluster_roots = sorted(cluster_roots, key=lambda n: root_info[n][0])
+        clusters = [self._cluster_leaves(node) for node in cluster_roots]
+        scores = {}
+        for clstr_root, clstr in zip(cluster_roots, clusters):
+            d, i, l, m = self.node_events[clstr_root]
+            total_score, spread = root_info[clstr_root]
+            for name in clstr:
+                scores[name] = (total_score, [i, d, l+m, spread])
+        clusters.sort(key=lambda c: -scores[c[0]][0])
+        return clusters, scores
+    def _average_spread(self, spreads):
+        if self.relative_avg == 'median':
+            spreads.sort()
+            med_i = (len(spreads)+1)//2-1
+            return (spreads[med_i] + spreads[-med_i-1])/2.0
+        elif self.relative_avg == 'mean':
+            return sum(spreads) / float(len(spreads))
+    def _grid_cluster_roots(self, is_cluster, children):
+        """Given the is_cluster arrays from cluster_many(), returns a boolean array of the same shape marking the cluster roots under each parameter set."""
+        in_cluster = np.zeros(is_cluster.shape, dtype=bool) # If a node is below a cluster root.
+        for ind in range(len(children)-1, -1, -1): # Parents come before their children.
+            for child in children[ind]:
+                in_cluster[child] = in_cluster[ind] | is_cluster[ind]
+        return is_cluster & ~in_cluster
+    def _preorder_inds(self, inds):
+        """Sorts indices into self.gene_postorder into the pre-order of their nodes; a node comes before the nodes that start at the same leaf but contain fewer leaves."""
+        def preorder_key(ind):
+            start, end = self.leaf_ranges[self.gene_postorder[ind]]
+            return (start, start - end)
+        return sorted(inds, key=preorder_key)
+    def _cluster_leaves(self, node):
+        """Returns a sorted list of the names of the leaves under the given node."""
+        start, end = self.leaf_ranges[node]
+        return sorted(self.leaf_order[start:end])
+    def _collect_cluster_roots(self, is_cluster):
+        """Given a list of the is_cluster decision of each node in self.gene_postorder, returns the names of the cluster roots in the order they appear in the gene tree."""
+        cluster_roots, to_visit = [], [len(self.gene_postorder) - 1]
+        children = self.node_children.tolist()
+        while to_visit:
+            ind = to_visit.pop()
+            if is_cluster[ind]:
+                cluster_roots.append(self.gene_postorder[ind])
+            else:
+                child1, child2 = children[ind]
+                to_visit.extend((child2, child1))
+        return cluster_roots
 
     # # # # #  matrix saving / loading methods:
     def _save_coords(self, coords, coords_file):
@@ -111,162 +578,321 @@ class Clusterer(object):
         coords = np.load(coords_file)
         return coords
     # # # # #  Private methods:
-    def _calc_clusters(self, node, params):
-        if node in self.gene_leaves_set:
-            species = self.species_map[node]
-            n = _PhyloST_node(node, species)
-            n.m = self._calc_loss_events((species,))
-            n.total_score = n.event_score = n.m * params['m_coef']
-            n._separate_event_score = n._combined_event_score = n.event_score
-            self.nodes[node] = n
-            return n
-        child1_name, child2_name = self.gene_children[node]
-        child1 = self._calc_clusters(child1_name, params)
-        child2 = self._calc_clusters(child2_name, params)
-        rca = self.recent_common_ancestor((child1.rca, child2.rca))
-        comp = child1.species_comp | child2.species_comp
-        d, i, l = self._count_events(child1, child2)
-        m = self._calc_loss_events(comp)
-        n = _PhyloST_node(node, rca)
-        n.species_comp = comp
-        n.leaves = child1.leaves | child2.leaves
-        n.d, n.i, n.l, n.m = d, i, l, m
-        comb_event_score = d*params['d_coef'] + i*params['i_coef'] + l*params['l_coef'] + m*params['m_coef']
-        n._combined_event_score = comb_event_score
-        n._separate_event_score = child1.event_score + child2.event_score
-        ### TEST < vs <= on the below if statement.
-        if child1.event_score + child2.event_score < comb_event_score: # Keep as seperate clusters.
-            n.total_score = n.event_score = child1.event_score + child2.event_score
-            n.clusters = child1.clusters + child2.clusters
-            n.cluster_roots = child1.cluster_roots + child2.cluster_roots
-        else:  # Merge into one large cluster.
-            n.total_score = n.event_score = comb_event_score
-            n.clusters = [list(n.leaves)]
-            n.cluster_roots = [node]
-        self.nodes[node] = n
-        return n
-    def _count_events(self, child1, child2):
-        d, i, l = child1.d+child2.d, child1.i+child2.i, child1.l+child2.l  # The counts of the children.
-        if not child1.species_comp & child2.species_comp:  # Some sort of speciation.
-            if child1.rca in self.species_paths[child2.rca] \
-                or child2.rca in self.species_paths[child1.rca]:
+    def _calc_clusters(self, ctx, params):
+        """Scores every node as one cluster (ctx.comb_scores) and as the better of that or its children's clusters (ctx.total_scores), and marks which was chosen in ctx.is_cluster. Arrays are indexed by position in self.gene_postorder."""
+        d, i, l, m = self.node_counts.T
+        ctx.comb_event_scores = d*params['d_coef'] + i*params['i_coef'] + l*params['l_coef'] + m*params['m_coef']
+        ctx.comb_event_scores[self.leaf_mask] = m[self.leaf_mask] * params['m_coef']
+        ctx.comb_scores = ctx.comb_event_scores
+        ctx.comb_spreads = None
+        self._score_levels(ctx)
+    def _score_levels(self, ctx):
+        """Fills out ctx.total_scores and ctx.is_cluster from ctx.comb_scores. All nodes of the same height are scored at once, as their children have all been scored before them."""
+        ctx.total_scores = total_scores = ctx.comb_scores.copy()
+        ctx.is_cluster = is_cluster = np.ones(len(self.gene_postorder), dtype=bool)
+        for inds, child1, child2 in self.node_levels:
+            if len(inds) == 1: # Array operations cost more than they save on a single node.
+                ind = inds[0]
+                separate = total_scores[child1[0]] + total_scores[child2[0]]
+                if separate < total_scores[ind]:
+                    total_scores[ind] = separate
+                    is_cluster[ind] = False
+                continue
+            comb_scores = ctx.comb_scores[inds]
+            separate = total_scores[child1] + total_scores[child2]
+            ### TEST < vs <= on the below comparison.
+            keep_separate = separate < comb_scores
+            total_scores[inds] = np.where(keep_separate, separate, comb_scores)
+            is_cluster[inds] = ~keep_separate
+    def _calc_node_levels(self):
+        """Returns an array of the child indices of each node in self.gene_postorder ((-1, -1) for leaves), and a list of the internal nodes grouped by height, as (node_inds, child1_inds, child2_inds) arrays from the lowest group up."""
+        children, heights = [], []
+        for node in self.gene_postorder:
+            if node in self.gene_leaves_set:
+                children.append((-1, -1))
+                heights.append(0)
+            else:
+                child1, child2 = [self.node_inds[child] for child in self.gene_children[node]]
+                children.append((child1, child2))
+                heights.append(max(heights[child1], heights[child2]) + 1)
+        children = np.array(children, dtype=int).reshape(-1, 2)
+        groups = [[] for _ in range(max(heights))]
+        for ind, height in enumerate(heights):
+            if height:
+                groups[height-1].append(ind)
+        levels = []
+        for inds in groups:
+            inds = np.array(inds, dtype=int)
+            levels.append((inds, children[inds,0], children[inds,1]))
+        return children, levels
+    def _reconcile_block(self, children, leaf_rcas, known=None):
+        """Reconciles a block of gene tree nodes in post-order, given the positions of each node's children in the block ((-1, -1) for leaves), and the species id of each leaf. 'known' is a dict {ind:(rca, comp, (d, i, l, m)), ...} of nodes that have already been reconciled. Returns lists of the recent common ancestor, species composition, and events of each node."""
+        rcas, comps, events = [], [], []
+        known = known or {}
+        for ind, (child1, child2) in enumerate(children):
+            reconciled = known.get(ind)
+            if reconciled is not None:
+                rca, comp, node_events = reconciled
+            elif child1 < 0:
+                rca = leaf_rcas[ind]
+                comp = self.species_bits[rca]
+                node_events = (0, 0, 0, self._calc_loss_events(comp))
+            else:
+                rca = self._species_rca(rcas[child1], rcas[child2])
+                comp = comps[child1] | comps[child2]
+                d, i, l = self._count_events(events[child1], events[child2], rcas[child1], rcas[child2], comps[child1], comps[child2])
+                node_events = (d, i, l, self._calc_loss_events(comp))
+            rcas.append(rca)
+            comps.append(comp)
+            events.append(node_events)
+        return rcas, comps, events
+    def _reconcile_subtrees(self, children, leaf_rcas, known):
+        """Cuts the gene tree into disjoint subtrees and reconciles them in a pool of self.processes workers. Returns a dict {ind:(rca, comp, (d, i, l, m)), ...} for the nodes in those subtrees; the nodes above the cuts are left for _reconcile_block().
+        The nodes of a subtree are a contiguous block of self.gene_postorder ending with its root, so each worker only needs that block of 'children', renumbered from 0, and the species tree index."""
+        sizes = []
+        for child1, child2 in children:
+            sizes.append(1 if child1 < 0 else sizes[child1] + sizes[child2] + 1)
+        max_size = max(len(children) // (4*self.processes), 1)
+        blocks, to_visit = [], [len(children) - 1]
+        while to_visit: # Keep the largest subtrees no bigger than max_size.
+            ind = to_visit.pop()
+            if sizes[ind] > max_size:
+                to_visit.extend(children[ind])
+            elif sizes[ind] >= max_size // 4 and ind not in known: # Smaller ones aren't worth sending.
+                blocks.append((ind - sizes[ind] + 1, ind + 1))
+        tasks = []
+        for start, end in blocks:
+            block_children = [(-1, -1) if child1 < 0 else (child1 - start, child2 - start) for child1, child2 in children[start:end]]
+            tasks.append((start, block_children, leaf_rcas[start:end]))
+        reconciled = {}
+        pool = multiprocessing.Pool(self.processes, _init_reconcile_worker, (self._species_index_state(),))
+        try:
+            for start, rcas, comps, events in pool.imap_unordered(_reconcile_worker_block, tasks):
+                for offset, node_info in enumerate(zip(rcas, comps, events)):
+                    reconciled[start + offset] = node_info
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        if self.verbose: print('-- Reconciled %i subtrees holding %i of %i nodes in %i processes' % (len(blocks), len(reconciled), len(children), self.processes))
+        return reconciled
+    def _species_index_state(self):
+        """Returns the attributes needed by _reconcile_block(), to set up a clusterer in a worker process."""
+        attributes = ('species_bits', 'all_species_mask', 'species_leaf_ids', '_euler_first', '_euler_table', '_species_last_desc', 'loss_memo_size')
+        state = dict((att, getattr(self, att)) for att in attributes)
+        state['_loss_memo'], state['_loss_memo_hits'], state['_loss_memo_misses'] = {}, 0, 0
+        return state
+    def _count_events(self, events1, events2, rca1, rca2, comp1, comp2):
+        (d1, i1, l1, _), (d2, i2, l2, _) = events1, events2
+        d, i, l = d1+d2, i1+i2, l1+l2  # The counts of the children.
+        if not comp1 & comp2:  # Some sort of speciation.
+            if self._is_species_ancestor(rca1, rca2) \
+                or self._is_species_ancestor(rca2, rca1):
                 i += 1  # incongruence event.
             #else: a standard speciation event. Not counted.
         else:  # a duplication event.
             d += 1
-            c1_missing = child2.species_comp - child1.species_comp
-            c2_missing = child1.species_comp - child2.species_comp
-            l += self._calc_loss_events(child1.species_comp, c1_missing)
-            l += self._calc_loss_events(child2.species_comp, c2_missing)
+            c1_missing = comp2 & ~comp1
+            c2_missing = comp1 & ~comp2
+            l += self._calc_loss_events(comp1, c1_missing)
+            l += self._calc_loss_events(comp2, c2_missing)
         return d, i, l
     def _calc_loss_events(self, present, missing=None):
-        """Given a set of ancestors, calculates the mininum number of loss events
+        """Given a bitmask of species, calculates the mininum number of loss events
         required to explain that set. If 'missing'=None, it is assumed to be all
-        species not in 'present'."""
-        if missing == None: missing = self.species
-        if len(missing) <= 1: return len(missing)
-        return max( \
-            len(set( self.recent_common_ancestor((g, m)) for m in missing if m not in present)) \
-            for g in present)
-    def _recalc_clusters(self, node, params, avg_spread):
-        """Overwrites the .clusters and .cluster_roots atts of the nodes, and
-        modifies total_score."""
-        n = self.nodes[node]
+        species not in 'present'. Results are memoized, as compositions often repeat."""
+        if missing == None: missing = self.all_species_mask
+        num_missing = bin(missing).count('1')
+        if num_missing <= 1: return num_missing
+        key = (present, missing)
+        losses = self._loss_memo.get(key)
+        if losses is not None:
+            self._loss_memo_hits += 1
+            return losses
+        self._loss_memo_misses += 1
+        missing = self._mask_species_ids(missing & ~present)
+        losses = max( \
+            len(set( self._species_rca(g, m) for m in missing)) \
+            for g in self._mask_species_ids(present))
+        if len(self._loss_memo) >= self.loss_memo_size:
+            self._loss_memo.clear()
+        self._loss_memo[key] = losses
+        return losses
+    def _mask_species_ids(self, mask):
+        """Returns the species ids of the bits set in 'mask'."""
+        ids = []
+        while mask:
+            low_bit = mask & -mask
+            ids.append(self.species_leaf_ids[low_bit.bit_length() - 1])
+            mask ^= low_bit
+        return ids
+    def _recalc_clusters(self, ctx, params, avg_spread):
+        """Adds the spread of each node relative to 'avg_spread' to its combined event score, and re-scores the nodes. Only array operations are needed, so it is cheap to repeat."""
+        ctx.comb_spreads = self._relative_spread(self._node_spreads(), avg_spread)
+        ctx.comb_spreads[self.leaf_mask] = self.singleton_spread
+        ctx.comb_scores = ctx.comb_event_scores + ctx.comb_spreads*params['spread_coef']
+        self._score_levels(ctx)
+    def _roots_average_spread(self, cluster_roots):
+        """Returns the average spread of the clusters with more than one sequence, or None if there are none."""
+        raw_spreads = self._node_spreads()
+        spreads = [raw_spreads[self.node_inds[node]] for node in cluster_roots if node not in self.gene_leaves_set]
+        if not spreads:
+            return None
+        return self._average_spread(spreads)
+    def _node_spreads(self):
+        """Returns an array of the spread of each node in self.gene_postorder from self.spread_calc(). They don't depend on the weights, so are only calculated once."""
+        with self._lock:
+            if self._raw_spreads is None or self._raw_spreads_calc != self.spread_calc:
+                self._raw_spreads = np.array([self.singleton_spread if node in self.gene_leaves_set else self.spread_calc(node) for node in self.gene_postorder], dtype=float)
+                self._raw_spreads_calc = self.spread_calc
+            return self._raw_spreads
+    def _merge_singletons(self, cluster_roots):
+        """Returns a new list of cluster roots, where each singleton cluster has been merged with its sibling, and a list of the parent nodes that became clusters.
+        Singletons are merged in the order they appear in 'cluster_roots', skipping those already taken in by an earlier merge. Each merge marks the leaf positions under the parent in self.leaf_order, jumping over runs that are already marked, so every position is only marked once."""
+        merged = []
+        next_unmarked = list(range(len(self.leaf_order) + 1)) # Points towards the first unmarked position at or after each one.
+        def find_unmarked(pos):
+            root = pos
+            while next_unmarked[root] != root:
+                root = next_unmarked[root]
+            while next_unmarked[pos] != root: # Shorten the path for later searches.
+                next_unmarked[pos], pos = root, next_unmarked[pos]
+            return root
+        for singleton in cluster_roots:
+            if singleton not in self.gene_leaves_set:
+                continue
+            start = self.leaf_ranges[singleton][0]
+            if find_unmarked(start) != start:
+                continue # Already merged into a larger cluster.
+            parent_node = self.gene_parents.get(singleton)
+            if parent_node is None:
+                print('Error: could not find the sibling of node {}. Singletons were not merged.'.format(singleton))
+                return cluster_roots, []
+            merged.append(parent_node)
+            start, end = self.leaf_ranges[parent_node]
+            pos = find_unmarked(start)
+            while pos < end:
+                next_unmarked[pos] = pos + 1
+                pos = find_unmarked(pos + 1)
+        # #  Keep the clusters not under a merged parent, then the merged parents not under a larger one, in the order they were merged.
+        clstr_rts = [rt for rt in cluster_roots if find_unmarked(self.leaf_ranges[rt][0]) == self.leaf_ranges[rt][0]]
+        outer_parents, outer_end = set(), 0
+        for parent_node in sorted(merged, key=lambda n: (self.leaf_ranges[n][0], -self.leaf_ranges[n][1])):
+            start, end = self.leaf_ranges[parent_node]
+            if start >= outer_end: # Merged clusters are nested or disjoint.
+                outer_parents.add(parent_node)
+                outer_end = end
+        clstr_rts.extend(parent_node for parent_node in merged if parent_node in outer_parents)
+        return clstr_rts, merged
+    def _calc_coord_spreads(self):
+        """Returns a dict {node_name:spread, ...} for every internal node of the gene tree, where the spread is the root mean squared distance of the node's leaf coordinates to their centroid.
+        Each node's point count, centroid, and summed squared deviation are merged from its children's (Chan et al.'s pairwise update), so each node costs O(dimensions) instead of a pass over all of its leaves."""
+        spreads, stats = {}, {}
+        for name in self.gene_postorder:
+            if name in self.gene_leaves_set:
+                stats[name] = (1, self.coords[self.gene_leaf_inds[name]], 0.0)
+                continue
+            child1, child2 = self.gene_children[name]
+            count1, mean1, sqrd1 = stats.pop(child1)
+            count2, mean2, sqrd2 = stats.pop(child2)
+            count = count1 + count2
+            delta = mean2 - mean1
+            mean = mean1 + delta * (count2 / float(count))
+            sqrd = sqrd1 + sqrd2 + np.dot(delta, delta) * count1 * count2 / float(count)
+            stats[name] = (count, mean, sqrd)
+            spreads[name] = np.sqrt(sqrd / float(count))
+        return spreads
+    def _cluster_std_dev(self, node, avg_std_dev=None):
         if node in self.gene_leaves_set:
-            n.clusters = [[node]]
-            n.cluster_roots = [node]
-            spread_score = self.spread_calc([node], avg_spread)
-            n.total_score = n.event_score + spread_score*params['spread_coef']
-            return n
-        child1, child2 = self.gene_children[node]
-        child1 = self._recalc_clusters(child1, params, avg_spread)
-        child2 = self._recalc_clusters(child2, params, avg_spread)
-        comb_spread_score = self.spread_calc(n.leaves, avg_spread)
-        comb_total_score = n._combined_event_score + comb_spread_score*params['spread_coef']
-        n._combined_total_score = comb_total_score
-        n._separate_total_score = child1.total_score + child2.total_score
-        if n._separate_total_score < comb_total_score:
-            n.total_score = n._separate_total_score
-            n.clusters = child1.clusters + child2.clusters
-            n.cluster_roots = child1.cluster_roots + child2.cluster_roots
-            n.spread = None
-        else:
-            n.total_score = comb_total_score
-            n.clusters = [list(n.leaves)]
-            n.cluster_roots = [node]
-            n.spread = comb_spread_score
-        return n
-    def _merge_singletons(self, avg_spread):
-        # Updates self.nodes[self.gene_root].cluster_roots and self.nodes[self.gene_root].clusters
-        clstr_rts = self.nodes[self.gene_root].cluster_roots[::]
-        clstrs = [clstr[::] for clstr in self.nodes[self.gene_root].clusters]
-        am_done = False
-        while not am_done:
-            for ind in range(len(clstrs)):
-                if len(clstrs[ind]) == 1:
-                    singleton = self.nodes[clstr_rts[ind]]
-                    # #  Find parent and sibling
-                    for parent_node, sib_nodes in self.gene_children.items():
-                        if singleton.node in sib_nodes:
-                            break
-                    else:
-                        print('Error: could not find the sibling of node {}. Singletons were not merged.'.format(singleton.node))
-                        return
-                    parent = self.nodes[parent_node]
-                    sib = self.nodes[sib_nodes[1]] if sib_nodes[0] == singleton.node else self.nodes[sib_nodes[0]]
-                    # #  Update parent to force combined MIG instead of separate
-                    parent.total_score = parent._combined_total_score
-                    parent.clusters = [list(parent.leaves)]
-                    parent.cluster_roots = [parent_node]
-                    parent.spread = self.spread_calc(parent.leaves, avg_spread)
-                    # #  Update central data to reflect new cluster
-                    inds_to_del = set()
-                    for clus in sib.clusters:
-                        if clus in clstrs:
-                            inds_to_del.add(clstrs.index(clus))
-                        else: # Happens sometimes when clstrs has been modified but node.clusters hasn't for nodes not direct parents of any cluster. Might only be for clusters that SHOULD span the root.
-                            clus_set = set(clus)
-                            for clstr_ind, clstr in enumerate(clstrs):
-                                if len(clus_set & set(clstr)) > 0:
-                                    inds_to_del.add(clstr_ind)
-                    inds_to_del.add(ind)
-                    inds_to_del = sorted(inds_to_del, reverse=True)
-                    for to_del in inds_to_del:
-                        del clstrs[to_del]
-                        del clstr_rts[to_del]
-                    clstr_rts.append(parent_node)
-                    clstrs.append(list(parent.leaves))
-                    break # Have to kick out of the loop, as list indices are now corrupted
-            else:
-                am_done = True # No break encountered, no singletons left
-        self.nodes[self.gene_root].cluster_roots = clstr_rts
-        self.nodes[self.gene_root].clusters = clstrs
-    def _cluster_std_dev(self, cluster, avg_std_dev=None):
-        if len(cluster) == 1:
             return self.singleton_spread
-        else:
-            inds = [self.gene_leaves.index(c) for c in cluster]
-            pts = self.coords[inds,:]
-            mean = np.average(pts, axis=0)
-            std_dev = np.sqrt(np.sum( np.sum((pts-mean)**2, axis=1) ) / float(pts.shape[0]))
-        if avg_std_dev == None: # Return the spread score itself.
+        return self._relative_spread(self.coord_spreads[node], avg_std_dev)
+    def _tree_std_dev(self, node, avg_std_dev=None):
+        if node in self.gene_leaves_set:
+            return self.singleton_spread
+        return self._relative_spread(self._get_tree_spreads()[node], avg_std_dev)
+    def _get_tree_spreads(self):
+        """Returns self.tree_spreads, calculating them from the gene tree when first needed."""
+        with self._lock:
+            if self.tree_spreads is None:
+                if self.verbose: print('-- Calculating spreads from the gene tree...')
+                self.tree_spreads = self._gene_tree.get_subtree_spreads()
+            return self.tree_spreads
+    def _relative_spread(self, std_dev, avg_std_dev):
+        if avg_std_dev is None: # Return the spread score itself.
             return std_dev
         else: # Return the normalized spread score.
             return std_dev / avg_std_dev - 1.0
 
-class _PhyloST_node(object):
-    def __init__(self, node, species):
-        self.total_score = 0.0 # Score reported by MIPhy.
-        self.event_score = 0.0 # Score before refinement step.
-        self.node = node
-        self.clusters = [[node]]
-        self.cluster_roots = [node]
-        self.d, self.i, self.l, self.m = 0, 0, 0, 0
-        self.spread = None
-        self.rca = species
-        self.species_comp = set((species,))
-        self.leaves = set((node,))
-        self._separate_event_score = 0.0 # Not currently used, potentially useful in the future for parameter exploration.
-        self._combined_event_score = 0.0
-        self._separate_total_score = 0.0
-        self._combined_total_score = 0.0
+    def spread_errors(self, clusters):
+        """Returns a sorted list of the estimated relative errors of the truncated spreads of each cluster with more than one sequence, or None if the coordinates were not truncated."""
+        if self.coord_residuals is None:
+            return None
+        errors = []
+        for clstr in clusters:
+            if len(clstr) == 1:
+                continue
+            node = clstr[0] # Clusters are clades, so the root is the first ancestor holding every sequence.
+            while self.leaf_ranges[node][1] - self.leaf_ranges[node][0] < len(clstr):
+                node = self.gene_parents[node]
+            errors.append(self._spread_error(node))
+        return sorted(errors)
+    def _spread_error(self, node):
+        """Estimates the relative error of the spread of the cluster rooted at 'node' calculated from truncated coordinates, compared to the full embedding. Each point's residual is the squared distance it lost to the discarded dimensions; negative eigenvalues from non-Euclidean tree distances are ignored, so this is an estimate rather than a bound."""
+        start, end = self.leaf_ranges[node]
+        pts = self.coords[start:end]
+        sqrd_spread = np.sum((pts - np.average(pts, axis=0))**2) / float(pts.shape[0])
+        full_sqrd_spread = sqrd_spread + np.average(self.coord_residuals[start:end])
+        if full_sqrd_spread == 0:
+            return 0.0
+        return 1.0 - np.sqrt(sqrd_spread / full_sqrd_spread)
+
+# # # # #  Worker functions for _reconcile_subtrees(). These are module level so they can be sent to the worker processes.
+_reconcile_worker = {}
+def _init_reconcile_worker(species_index_state):
+    clusterer = Clusterer.__new__(Clusterer)
+    clusterer.__setstate__(species_index_state)
+    _reconcile_worker['clusterer'] = clusterer
+def _reconcile_worker_block(task):
+    start, children, leaf_rcas = task
+    rcas, comps, events = _reconcile_worker['clusterer']._reconcile_block(children, leaf_rcas)
+    return start, rcas, comps, events
+
+class CladeMemo(object):
+    """The reconciliation of gene tree clades, keyed by phylo.Tree.get_clade_keys(), to be shared by the clusterers of related trees such as bootstrap replicates. A clade's events don't depend on the rest of its tree, only on the species tree and species mapping; the memo is cleared if a clusterer with a different species tree or mapping uses it."""
+    def __init__(self, max_size=2**20):
+        self.max_size = max_size # Maximum number of clades kept; the memo is cleared when full.
+        self.hits, self.misses = 0, 0
+        self._reconciled, self._species_key = {}, None
+    def check_species(self, species_key):
+        if species_key != self._species_key:
+            self._reconciled.clear()
+            self._species_key = species_key
+    def get(self, clade_key):
+        reconciled = self._reconciled.get(clade_key)
+        if reconciled is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return reconciled
+    def add(self, clade_key, reconciled):
+        """Stores 'reconciled', a tuple (rca, species_comp, (d, i, l, m)), for the clade."""
+        if len(self._reconciled) >= self.max_size:
+            self._reconciled.clear()
+        self._reconciled[clade_key] = reconciled
+
+class _ClusterContext(object):
+    """The working state of one call to Clusterer.cluster(). Arrays are indexed by position in Clusterer.gene_postorder."""
+    def __init__(self):
+        self.comb_event_scores = None # Score of each node as one cluster, from its events alone.
+        self.comb_scores = None # As above, plus the spread of the node once refined.
+        self.comb_spreads = None # Spread of each node relative to the average, once refined.
+        self.total_scores = None # Best score of each node as one cluster or split between its children's clusters.
+        self.is_cluster = None # If each node is scored as one cluster.
+
+class _PhaseRegion(object):
+    def __init__(self):
+        self.strict_inds = None # Rows of Clusterer._phase_rows whose dot product with the weights (i, d, l, spread) is > 0 everywhere in the region.
+        self.loose_inds = None # As above, but >= 0.
+        self.avg_spread = None
+        self.scale = None # Bounds the coefficients of every score in the tree, setting the tolerance of Clusterer._phase_near_boundary().
+        self.cluster_roots = [] # In the order they appear in the gene tree.
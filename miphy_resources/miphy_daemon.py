@@ -4,7 +4,7 @@ from random import randint
 from flask import Flask, request, render_template, json
 from miphy_resources.miphy_instance import MiphyInstance
 from miphy_resources.miphy_common import MiphyValidationError, MiphyRuntimeError
-from miphy_resources.phylo import PhyloValueError
+from miphy_resources.phylo import PhyloValueError, is_binary_tree_data
 
 ## IF STILL not working on MacOSX (actually, do this anyways), add a command line option to specify a download location. if flag is given but empty, means cwd. if flag not given, tkinter is loaded and user can specify. If location is specified, tkinter is never imported; when saving check if file exists, increment filename to avoid overwriting. If no flag is given, and tkinter fails to import (if user doesn't have it), should default to specifying location as cwd.
 
@@ -49,7 +49,7 @@ class Daemon(object):
     558 - Unknown error validating the user's tree.
     559 - A request was received with an unrecognized session ID.
     """
-    def __init__(self, server_port, web_server=False, instance_timeout_inf=False, verbose=False, downloads_dir=''):
+    def __init__(self, server_port, web_server=False, instance_timeout_inf=False, verbose=False, downloads_dir='', phase_map=False):
         max_upload_size = 10*1024*1024 # 10 MB
         error_log_lines = 10000
         self.server_port = server_port
@@ -57,6 +57,7 @@ class Daemon(object):
         self.verbose = verbose
         self.downloads_dir = downloads_dir
         self.sessions = {} # Holds the miphy instances, with session IDs as keys.
+        self.phase_map = phase_map # If True, sessions answer re-clustering requests from a phase map of the weights (see Clusterer.build_phase_map()).
         if not web_server: # Running locally.
             self.sessionID_length = 5 # Length of the unique session ID used.
             self.check_interval = 3 # Repeatedly wait this many seconds between running server tasks.
@@ -280,13 +281,13 @@ class Daemon(object):
             return render_template('/monitor.html')
         # # #  END OF TESTING.
 
-    def new_instance(self, gene_tree_data, info_data, gene_tree_format, merge_singletons=False, use_coords=True, coords_file=''):
+    def new_instance(self, gene_tree_data, info_data, gene_tree_format, merge_singletons=False, use_coords=True, coords_file='', processes=1, variance_target=None):
         if type(info_data) == bytes:
             info_data = info_data.decode()
-        if type(gene_tree_data) == bytes:
+        if type(gene_tree_data) == bytes and not is_binary_tree_data(gene_tree_data):
             gene_tree_data = gene_tree_data.decode()
         idnum = self.generateSessionID()
-        self.sessions[idnum] = MiphyInstance(gene_tree_data, info_data, gene_tree_format, self.allowed_wait, merge_singletons, use_coords, coords_file, self.verbose, refine_limit=self.server_refine_limit)
+        self.sessions[idnum] = MiphyInstance(gene_tree_data, info_data, gene_tree_format, self.allowed_wait, merge_singletons, use_coords, coords_file, self.verbose, refine_limit=self.server_refine_limit, phase_map=self.phase_map, processes=processes, variance_target=variance_target)
         return idnum
     def process_instance(self, idnum, params):
         self.sessions[idnum].processed(params)
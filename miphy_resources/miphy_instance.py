@@ -1,84 +1,12 @@
-import time
+import time, threading
 import xml.etree.ElementTree as ET
 from miphy_resources.clusterer import Clusterer
 from miphy_resources.miphy_common import MiphyValidationError, MiphyRuntimeError
 from miphy_resources import phylo
 
 
-class MiphyInstance(object):
-    def __init__(self, gene_tree_data, info_data, gene_tree_format, allowed_wait, merge_singletons, use_coords, coords_file, verbose, refine_limit=None):
-        self.clusters, self.scores, self.cluster_list, self.init_weights = {}, {}, {}, []
-        self.merge_singletons = merge_singletons
-        self.use_coords = use_coords
-        self.verbose = verbose
-        self.species_tree_data = ''
-        self.species_mapping = {}
-        self.species_colours = {}
-        self.parse_species_tree_mapping_colours(info_data) # fills out above 3 attributes
-        if self.verbose: print('Finished parsing the info file.')
-        self.species = sorted(list(set(self.species_mapping.values())))
-        if gene_tree_format == 'auto':
-            gene_tree = phylo.load_tree_string(gene_tree_data)
-        elif gene_tree_format == 'newick':
-            gene_tree = phylo.load_newick_string(gene_tree_data)
-        elif gene_tree_format == 'nexus':
-            gene_tree = phylo.load_nexus_string(gene_tree_data)
-        elif gene_tree_format == 'phyloxml':
-            gene_tree = phylo.load_phyloxml_string(gene_tree_data)
-        elif gene_tree_format == 'nexml':
-            gene_tree = phylo.load_nexml_string(gene_tree_data)
-        self.num_sequences = len(gene_tree.leaves)
-        self.tree_data = gene_tree.phyloxml_string(support_values=False, comments=False, internal_names=False)
-        self.clusterer = Clusterer(gene_tree, self.species_tree_data, self.species_mapping, use_coords, coords_file, self.verbose)
-        self.sequence_names = self.clusterer.gene_leaves
-        # # Code to clean dead instances:
-        self.been_processed, self.html_loaded = False, False
-        self._allowed_wait = allowed_wait # Only used by collect_garbage() in miphy_daemon.py
-        self.last_maintained = time.time()
-
-    # # #  Timeout methods:
-    def processed(self, params):
-        # params should be a tuple of floats in this order: (ils, dup, loss, spread).
-        if self.been_processed or self.html_loaded:
-            raise MiphyRuntimeError('miphy instance cannot be processed twice, and must be processed before being loaded by the results page.')
-        self.init_weights = list(params[:4])
-        self.cluster(params)
-        self.been_processed = True
-        self.last_maintained = time.time()
-    def page_loaded(self):
-        if not self.been_processed:
-            raise MiphyRuntimeError('miphy instance cannot be loaded by the results page before being processed.')
-        self.html_loaded = True
-        self.last_maintained = time.time()
-    def maintain(self):
-        if not self.been_processed or not self.html_loaded:
-            raise MiphyRuntimeError('miphy instance should not be maintained before being processed and loaded by the results page.')
-        self.last_maintained = time.time()
-    def cluster(self, params):
-        # params should be a tuple of 4 floats and 1 bool in this order: (ils, dup, loss, spread, merge).
-        if params not in self.clusters:
-            t0 = time.time()
-            self.clusters[params], self.scores[params] = self.clusterer.cluster(*params)
-            self.cluster_list[params] = []
-            for clstr in self.clusters[params]: # Already sorted by descending instability
-                clstr_score, clstr_events = self.scores[params][clstr[0]]
-                self.cluster_list[params].append([clstr_score, clstr_events, len(clstr), clstr])
-            if self.verbose: print('Clustering took %.2f seconds' % (time.time()-t0))
-        elif self.verbose:
-            print('Clustering pattern retrieved from cache')
-    def still_alive(self):
-        age = time.time() - self.last_maintained
-        if not self.been_processed:
-            if age >= self._allowed_wait['after_instance']:
-                return False
-        elif not self.html_loaded:
-            if age >= self._allowed_wait['page_load']:
-                return False
-        else:
-            if age >= self._allowed_wait['between_checks']:
-                return False
-        return True
-
+class SpeciesInfo(object):
+    """Parses the species tree, species assignments, and species colours of an information file. Shared by MiphyInstance and TreeSetInstance."""
     # # #  Data parsing:
     def parse_species_tree_mapping_colours(self, info_data):
         info = self.parse_info_data(info_data)
@@ -150,3 +78,99 @@ class MiphyInstance(object):
                 buff.append(line)
         info[group] = buff
         return info
+
+
+class MiphyInstance(SpeciesInfo):
+    def __init__(self, gene_tree_data, info_data, gene_tree_format, allowed_wait, merge_singletons, use_coords, coords_file, verbose, refine_limit=None, phase_map=False, processes=1, variance_target=None):
+        self.clusters, self.scores, self.cluster_list, self.init_weights = {}, {}, {}, []
+        self.merge_singletons = merge_singletons
+        self.phase_map = phase_map # If True, clusterings are looked up from the clusterer's phase map, built around the initial weights.
+        self.use_coords = use_coords
+        self.verbose = verbose
+        self.species_tree_data = ''
+        self.species_mapping = {}
+        self.species_colours = {}
+        self.parse_species_tree_mapping_colours(info_data) # fills out above 3 attributes
+        if self.verbose: print('Finished parsing the info file.')
+        self.species = sorted(list(set(self.species_mapping.values())))
+        if isinstance(gene_tree_data, phylo.BinaryTree): # Already opened from a binary tree file.
+            gene_tree = gene_tree_data
+        elif gene_tree_format == 'binary' or (gene_tree_format == 'auto' and phylo.is_binary_tree_data(gene_tree_data)):
+            gene_tree = phylo.open_binary_string(gene_tree_data) # The Tree is only built if the clusterer or results page needs it.
+        elif gene_tree_format == 'auto':
+            gene_tree = phylo.load_tree_string(gene_tree_data)
+        elif gene_tree_format == 'newick':
+            gene_tree = phylo.load_newick_string(gene_tree_data)
+        elif gene_tree_format == 'nexus':
+            gene_tree = phylo.load_nexus_string(gene_tree_data)
+        elif gene_tree_format == 'phyloxml':
+            gene_tree = phylo.load_phyloxml_string(gene_tree_data)
+        elif gene_tree_format == 'nexml':
+            gene_tree = phylo.load_nexml_string(gene_tree_data)
+        self.num_sequences = len(gene_tree)
+        self.gene_tree = gene_tree
+        self._tree_data = None # Built by the tree_data property, only if the results page asks for it.
+        self.clusterer = Clusterer(gene_tree, self.species_tree_data, self.species_mapping, use_coords, coords_file, self.verbose, variance_target, processes=processes)
+        self.sequence_names = self.clusterer.gene_leaves
+        # # Code to clean dead instances:
+        self.been_processed, self.html_loaded = False, False
+        self._allowed_wait = allowed_wait # Only used by collect_garbage() in miphy_daemon.py
+        self.last_maintained = time.time()
+
+    @property
+    def tree_data(self):
+        """The gene tree in PhyloXML format, as drawn by the results page. It is built when first requested, so runs saved straight to a results file never pay for it."""
+        if self._tree_data is None:
+            self._tree_data = self.gene_tree.phyloxml_string(support_values=False, comments=False, internal_names=False)
+        return self._tree_data
+
+    # # #  Timeout methods:
+    def processed(self, params):
+        # params should be a tuple of floats in this order: (ils, dup, loss, spread).
+        if self.been_processed or self.html_loaded:
+            raise MiphyRuntimeError('miphy instance cannot be processed twice, and must be processed before being loaded by the results page.')
+        self.init_weights = list(params[:4])
+        self.cluster(params)
+        if self.phase_map: # Built in the background so the page doesn't wait on it. Until then, phase_cluster() calculates any region it needs.
+            t = threading.Thread(target=self.clusterer.build_phase_map, args=(self.init_weights,))
+            t.daemon = True; t.start()
+        self.been_processed = True
+        self.last_maintained = time.time()
+    def page_loaded(self):
+        if not self.been_processed:
+            raise MiphyRuntimeError('miphy instance cannot be loaded by the results page before being processed.')
+        self.html_loaded = True
+        self.last_maintained = time.time()
+    def maintain(self):
+        if not self.been_processed or not self.html_loaded:
+            raise MiphyRuntimeError('miphy instance should not be maintained before being processed and loaded by the results page.')
+        self.last_maintained = time.time()
+    def cluster(self, params):
+        # params should be a tuple of 4 floats and 1 bool in this order: (ils, dup, loss, spread, merge).
+        if params not in self.clusters:
+            t0 = time.time()
+            if self.phase_map:
+                clusters, scores = self.clusterer.phase_cluster(*params)
+            else:
+                clusters, scores = self.clusterer.cluster(*params)
+            cluster_list = []
+            for clstr in clusters: # Already sorted by descending instability
+                clstr_score, clstr_events = scores[clstr[0]]
+                cluster_list.append([clstr_score, clstr_events, len(clstr), clstr])
+            # Stored last, as concurrent requests take the params being in self.clusters to mean all three are ready.
+            self.cluster_list[params], self.scores[params], self.clusters[params] = cluster_list, scores, clusters
+            if self.verbose: print('Clustering took %.2f seconds' % (time.time()-t0))
+        elif self.verbose:
+            print('Clustering pattern retrieved from cache')
+    def still_alive(self):
+        age = time.time() - self.last_maintained
+        if not self.been_processed:
+            if age >= self._allowed_wait['after_instance']:
+                return False
+        elif not self.html_loaded:
+            if age >= self._allowed_wait['page_load']:
+                return False
+        else:
+            if age >= self._allowed_wait['between_checks']:
+                return False
+        return True
@@ -30,6 +30,12 @@ load_phyloxml_string(tree_string, **tree_args)
 load_nexml(tree_filename, **kwargs)
 load_nexml_string(tree_string, **kwargs)
   - These functions return a Tree instance. Support values in the file are expected to be a child of a node element, of the form: <meta content="SUPPORT_VALUE" datatype="string" id="SOME_ID" property="nex:confidence_TYPE" xsi:type="nex:LiteralMeta" />. The property must begin with "nex:confidence_", and will set the node's support to SUPPORT_VALUE and the support_type to TYPE. If the property contains anything else, the content attribute will be saved as a comment instead.
+load_binary(tree_filename, **tree_args)
+load_binary_string(tree_bytes, **tree_args)
+  - These functions return a Tree instance from the binary data written by Tree.save_binary() or Tree.binary_string(). No text has to be parsed, so this is much faster than the other formats for large trees that are loaded repeatedly. load_tree() and load_tree_string() recognize this format.
+open_binary(tree_filename, **tree_args)
+open_binary_string(tree_bytes, **tree_args)
+  - These functions return a BinaryTree instance from the same binary data, which is memory-mapped from the file or read in place from the bytes. It answers get_named_leaves(), get_named_children(), and get_postorder_names() straight from the arrays, and only builds the Tree the first time any other Tree attribute is used, or from its 'tree' attribute.
 
 Loading functions for multiple trees
 ------------------------------------
@@ -40,6 +46,15 @@ load_multiple_phyloxml_string(tree_string, **tree_args)
 load_multiple_nexml(tree_filename, **tree_args)
 load_multiple_nexml_string(tree_string, **tree_args)
   - These functions return a list of Tree instances. Otherwise, the same considerations described for the standard loading functions apply.
+iter_nexus_trees(tree_file, internal_as_names=False, chunk_size=2**20, **tree_args)
+iter_newick_trees(tree_file, internal_as_names=False, chunk_size=2**20, **tree_args)
+  - These generators read 'tree_file', either a file name or an open file object, 'chunk_size' characters at a time, and yield each Tree instance as soon as it has been read. Only one tree is held in memory at a time, so they should be used for files holding many trees, such as bootstrap replicates or posterior samples. Any Translate command in a NEXUS file is parsed once and applied to every tree. A Newick file may hold any number of trees, each ending with a ';', and a tree may span several lines.
+iter_nexus_tree_commands(tree_file, chunk_size=2**20)
+iter_newick_tree_strings(tree_file, chunk_size=2**20)
+  - These generators read files as above, but yield the text of each tree without parsing it; iter_nexus_tree_commands() yields (tree_command, translation), which can be given to Tree.parse_nexus_tree_command(). They allow the trees to be parsed elsewhere, such as in worker processes.
+iter_phyloxml_trees(tree_file, **tree_args)
+iter_nexml_trees(tree_file, **tree_args)
+  - These generators parse 'tree_file', either a file name or an open file object, with ElementTree.iterparse, yielding a Tree instance for each phylogeny or tree element as soon as it closes. Elements are cleared once they have been parsed, so the document itself is never held in memory. The load_phyloxml(), load_nexml() and load_multiple_ functions for these formats read their files in the same way.
 
 Saving methods for Tree objects
 -------------------------------
@@ -55,6 +70,9 @@ Tree.phyloxml_string(**save_args)
 Tree.save_nexml(tree_filename, **save_args)
 Tree.nexml_string(**save_args)
   - These functions save the tree data to a file or return it as a string, respectively. This format requires a tree name; a default name will be generated if the Tree.attribute is not set or a name was not given in the input file. The tree name, node names, and node comments will have any '<>' characters removed.
+Tree.save_binary(tree_filename)
+Tree.binary_string()
+  - These functions save the tree data to a file or return it as bytes, respectively. The data is a versioned .npz file holding the parent index, branch length, and support value of each node as arrays, with the names, support types, and comments stored in a table of strings. Everything in the Tree is kept, and no characters are restricted. These methods do not respect the save_args.
 
 Saving functions for multiple trees
 -----------------------------------
@@ -119,6 +137,14 @@ Tree.get_nodes_starting_with(prefixes)
   - This method takes a sequence of node name prefixes as strings, and returns a list of all TreeNode objects whose name begins with at least one of those prefixes.
 Tree.get_ordered_nodes()
   - This method returns all nodes as an ordered list of TreeNode objects. It starts with the root, then its first child, then that child's first child, and so on in a depth-first pre-order (NLR) traversal.
+Tree.iter_preorder(node=None)
+Tree.iter_postorder(node=None)
+  - These methods are generators, yielding the TreeNode objects of the subtree rooted at 'node' (or the whole tree if 'node' is None) in a depth-first pre-order (NLR) or post-order (LRN) traversal, respectively. They use an explicit stack instead of recursion, so they can be used on trees of any depth.
+Tree.get_postorder_nodes()
+  - This method returns all nodes as a list of TreeNode objects in a depth-first post-order (LRN) traversal, so every node comes after all of its descendants. The list is cached until the tree is modified, and so should not be altered.
+Tree.get_postorder_arrays()
+Tree.get_postorder_index(node)
+  - The first method returns 'parents', 'branches', 'depths', and 'firsts' as Numpy arrays, where index i describes the TreeNode at Tree.get_postorder_nodes()[i]. 'parents[i]' is the index of that node's parent (-1 for the root), 'branches[i]' is its branch length, 'depths[i]' is its distance from the root, and 'firsts[i]' is the lowest index in its subtree; as every subtree is a contiguous range of indices ending with its root, node j is a descendant of node i if firsts[i] <= j <= i. The second method returns the index of the given TreeNode object. The arrays are cached until the tree is modified, and so should not be altered. They let calculations on large trees avoid walking the TreeNode objects, and are used by the methods to find leaves, common ancestors, distances, and the midpoint.
 Tree.get_node_leaves(node)
   - This method returns a set of TreeNode objects that are the terminal children of the given TreeNode object.
 Tree.get_recent_common_ancestor(nodes)
@@ -142,6 +168,12 @@ Tree.get_distance_matrix()
   - This method returns 'names', 'distance_matrix'; where 'names' contains all tree leaf names as a list of strings (the same as returned by Tree.get_named_leaves()), and 'distance_matrix' is a symmetrical 2D Numpy array. The phylogenetic distance between tree leaves at indices i and j from 'names' is found by 'dist_mat[i,j]'.
 Tree.get_leaf_coordinate_points(max_dimensions=None)
   - This method returns 'names', 'coordinate_points'; where 'names' contains all tree leaf names as a list of strings (the same as returned by Tree.get_named_leaves()), and 'coordinate_points' is a 2D numpy array. 'coordinate_points[i]' is a numpy array representing a point in Euclidean space for the tree leaf 'names[i]', such that all points respect the pairwise distances in the tree. The coordinates will use the minimum number of dimensions required to satisfy those distances, though 'max_dimensions' can be used to specify a maxinum number of dimensions. Though the least important dimensions will be discarded first, the agreement between pairwise coordinate distances and tree distances will degrade with every lost dimension.
+Tree.get_subtree_spreads()
+  - This method returns a dictionary {'node_name1':spread1, 'node_name2':spread2, ...}, where the spread of a node is the root mean squared distance of the leaves below it to their centroid. It is calculated directly from the branch lengths using the pairwise tree distances, without any coordinate points or distance matrix, in a single traversal of the tree.
+Tree.get_clade_keys()
+  - This method returns a dictionary {node1:(leaf_key1, topology_key1), ...} of canonical keys for every clade in the tree. The leaf key of a node depends only on the set of leaf names below it, and the topology key also depends on the shape of that subtree. Neither depends on the order of any node's children, so a clade found in several trees, such as bootstrap replicates, receives the same keys in each. The keys are 64-bit integers, and are the same in every Python process.
+Tree.get_truncated_leaf_coordinate_points(variance_target=0.99, max_dimensions=None)
+  - This method returns 'names', 'coordinate_points', 'residuals'. It is an approximate version of Tree.get_leaf_coordinate_points() for large trees, that avoids the full eigenvalue decomposition. Only the most important dimensions are calculated, using a randomized eigensolver on the centred Gram matrix, and the number of dimensions is chosen so that the points explain at least 'variance_target' of the total variance of the leaves; 'max_dimensions' can be used to set an upper limit. The points are centred on the origin. 'residuals[i]' is the squared distance that the point for 'names[i]' lost by discarding the remaining dimensions, which can be used to estimate the error of calculations on the truncated points.
 
 General notes
 -------------
@@ -154,12 +186,14 @@ Some functions will print warnings or other information during execution that ar
 # All parsing functions must call self.reset_nodes(), then use self.new_tree_node() to create nodes, and finally set one as self.root.
 # All nodes must have their .parent and .children attributes set. All nodes should have their .name, .branch, .support, .support_type, and .comment attributes filled if possible, though all are optional.
 # Use remove_tree_node() to remove nodes from the tree.
+# TreeNode defines __slots__ to keep large trees small, so no other attributes can be set on a node; keep any extra per-node data in a dict or an array indexed by get_postorder_index().
 # self.process_tree_nodes() must be called after adding or removing a batch of nodes.
 
 
-import re, operator, itertools
-import os.path
+import re, operator, struct, hashlib
+import os.path, io, zipfile, mmap
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape as xml_escape
 from collections import OrderedDict
 import numpy as np
 
@@ -169,13 +203,20 @@ def process_path(file_path):
     return os.path.abspath(os.path.expanduser(os.path.normpath(file_path)))
 
 def load_tree(tree_filename, internal_as_names=False, **kwargs):
-    with open(process_path(tree_filename)) as f:
-        tree_string = f.read()
+    if is_binary_tree_file(tree_filename):
+        return load_binary(tree_filename, **kwargs)
+    try:
+        with open(process_path(tree_filename)) as f:
+            tree_string = f.read()
+    except UnicodeDecodeError: # Some other binary file, such as a zip archive that isn't a tree.
+        return None
     return load_tree_string(tree_string, internal_as_names, **kwargs)
 def load_tree_string(tree_string, internal_as_names=False, **kwargs):
+    if is_binary_tree_data(tree_string):
+        return load_binary_string(tree_string, **kwargs)
     tree_data_str = tree_string.strip().lower()
     tree_init = tree_data_str[:100]
-    if tree_data_str[:5].upper() == '#NEXUS':
+    if tree_data_str[:6].upper() == '#NEXUS':
         return load_nexus_string(tree_string, internal_as_names, **kwargs)
     elif '<phyloxml ' in tree_init or ':phyloxml ' in tree_init:
         return load_phyloxml_string(tree_string, **kwargs)
@@ -210,6 +251,71 @@ def load_multiple_nexus(tree_filename, internal_as_names=False, **kwargs):
 def load_multiple_nexus_string(tree_string, internal_as_names=False, **kwargs):
     tree = Tree(**kwargs)
     return tree.parse_multiple_nexus(tree_string, internal_as_names)
+def iter_nexus_trees(tree_file, internal_as_names=False, chunk_size=2**20, **kwargs):
+    tree = Tree(**kwargs)
+    for new_tree in tree.iter_multiple_nexus(read_file_chunks(tree_file, chunk_size), internal_as_names):
+        yield new_tree
+def iter_newick_trees(tree_file, internal_as_names=False, chunk_size=2**20, **kwargs):
+    for newick_str in iter_newick_tree_strings(tree_file, chunk_size):
+        yield load_newick_string(newick_str, internal_as_names, **kwargs)
+def iter_nexus_tree_commands(tree_file, chunk_size=2**20):
+    tree = Tree()
+    for tree_command, translation in tree.iter_nexus_tree_commands(read_file_chunks(tree_file, chunk_size)):
+        yield tree_command, translation
+def iter_newick_tree_strings(tree_file, chunk_size=2**20):
+    tree = Tree()
+    for newick_str in tree.iter_statements(read_file_chunks(tree_file, chunk_size)):
+        if any(data[0] != '[' and data.strip() for data in tree.separate_square_comments(newick_str)): # Skips blank lines and trailing comments.
+            yield newick_str + ';'
+def load_binary(tree_filename, **kwargs):
+    return open_binary(tree_filename, **kwargs).tree
+def load_binary_string(tree_bytes, **kwargs):
+    return open_binary_string(tree_bytes, **kwargs).tree
+def open_binary(tree_filename, **kwargs):
+    with open(process_path(tree_filename), 'rb') as f:
+        try:
+            buff = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # An empty file can't be mapped.
+            raise PhyloParseError("Error: malformed binary tree file.")
+    return BinaryTree(buff, **kwargs)
+def open_binary_string(tree_bytes, **kwargs):
+    return BinaryTree(tree_bytes, **kwargs)
+def is_binary_tree_file(tree_filename):
+    tree_filename = process_path(tree_filename)
+    with open(tree_filename, 'rb') as f:
+        if f.read(len(Tree._binary_magic)) != Tree._binary_magic:
+            return False
+    return has_binary_tree_arrays(tree_filename)
+def is_binary_tree_data(tree_data):
+    return isinstance(tree_data, bytes) and tree_data[:len(Tree._binary_magic)] == Tree._binary_magic and has_binary_tree_arrays(io.BytesIO(tree_data))
+def has_binary_tree_arrays(source):
+    """Checks that the zip archive 'source' holds the arrays written by Tree.binary_string(), so that other zip files aren't taken for binary trees."""
+    try:
+        with zipfile.ZipFile(source) as archive:
+            array_names = set(archive.namelist())
+    except zipfile.BadZipfile:
+        return False
+    return all(key + '.npy' in array_names for key in Tree._binary_arrays)
+
+def string_source(tree_string):
+    """Wraps 'tree_string' in a file object, for the parsers that read from a file."""
+    if isinstance(tree_string, bytes):
+        return io.BytesIO(tree_string)
+    return io.StringIO(tree_string)
+def read_file_chunks(tree_file, chunk_size=2**20):
+    """Yields the contents of 'tree_file', either a file name or an open file object, 'chunk_size' characters at a time."""
+    if hasattr(tree_file, 'read'):
+        f, close_file = tree_file, False
+    else:
+        f, close_file = open(process_path(tree_file)), True
+    try:
+        chunk = f.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = f.read(chunk_size)
+    finally:
+        if close_file:
+            f.close()
 def save_multiple_nexus(trees, tree_filename, translate_command=False, support_as_comment=False, support_values=True, comments=True, internal_names=True, max_name_length=None):
     tree_string = multiple_nexus_string(trees, translate_command, support_as_comment, support_values, comments, internal_names, max_name_length)
     with open(process_path(tree_filename), 'w') as f:
@@ -260,20 +366,22 @@ def multiple_nexus_string(trees, translate_command=False, support_as_comment=Fal
     return '\n'.join(nexus_buff)
 
 def load_phyloxml(tree_filename, **kwargs):
-    with open(process_path(tree_filename)) as f:
-        tree_string = f.read()
-    return load_phyloxml_string(tree_string, **kwargs)
+    tree = Tree(**kwargs)
+    tree.parse_phyloxml_source(tree_filename)
+    return tree
 def load_phyloxml_string(tree_string, **kwargs):
     tree = Tree(**kwargs)
     tree.parse_phyloxml(tree_string)
     return tree
 def load_multiple_phyloxml(tree_filename, **kwargs):
-    with open(process_path(tree_filename)) as f:
-        tree_string = f.read()
-    return load_multiple_phyloxml_string(tree_string, **kwargs)
+    return list(iter_phyloxml_trees(tree_filename, **kwargs))
 def load_multiple_phyloxml_string(tree_string, **kwargs):
     tree = Tree(**kwargs)
     return tree.parse_multiple_phyloxml(tree_string)
+def iter_phyloxml_trees(tree_file, **kwargs):
+    tree = Tree(**kwargs)
+    for new_tree in tree.iter_multiple_phyloxml(tree_file):
+        yield new_tree
 def save_multiple_phyloxml(trees, tree_filename, support_values=True, comments=True, internal_names=True, max_name_length=None):
     tree_string = multiple_phyloxml_string(trees, support_values, comments, internal_names, max_name_length)
     with open(process_path(tree_filename), 'w') as f:
@@ -295,23 +403,25 @@ def multiple_phyloxml_string(trees, support_values=True, comments=True, internal
             tree.add_nodes_to_phyloxml(tree.root, phylogeny, replacer_fxn, set(), support_values, comments, internal_names, max_name_length)
         except PhyloUniqueNameError as err:
             raise PhyloUniqueNameError(str(err))
-    return ET.tostring(e_tree, encoding='UTF-8', method='xml').decode()
+    return Tree().xml_string(e_tree)
 
 def load_nexml(tree_filename, **kwargs):
-    with open(process_path(tree_filename)) as f:
-        tree_string = f.read()
-    return load_nexml_string(tree_string, **kwargs)
+    tree = Tree(**kwargs)
+    tree.parse_nexml_source(tree_filename)
+    return tree
 def load_nexml_string(tree_string, **kwargs):
     tree = Tree(**kwargs)
     tree.parse_nexml(tree_string)
     return tree
 def load_multiple_nexml(tree_filename, **kwargs):
-    with open(process_path(tree_filename)) as f:
-        tree_string = f.read()
-    return load_multiple_nexml_string(tree_string, **kwargs)
+    return list(iter_nexml_trees(tree_filename, **kwargs))
 def load_multiple_nexml_string(tree_string, **kwargs):
     tree = Tree(**kwargs)
     return tree.parse_multiple_nexml(tree_string)
+def iter_nexml_trees(tree_file, **kwargs):
+    tree = Tree(**kwargs)
+    for new_tree in tree.iter_multiple_nexml(tree_file):
+        yield new_tree
 def save_multiple_nexml(trees, tree_filename, support_values=True, comments=True, internal_names=True, max_name_length=None):
     tree_string = multiple_nexml_string(trees, support_values, comments, internal_names, max_name_length)
     with open(process_path(tree_filename), 'w') as f:
@@ -343,7 +453,7 @@ def multiple_nexml_string(trees, support_values=True, comments=True, internal_na
             tree_id = '{}_{}'.format(tree_id, tree_ids_ind)
         tree_ids.add(tree_id)
         tree.add_nexml_nodes_edges(trees_e, tree_id, node_ids, replacer_fxn, support_values, comments, internal_names, max_name_length)
-    return ET.tostring(e_tree, encoding='UTF-8', method='xml').decode()
+    return Tree().xml_string(e_tree)
 
 
 class Tree(object):
@@ -352,6 +462,11 @@ class Tree(object):
     _nexus_replacements = {'[':'(', ']':')', ';':'.', '=':'', ' ':'_', '\t':'_', '\n':''} # Applied to tree name only
     _phyloxml_replacements = {'<':'', '>':''} # Applied to tree name, node names, and comments
     _nexml_replacements = {'<':'', '>':''} # Applied to tree name, node names, and comments
+    _newick_token_pattern = re.compile(r'[(),\[\]]') # The characters that structure a Newick string.
+    _statement_token_pattern = re.compile(r'[;\[\]]') # The characters that separate the statements of a NEXUS or multiple Newick file.
+    _binary_magic = b'PK\x03\x04' # Binary trees are .npz files, which are zip archives.
+    _binary_version = 1 # Increment if the arrays saved by binary_string() change.
+    _binary_arrays = ('version', 'parents', 'branches', 'supports', 'string_data', 'string_offsets', 'name_inds', 'support_type_inds', 'comment_inds', 'tree_name_ind', 'is_cladogram')
 
     def __init__(self, support_label='bootstrap', remove_name_quotes=True):
         """Data structure used to parse and manipulate phylogenetic trees.
@@ -363,8 +478,11 @@ class Tree(object):
         self.leaves = set()
         self.internal = set()
         self.nodes = set()
-        self.paths = {}
-        self.path_dists = {}
+        self._paths = None # Calculated on first access of self.paths or self.path_dists
+        self._path_dists = None
+        self._postorder_nodes = None # Cached by get_postorder_nodes()
+        self._postorder_arrays = None # Cached by calculate_postorder_arrays()
+        self._postorder_inds = None
         # # #  Public descriptive attributes
         self.is_cladogram = None # None means it hasn't been set; will be True or False.
 
@@ -375,7 +493,7 @@ class Tree(object):
         self._cladogram_branch = 1.0 # length of each branch in a cladogram
         self._remove_name_quotes = remove_name_quotes
         self._support_label = support_label
-        self._node_ids = set()
+        self._node_ids = set() # The TreeNode.index values in use.
         self._node_id_template = '_node_{}' # Must not invalidate any restricted character set
         self._node_id_index = 0
         self._max_branch_precision = 10
@@ -479,6 +597,7 @@ class Tree(object):
     def rotate_node(self, node, propagate_rotation=True):
         """Swaps the children of the given node, as well as all descendants to give a proper rotation. If 'propagate_rotation' is False only the given node's children will be swapped, resulting in the subtrees remaining untouched."""
         node.children.reverse()
+        self._postorder_nodes = self._postorder_arrays = self._postorder_inds = None
         if propagate_rotation == True:
             self.traverse_rotate_children(node)
     def rotate_subtree(self, names, propagate_rotation=True):
@@ -492,6 +611,7 @@ class Tree(object):
         """Reorders each node's children for asthetic purposes.
         If increasing=True, children are ordered so that short leaves come before leaves with long branches, which come before children that are internal nodes. Setting increasing=False reverses this."""
         self.traverse_order_children(self.root, increasing)
+        self._postorder_nodes = self._postorder_arrays = self._postorder_inds = None
     def prune_to(self, names, merge_monotomies=True):
         """Modifies the tree in place, keeping 'names' and relevant predecessors but pruning off all others."""
         self.prune_to_nodes(self.get_nodes(names), merge_monotomies)
@@ -582,6 +702,7 @@ class Tree(object):
             if node != self.root:
                 node.branch = cladogram_branch
         self.root.branch = 0.0
+        self._path_dists = self._postorder_arrays = None
 
     # # #  Public functions for working with my data structures
     def get_named_leaves(self):
@@ -621,33 +742,65 @@ class Tree(object):
         nodes = []
         self.build_nodes_list(self.root, nodes)
         return nodes
+    def iter_preorder(self, node=None):
+        """Yields the nodes of the subtree rooted at 'node' (default self.root) in a depth-first pre-order (NLR) traversal."""
+        to_visit = [self.root if node is None else node]
+        while to_visit:
+            node = to_visit.pop()
+            yield node
+            to_visit.extend(node.children[::-1])
+    def iter_postorder(self, node=None):
+        """Yields the nodes of the subtree rooted at 'node' (default self.root) in a depth-first post-order (LRN) traversal."""
+        to_visit = [(self.root if node is None else node, False)]
+        while to_visit:
+            node, children_done = to_visit.pop()
+            if children_done or not node.children:
+                yield node
+            else:
+                to_visit.append((node, True))
+                to_visit.extend((child, False) for child in node.children[::-1])
+    def get_postorder_nodes(self):
+        """Returns self.nodes as a list in a depth-first post-order (LRN) traversal, so every node comes after its descendants. The list is cached, and should not be modified."""
+        if self._postorder_nodes is None:
+            self._postorder_nodes = list(self.iter_postorder())
+        return self._postorder_nodes
+    def get_postorder_names(self):
+        """Returns the names of the nodes from get_postorder_nodes(), as a list of strings."""
+        return [node.name for node in self.get_postorder_nodes()]
+    def get_postorder_arrays(self):
+        """Returns 'parents', 'branches', 'depths', and 'firsts' as Numpy arrays, where index i refers to the node at get_postorder_nodes()[i]. 'parents[i]' is the index of the node's parent (-1 for the root), 'branches[i]' its branch length, 'depths[i]' its distance from the root, and 'firsts[i]' the lowest index in its subtree. The arrays are cached, and should not be modified."""
+        if self._postorder_arrays is None:
+            self.calculate_postorder_arrays()
+        return self._postorder_arrays
+    def get_postorder_index(self, node):
+        """Returns the index of the TreeNode 'node' in get_postorder_nodes() and the arrays of get_postorder_arrays()."""
+        if self._postorder_inds is None:
+            self.calculate_postorder_arrays()
+        return self._postorder_inds[node]
     def get_node_leaves(self, node):
         """Returns a set of TreeNode objects that are the terminal children of the given node."""
         if node not in self.nodes:
             raise PhyloValueError("Error: cannot get the leaves of an invalid node.")
         if node in self.leaves:
-            return set(node)
-        children = set()
-        for leaf in self.leaves:
-            if node in self.paths[leaf]:
-                children.add(leaf)
-        return children
+            return set([node])
+        parents, branches, depths, firsts = self.get_postorder_arrays()
+        ind = self.get_postorder_index(node)
+        return set(n for n in self.get_postorder_nodes()[firsts[ind]:ind] if n in self.leaves)
     def get_recent_common_ancestor(self, nodes):
         """Given a list of TreeNode objects, returns the most recent commont ancestor TreeNode shared by all."""
         if len(nodes) == 0:
             raise PhyloValueError("Error: could not determing the recent common ancestor, as no nodes were given.")
         elif len(nodes) == 1:
             return nodes[0]
-        ancestor = None
-        for ancestor_nodes in zip(*(self.paths[node] for node in nodes)):
-            nodes_set = set(ancestor_nodes)
-            if len(nodes_set) == 1:
-                ancestor = nodes_set.pop()
-            else:
-                break
-        if ancestor == None:
-            raise PhyloValueError("Error: could not determing the recent common ancestor. This might indicate nodes have no single common ancestor or that the tree structure is malformed.")
-        return ancestor
+        parents, branches, depths, firsts = self.get_postorder_arrays()
+        ancestor = self.get_postorder_index(nodes[0])
+        for node in nodes[1:]:
+            ind = self.get_postorder_index(node)
+            while not firsts[ancestor] <= ind <= ancestor: # A subtree holds a contiguous range of indices, ending with its root.
+                ancestor = parents[ancestor]
+                if ancestor == -1:
+                    raise PhyloValueError("Error: could not determing the recent common ancestor. This might indicate nodes have no single common ancestor or that the tree structure is malformed.")
+        return self.get_postorder_nodes()[ancestor]
     def get_subtree(self, names, keep_root_branch=False):
         """Returns a new Tree object of the subtree containing all nodes specified by 'names'."""
         nodes = self.get_nodes(names)
@@ -680,6 +833,18 @@ class Tree(object):
         return new_tree
 
     # # #  Functions to extract information
+    @property
+    def paths(self):
+        """Dict {TreeNode:[root, ..., TreeNode], ...}. Calculated when first needed, as it takes memory proportional to the number of nodes times the depth of the tree."""
+        if self._paths is None:
+            self.calculate_paths()
+        return self._paths
+    @property
+    def path_dists(self):
+        """Dict {TreeNode:[0.0, branch1, ..., TreeNode.branch], ...}, the branch lengths along each path in self.paths."""
+        if self._path_dists is None:
+            self.calculate_paths()
+        return self._path_dists
     def get_named_children(self):
         """Returns a dict {'name':['child1', 'child2', ...], ...}."""
         node_children = {}
@@ -696,72 +861,166 @@ class Tree(object):
         """Returns the phylogenetic distance between the two TreeNode objects."""
         if node1 == node2:
             return 0.0
-        for i, (n1, n2) in enumerate(zip(self.paths[node1], self.paths[node2])):
-            if n1 != n2:
-                break
-        else:
-            i = min(len(self.paths[node1]), len(self.paths[node2]))
-        return sum(self.path_dists[node1][i:]) + sum(self.path_dists[node2][i:])
-    def get_distance_matrix(self):
-        """Returns a sorted list of strings, and a 2D Numpy array. The phylogenetic distance between tree leaves i and j from 'names' is found by 'dist_mat[i,j]'."""
+        parents, branches, depths, firsts = self.get_postorder_arrays()
+        rca = self.get_postorder_index(self.get_recent_common_ancestor([node1, node2]))
+        dist = 0.0
+        for node in (node1, node2):
+            ind, path_dists = self.get_postorder_index(node), []
+            while ind != rca:
+                path_dists.append(branches[ind])
+                ind = parents[ind]
+            dist += sum(path_dists[::-1]) # Summed from the ancestor down, as subtracting depths would lose precision.
+        return float(dist)
+    def get_distance_matrix(self, block_steps=64):
+        """Returns a sorted list of strings, and a 2D Numpy array. The phylogenetic distance between tree leaves i and j from 'names' is found by 'dist_mat[i,j]'.
+        Each distance is summed in the same order as node_distance(), so the two are identical: the branches from the recent common ancestor down to each leaf are summed from the top, and the two sums are added.
+        The sum from a node down to a leaf can't be extended to the node's parent without changing that order, so the sums starting at every ancestor of each leaf are accumulated together, one level of the tree at a time. They are stored in that leaf's row of the matrix until the row is filled in with its half of each distance, and adding the transpose of the matrix completes them."""
         names = self.get_named_leaves()
         num_names = len(names)
+        name_inds = dict((name, i) for i, name in enumerate(names))
         dist_mat = np.zeros((num_names, num_names), dtype='float')
-        for i, j in itertools.combinations(range(num_names), 2):
-            node1, node2 = self.node_names[names[i]], self.node_names[names[j]]
-            dist = self.node_distance(node1, node2)
-            dist_mat[i,j] = dist
-            dist_mat[j,i] = dist
+        nodes = self.get_postorder_nodes()
+        parents, branches, depths, firsts = self.get_postorder_arrays()
+        par_list = parents.tolist()
+        levels = [0] * len(nodes) # Number of branches between each node and the root.
+        for ind in range(len(nodes)-2, -1, -1):
+            levels[ind] = levels[par_list[ind]] + 1
+        leaf_inds = [ind for ind, node in enumerate(nodes) if node in self.leaves] # In the order of the tree.
+        leaf_rows = np.array([name_inds[nodes[ind].name] for ind in leaf_inds], dtype=int)
+        levels = np.array(levels, dtype=int)
+        leaf_levels = levels[leaf_inds]
+        # The node before a leaf in post-order is the child of its recent common ancestor with the previous leaf, on the side of the previous leaf:
+        rca_levels = levels[np.array(leaf_inds[1:], dtype=int) - 1] - 1
+        # sums[ind] holds the sum from the node 'step' levels above node ind down to it. Nodes are sorted by level, so those deep enough to have that ancestor are a prefix.
+        order = np.argsort(-levels, kind='stable')
+        order_pos = np.empty(len(order), dtype=int)
+        order_pos[order] = np.arange(len(order))
+        order_parents = order_pos[np.maximum(parents[order], 0)]
+        order_branches = branches[order]
+        order_levels = levels[order]
+        sums = order_branches.copy()
+        num_deep = np.searchsorted(-order_levels, np.arange(order_levels[0] if len(order) else 0), side='left') # num_deep[step] nodes are more than 'step' levels deep.
+        leaf_sort = np.argsort(-leaf_levels, kind='stable')
+        sorted_rows, sorted_levels, sorted_order = leaf_rows[leaf_sort], leaf_levels[leaf_sort], order_pos[leaf_inds][leaf_sort]
+        num_deep_leaves = np.searchsorted(-sorted_levels, np.arange(order_levels[0] if len(order) else 0), side='left')
+        # A leaf can only be deeper than there are leaves if some node has a single child, so the sums don't fit in its row.
+        leaf_sums_mat = dist_mat if num_names == 0 or leaf_levels.max() < num_names else np.zeros((num_names, leaf_levels.max()+1))
+        # Stored in row i at column k is the sum from the ancestor at level k down to leaf i. They are written a block of steps at a time, so each row receives a contiguous run of columns instead of one scattered value per step.
+        for block_start in range(0, len(num_deep), block_steps):
+            steps = np.arange(block_start, min(block_start + block_steps, len(num_deep)))
+            num_leaves = num_deep_leaves[block_start]
+            block = np.empty((len(steps), num_leaves))
+            for row, step in enumerate(steps.tolist()):
+                if step > 0:
+                    deep = num_deep[step]
+                    sums[:deep] = sums[order_parents[:deep]] + order_branches[:deep]
+                block[row] = sums[sorted_order[:num_leaves]]
+            # Leaves no more than 'step' levels deep don't need the sum; theirs land in column 0, which is never read. Flat indices are much faster to assign to than pairs of rows and columns.
+            cols = np.maximum(sorted_levels[None,:num_leaves] - steps[:,None], 0)
+            leaf_sums_mat.ravel()[(sorted_rows[None,:num_leaves]*leaf_sums_mat.shape[1] + cols).ravel()] = block.ravel()
+        # Each row is filled with the sums from the leaf to every other leaf's recent common ancestor. The level of the ancestor of leaves i < j is the lowest of rca_levels[i:j].
+        for i, row in enumerate(leaf_rows.tolist()):
+            leaf_sums = leaf_sums_mat[row, :leaf_levels[i]+1].copy()
+            row_sums = np.zeros(num_names)
+            if i > 0:
+                row_sums[:i] = leaf_sums[np.minimum.accumulate(rca_levels[i-1::-1])[::-1] + 1]
+            row_sums[i+1:] = leaf_sums[np.minimum.accumulate(rca_levels[i:]) + 1]
+            dist_mat[row, leaf_rows] = row_sums
+        self.add_transpose(dist_mat)
         return names, dist_mat
     def get_leaf_coordinate_points(self, max_dimensions=None, min_epsilon=1e-5):
         """Returns a sorted list of strings, and a 2D Numpy array. The coordinates for tree leaf i are found by 'coords[i]'.
         If 'max_dimensions' is specified, the least significant dimensions will be discarded.
         The algorithm was found at http://math.stackexchange.com/questions/156161/finding-the-coordinates-of-points-from-distance-matrix/423898#423898"""
-        names, dist_mat = self.get_distance_matrix()
-        num_leaves = len(names)
-        sqrd_dist = np.square(dist_mat)
-        # Generate the positive semi-definite square matrix M:
-        m_mat = np.zeros((num_leaves, num_leaves), dtype='float')
-        for i in range(num_leaves):
-            di1 = sqrd_dist[0,i]
-            for j in range(i, num_leaves):
-                m = di1 + sqrd_dist[0,j] - sqrd_dist[i,j]
-                m_mat[i,j] = m
-                m_mat[j,i] = m
-        m_mat /= 2.0
+        names, m_mat = self.get_distance_matrix()
+        # The distance matrix is squared and converted into M in place, so only one n x n buffer is used:
+        np.square(m_mat, out=m_mat)
+        self.fill_gram_matrix(m_mat)
         # An eigenvalue decomposition of M yields the coordinate points:
         values, vectors = np.linalg.eigh(m_mat)
+        del m_mat
         tokeep = max(len(values) - max_dimensions, 0) if max_dimensions else 0
-        values, vectors = values[tokeep:], vectors[:,range(tokeep, len(values))]
-        coords = np.column_stack([vectors[:,i]*np.sqrt(val) for i, val in enumerate(values) if val >= min_epsilon])
+        keep = [i for i in range(tokeep, len(values)) if values[i] >= min_epsilon]
+        coords = vectors[:,keep]
+        del vectors
+        coords *= np.sqrt(values[keep])
         return names, coords
+    def get_subtree_spreads(self):
+        """Returns a dict {'name':spread, ...}, where the spread of a node is the root mean squared distance of its leaves to their centroid.
+        The mean squared distance to the centroid of c points equals the sum of their squared pairwise distances divided by c^2. Each node carries its leaf count, and the sums of the distances and squared distances to its leaves; these are shifted up each branch and combined with the sibling's, so every node is processed once."""
+        spreads, stats = {}, {} # stats maps a node to (num_leaves, sum_dists, sum_sqrd_dists, sum_sqrd_pairs)
+        for node in self.get_postorder_nodes():
+            count, sum_dists, sum_sqrd, sum_pairs = 0, 0.0, 0.0, 0.0
+            if node in self.leaves:
+                count = 1
+            for child in node.children:
+                c_count, c_dists, c_sqrd, c_pairs = stats.pop(child)
+                branch = child.branch
+                c_sqrd = c_sqrd + 2*branch*c_dists + c_count*branch*branch
+                c_dists = c_dists + c_count*branch
+                sum_pairs += c_pairs + count*c_sqrd + c_count*sum_sqrd + 2*sum_dists*c_dists
+                count += c_count
+                sum_dists += c_dists
+                sum_sqrd += c_sqrd
+            stats[node] = (count, sum_dists, sum_sqrd, sum_pairs)
+            spreads[node.name] = np.sqrt(max(sum_pairs, 0.0)) / count
+        return spreads
+    def get_clade_keys(self):
+        """Returns a dict {node:(leaf_key, topology_key), ...} of canonical keys for each clade. The leaf key depends only on the set of leaf names under the node, while the topology key also depends on the shape of the subtree; neither depends on the order of any node's children, so identical clades in different trees receive identical keys.
+        Leaf names are hashed to 64-bit integers. A leaf key is the sum of the hashes of its leaves, and a topology key is the hash of the sorted topology keys of its children."""
+        keys, mask = {}, 2**64 - 1
+        for node in self.get_postorder_nodes():
+            if not node.children:
+                leaf_key = topology_key = self.hash_clade_data(node.name.encode('utf-8'))
+            else:
+                leaf_key = sum(keys[child][0] for child in node.children) & mask
+                child_keys = sorted(keys[child][1] for child in node.children)
+                topology_key = self.hash_clade_data(struct.pack('<%iQ' % len(child_keys), *child_keys))
+            keys[node] = (leaf_key, topology_key)
+        return keys
+    def get_truncated_leaf_coordinate_points(self, variance_target=0.99, max_dimensions=None, min_epsilon=1e-5):
+        """Returns a sorted list of strings, a 2D Numpy array, and a 1D Numpy array. The coordinates for tree leaf i are found by 'coords[i]', and the squared distance lost by truncating its remaining dimensions by 'residuals[i]'.
+        Only the leading eigenpairs of the centred Gram matrix are calculated, adding dimensions until they explain 'variance_target' of the total variance or reach 'max_dimensions'."""
+        names, g_mat = self.get_distance_matrix()
+        np.square(g_mat, out=g_mat)
+        self.fill_centred_gram_matrix(g_mat)
+        values, vectors = self.randomized_eigh(g_mat, variance_target, max_dimensions)
+        residuals = np.diagonal(g_mat).copy()
+        del g_mat
+        keep = values >= min_epsilon
+        coords = vectors[:,keep]
+        coords *= np.sqrt(values[keep])
+        residuals -= np.sum(np.square(coords), axis=1)
+        np.maximum(residuals, 0.0, out=residuals)
+        return names, coords, residuals
 
     # # #  Newick parsing and saving functions
     def parse_newick(self, newick_str, internal_as_names=False):
+        """Builds the tree in one pass over the tokens '(),[]'. Brackets and commas within a comment, including nested comments, are skipped by tracking the comment depth."""
         self.reset_nodes()
         try:
             newick_str, final_r = self.clean_newick_string(newick_str)
             self.root = self.new_tree_node()
             name, comment, branch, support = self.parse_newick_node_data(newick_str[final_r+1 : -1])
             self.newick_info_to_node(self.root, name, branch, support, comment, internal_as_names)
-            i, r_prev, parent_nodes = newick_str.find('('), False, [self.root]
-            while i < len(newick_str):
-                lj, rj, cj, lsq, rsq = (newick_str.find(c, i+1) for c in '(),[]')
-                # Parses nested comments:
-                sub_lsq = newick_str.find('[', lsq+1)
-                while -1 < sub_lsq < rsq:
-                    sub_lsq = newick_str.find('[', sub_lsq+1)
-                    rsq = newick_str.find(']', rsq+1)
-                # Ensures the found (), are not within a comment:
-                if lsq < lj < rsq:
-                    lj = newick_str.find('(', rsq+1)
-                if lsq < rj < rsq:
-                    rj = newick_str.find(')', rsq+1)
-                if lsq < cj < rsq:
-                    cj = newick_str.find(',', rsq+1)
-                # The closest (), identifies what action to take:
-                j = min(ind for ind in (lj,rj,cj) if ind > 0)
-                if lj == j: # new internal node.
+            i, r_prev, parent_nodes, depth = None, False, [self.root], 0
+            for match in self._newick_token_pattern.finditer(newick_str):
+                token, j = match.group(), match.start()
+                if token == '[':
+                    depth += 1
+                    continue
+                elif token == ']':
+                    depth -= 1
+                    continue
+                elif depth:
+                    continue
+                elif i is None: # Skips any data before the opening bracket of the root.
+                    if token == '(':
+                        i = j
+                        continue
+                    i = -1
+                # The token identifies what action to take:
+                if token == '(': # new internal node.
                     parent_nodes.append( self.new_tree_node(parent_nodes[-1]) )
                 else: # process node
                     name, comment, branch, support = self.parse_newick_node_data(newick_str[i+1:j])
@@ -775,8 +1034,10 @@ class Tree(object):
                     parent_nodes[-1].children.append(node)
                 if j == final_r:
                     break
-                r_prev = True if rj == j else False
+                r_prev = True if token == ')' else False
                 i = j
+            else:
+                raise PhyloParseError('Error: malformed Newick data.')
         except:
             raise PhyloParseError('Error: malformed Newick data.')
         self.process_tree_nodes()
@@ -794,43 +1055,23 @@ class Tree(object):
         if support_values and internal_names: # The only way to save both supports and internal names.
             support_as_comment = True
         replacer_fxn = self.create_string_replacer_function(self._newick_replacements)
-        try:
-            return self.format_newick_string(self.root, replacer_fxn, set(), support_as_comment, support_values, comments, internal_names, max_name_length) + ';'
-        except PhyloUniqueNameError as err:
-            # This is so the entire recursive stack isn't printed on error
-            raise PhyloUniqueNameError(str(err))
+        return self.format_newick_string(self.root, replacer_fxn, set(), support_as_comment, support_values, comments, internal_names, max_name_length) + ';'
 
     # # #  NEXUS parsing and saving functions
     def parse_nexus(self, nexus_str, internal_as_names=False):
-        tree_commands, translate_command = self.parse_nexus_tree_commands(nexus_str)
+        tree_commands = list(self.iter_nexus_tree_commands([nexus_str]))
         if len(tree_commands) > 1:
             raise PhyloParseError("Error: multiple trees detected. Use the function 'load_multiple_nexus()' instead.")
-        self.reset_nodes()
-        tree_name, _, newick_str = tree_commands[0].partition('=')
-        self.name = tree_name.strip()
-        self.parse_newick(newick_str.strip() + ';', internal_as_names)
-        #self.process_tree_nodes() #This is done in parse_newick()
-        if translate_command:
-            translation = self.format_nexus_translation(translate_command)
-            for node in self.nodes:
-                if node.name in translation:
-                    node.rename(translation[node.name])
+        tree_command, translation = tree_commands[0]
+        self.parse_nexus_tree_command(tree_command, translation, internal_as_names)
     def parse_multiple_nexus(self, nexus_str, internal_as_names=False):
-        tree_commands, translate_command = self.parse_nexus_tree_commands(nexus_str)
-        trees = []
-        for tree_command in tree_commands:
-            self.reset_nodes()
-            tree_name, _, newick_str = tree_command.partition('=')
-            self.name = tree_name.strip()
-            self.parse_newick(newick_str.strip() + ';', internal_as_names)
-            #self.process_tree_nodes() #This is done in parse_newick()
-            if translate_command:
-                translation = self.format_nexus_translation(translate_command)
-                for node in self.nodes:
-                    if node.name in translation:
-                        node.rename(translation[node.name])
-            trees.append(self.copy())
-        return trees
+        return list(self.iter_multiple_nexus([nexus_str], internal_as_names))
+    def iter_multiple_nexus(self, nexus_chunks, internal_as_names=False):
+        """Yields a new Tree for each tree command in the NEXUS data, given as an iterable of strings, as soon as the command has been read."""
+        for tree_command, translation in self.iter_nexus_tree_commands(nexus_chunks):
+            tree = Tree(support_label=self._support_label, remove_name_quotes=self._remove_name_quotes)
+            tree.parse_nexus_tree_command(tree_command, translation, internal_as_names)
+            yield tree
     def save_nexus(self, tree_filename, translate_command=False, support_as_comment=False, support_values=True, comments=True, internal_names=True, max_name_length=None):
         tree_string = self.nexus_string(translate_command, support_as_comment, support_values, comments, internal_names, max_name_length)
         with open(process_path(tree_filename), 'w') as f:
@@ -854,32 +1095,56 @@ class Tree(object):
 
     # # #  PhyloXML parsing and saving functions
     def parse_phyloxml(self, phylo_str):
-        phylos, ns = self.parse_phyloxml_phylogenies(phylo_str)
-        if len(phylos) > 1:
+        self.parse_phyloxml_source(string_source(phylo_str.strip()))
+    def parse_phyloxml_source(self, source):
+        phylos = self.iter_multiple_phyloxml(source, reuse_tree=True)
+        next(phylos)
+        for phy in phylos:
             raise PhyloParseError("Error: multiple phylogenies detected. Use the function 'load_multiple_phyloxml()' instead.")
-        else:
-            phy = phylos[0]
-        self.reset_nodes()
-        self.name = phy.findtext('name', None) or phy.findtext(ns + 'name', None)
-        root_e = phy.find('clade')
-        if root_e == None:
-            root_e = phy.find(ns + 'clade')
-        self.root = self.new_tree_node()
-        self.parse_phyloxml_element_info_to_node(self.root, root_e, ns)
-        self.traverse_phyloxml(self.root, root_e, ns)
-        self.process_tree_nodes()
     def parse_multiple_phyloxml(self, phylo_str):
-        phylos, ns = self.parse_phyloxml_phylogenies(phylo_str)
-        trees = []
-        for phy in phylos:
-            self.reset_nodes()
-            root_e = phy.find(ns + 'clade')
-            self.root = self.new_tree_node()
-            self.parse_phyloxml_element_info_to_node(self.root, root_e, ns)
-            self.traverse_phyloxml(self.root, root_e, ns)
-            #self.process_tree_nodes() This is done in copy()
-            trees.append(self.copy())
-        return trees
+        return list(self.iter_multiple_phyloxml(string_source(phylo_str.strip())))
+    def iter_multiple_phyloxml(self, source, reuse_tree=False):
+        """Yields a Tree for each phylogeny in 'source', a file name or file object. Each clade is parsed when its element closes and is then cleared, so the document is never held in memory. If 'reuse_tree' is True, each phylogeny is parsed into this Tree instead of a new one."""
+        ns, tree, num_trees = None, None, 0
+        elements, clade_nodes = [], []
+        for event, element in self.iter_xml_events(source, 'PhyloXML'):
+            if ns is None:
+                if 'phyloxml' not in element.tag:
+                    raise PhyloParseError("Error: malformed file format. The first element of a PhyloXML file must have the tag 'phyloxml'.")
+                ns, _, _ = element.tag.rpartition('phyloxml')
+            tag = element.tag[len(ns):] if element.tag.startswith(ns) else element.tag
+            if event == 'start':
+                elements.append(element)
+                if tag == 'phylogeny' and len(elements) == 2:
+                    tree = self if reuse_tree else Tree(support_label=self._support_label, remove_name_quotes=self._remove_name_quotes)
+                    tree.reset_nodes()
+                elif tag == 'clade' and tree is not None:
+                    if clade_nodes:
+                        node = tree.new_tree_node(clade_nodes[-1])
+                        clade_nodes[-1].children.append(node)
+                    elif tree.root is None:
+                        node = tree.root = tree.new_tree_node()
+                    else:
+                        raise PhyloParseError("Error: malformed PhyloXML file. A phylogeny had more than one root clade.")
+                    clade_nodes.append(node)
+                continue
+            elements.pop()
+            if tag == 'clade' and clade_nodes:
+                tree.parse_phyloxml_element_info_to_node(clade_nodes.pop(), element, ns)
+                element.clear()
+                elements[-1].remove(element)
+            elif tag == 'phylogeny' and tree is not None and len(elements) == 1:
+                if tree.root is None:
+                    raise PhyloParseError("Error: malformed PhyloXML file. A phylogeny had no clades.")
+                tree.name = element.findtext('name', None) or element.findtext(ns + 'name', None)
+                tree.process_tree_nodes()
+                element.clear()
+                elements[-1].remove(element)
+                num_trees += 1
+                yield tree
+                tree = None
+        if num_trees == 0:
+            raise PhyloParseError("Error: malformed file format. No phylogenies were found.")
     def save_phyloxml(self, tree_filename, support_values=True, comments=True, internal_names=True, max_name_length=None):
         tree_string = self.phyloxml_string(support_values, comments, internal_names, max_name_length)
         with open(process_path(tree_filename), 'w') as f:
@@ -900,24 +1165,72 @@ class Tree(object):
             self.add_nodes_to_phyloxml(self.root, phylogeny, replacer_fxn, set(), support_values, comments, internal_names, max_name_length)
         except PhyloUniqueNameError as err:
             raise PhyloUniqueNameError(str(err))
-        return ET.tostring(e_tree, encoding='UTF-8', method='xml').decode()
+        return self.xml_string(e_tree)
 
     # # #  NeXML parsing and saving functions
     def parse_nexml(self, nexml_str):
-        otus, tree_es, ns = self.parse_nexml_otus_trees(nexml_str)
-        if len(tree_es) > 1:
+        self.parse_nexml_source(string_source(nexml_str.strip()))
+    def parse_nexml_source(self, source):
+        tree_es = self.iter_multiple_nexml(source, reuse_tree=True)
+        next(tree_es)
+        for tree_e in tree_es:
             raise PhyloParseError("Error: multiple trees detected. Use the function 'load_multiple_nexml()' instead.")
-        self.reset_nodes()
-        self.parse_nexml_tree_element(tree_es[0], ns)
-        self.process_tree_nodes()
     def parse_multiple_nexml(self, nexml_str):
-        trees = []
-        otus, tree_es, ns = self.parse_nexml_otus_trees(nexml_str)
-        for tree_e in tree_es:
-            self.reset_nodes()
-            self.parse_nexml_tree_element(tree_e, ns)
-            trees.append(self.copy())
-        return trees
+        return list(self.iter_multiple_nexml(string_source(nexml_str.strip())))
+    def iter_multiple_nexml(self, source, reuse_tree=False):
+        """Yields a Tree for each tree element in 'source', a file name or file object. Each node and edge is parsed when its element closes and is then cleared, so the document is never held in memory. If 'reuse_tree' is True, each tree is parsed into this Tree instead of a new one."""
+        ns, tree, num_trees = None, None, 0
+        otus_found, trees_found = False, False
+        elements = []
+        for event, element in self.iter_xml_events(source, 'NeXML'):
+            if ns is None:
+                if 'nexml' not in element.tag:
+                    raise PhyloParseError("Error: malformed NeXML file. The first element of a NeXML file must have the tag 'nexml'.")
+                ns, _, _ = element.tag.rpartition('nexml')
+            tag = element.tag[len(ns):] if element.tag.startswith(ns) else element.tag
+            if event == 'start':
+                elements.append(element)
+                if tag == 'trees' and len(elements) == 2:
+                    trees_found = True
+                elif tag == 'tree' and len(elements) == 3 and trees_found:
+                    tree = self if reuse_tree else Tree(support_label=self._support_label, remove_name_quotes=self._remove_name_quotes)
+                    tree.reset_nodes()
+                    tree.name = element.get('id')
+                    node_e_ids, edges, root_branch = {}, [], None
+                continue
+            elements.pop()
+            if tree is not None and len(elements) == 3:
+                if tag == 'node':
+                    e_id = element.get('id')
+                    if e_id == None:
+                        raise PhyloParseError("Error: malformed NeXML file. A node element was found with no 'id' attribute.")
+                    node = tree.new_tree_node()
+                    tree.parse_nexml_element_info_to_node(node, element, ns)
+                    node_e_ids[e_id] = node
+                elif tag == 'edge':
+                    edges.append((element.get('source'), element.get('target'), element.get('length', None)))
+                elif tag == 'rootedge':
+                    root_branch = element.get('length', None)
+                element.clear()
+                elements[-1].remove(element)
+            elif tag == 'tree' and tree is not None and len(elements) == 2:
+                tree.add_nexml_edges_to_nodes(node_e_ids, edges, root_branch)
+                tree.process_tree_nodes()
+                element.clear()
+                elements[-1].remove(element)
+                num_trees += 1
+                yield tree
+                tree = None
+            elif tag == 'otus' and len(elements) == 1:
+                otus_found = True
+                element.clear() # The otus are not needed, as each node element has its own label.
+                elements[-1].remove(element)
+        if not otus_found and verbose:
+            print("Warning: malformed NeXML file. No 'otus' block was found, but parsing can continue.")
+        if not trees_found:
+            raise PhyloParseError("Error: malformed NeXML file. No 'trees' block was found.")
+        if num_trees == 0:
+            raise PhyloParseError("Error: malformed NeXML file. No 'tree' blocks were found.")
     def save_nexml(self, tree_filename, support_values=True, comments=True, internal_names=True, max_name_length=None):
         tree_string = self.nexml_string(support_values, comments, internal_names, max_name_length)
         with open(process_path(tree_filename), 'w') as f:
@@ -938,30 +1251,113 @@ class Tree(object):
         trees_e.set('otus', otus_id)
         tree_id = replacer_fxn(self.name) if self.name else 'tree1'
         self.add_nexml_nodes_edges(trees_e, tree_id, node_ids, replacer_fxn, support_values, comments, internal_names, max_name_length)
-        return ET.tostring(e_tree, encoding='UTF-8', method='xml').decode()
+        return self.xml_string(e_tree)
+
+    # # #  Binary parsing and saving functions
+    def parse_binary(self, source):
+        """Builds the tree from 'source', a file name or file object holding the .npz data written by binary_string()."""
+        if hasattr(source, 'read'):
+            binary_tree = BinaryTree(source.read())
+        else:
+            binary_tree = open_binary(source)
+        self.build_binary_nodes(binary_tree)
+    def build_binary_nodes(self, binary_tree):
+        """Builds the tree from the arrays of the BinaryTree object 'binary_tree'."""
+        self.reset_nodes()
+        strings = binary_tree.strings
+        parents, branches, supports = binary_tree.parents.tolist(), binary_tree.branches.tolist(), binary_tree.supports.tolist()
+        name_inds, type_inds, comment_inds = binary_tree.name_inds.tolist(), binary_tree.support_type_inds.tolist(), binary_tree.comment_inds.tolist()
+        self.name = binary_tree.name
+        nodes = []
+        for i in range(len(parents)):
+            parent = nodes[parents[i]] if i > 0 else None
+            node = self.new_tree_node(parent)
+            if parent is None:
+                self.root = node
+            else:
+                parent.children.append(node)
+            if name_inds[i] >= 0:
+                node.name = strings[name_inds[i]]
+            if not binary_tree.is_cladogram:
+                node.branch = branches[i]
+            if supports[i] == supports[i]: # NaN marks a node with no support value.
+                node.support = supports[i]
+                node.support_type = strings[type_inds[i]] if type_inds[i] >= 0 else None
+            if comment_inds[i] >= 0:
+                node.comment = strings[comment_inds[i]]
+            nodes.append(node)
+        self.process_tree_nodes()
+    def save_binary(self, tree_filename):
+        tree_bytes = self.binary_string()
+        with open(process_path(tree_filename), 'wb') as f:
+            f.write(tree_bytes)
+    def binary_string(self):
+        """Returns the tree as the bytes of an .npz file. The nodes are stored in pre-order as arrays of their parent indices, branch lengths, and support values, while their names, support types, and comments are indices into a table of unique strings. The table is stored as the concatenated UTF-8 bytes of the strings along with their offsets."""
+        nodes = list(self.iter_preorder())
+        node_inds = dict((node, i) for i, node in enumerate(nodes))
+        strings, string_inds = [], {}
+        def string_ind(string):
+            if string is None:
+                return -1
+            if string not in string_inds:
+                string_inds[string] = len(strings)
+                strings.append(string)
+            return string_inds[string]
+        parents = np.array([node_inds[node.parent] if node != self.root else -1 for node in nodes], dtype=np.int32)
+        branches = np.array([node.branch for node in nodes], dtype=np.float64)
+        supports = np.array([np.nan if node.support is None else node.support for node in nodes], dtype=np.float64)
+        name_inds = np.array([string_ind(node.name if node.name != node.id else None) for node in nodes], dtype=np.int32)
+        type_inds = np.array([string_ind(node.support_type if node.support is not None else None) for node in nodes], dtype=np.int32)
+        comment_inds = np.array([string_ind(str(node.comment) if node.comment else None) for node in nodes], dtype=np.int32)
+        tree_name_ind = string_ind(self.name)
+        encoded_strings = [string.encode('utf-8') for string in strings]
+        string_offsets = np.cumsum([0] + [len(string) for string in encoded_strings], dtype=np.int32)
+        string_data = np.frombuffer(b''.join(encoded_strings), dtype=np.uint8)
+        buff = io.BytesIO()
+        np.savez(buff, version=np.array([self._binary_version]), parents=parents, branches=branches, supports=supports,
+            string_data=string_data, string_offsets=string_offsets, name_inds=name_inds, support_type_inds=type_inds, comment_inds=comment_inds,
+            tree_name_ind=np.array([tree_name_ind]), is_cladogram=np.array([bool(self.is_cladogram)]))
+        return buff.getvalue()
 
     # # #  Misc rooting functions
     def find_middle_point(self):
         """Identifies leaf1 and leaf2, which are the furthest apart in the tree. Pairwise distances aren't needed, as this pair must proveably include leaf1, which is the leaf furthest from the root.
         """
+        parents, branches, depths, firsts = self.get_postorder_arrays()
         leaf1, longest_dist = None, 0.0
         for leaf in self.leaves:
-            dist = sum(self.path_dists[leaf])
+            dist = depths[self.get_postorder_index(leaf)]
             if dist > longest_dist:
                 leaf1 = leaf
                 longest_dist = dist
+        # The distance from leaf1 to every node goes through the lowest ancestor of that node that is also an ancestor of leaf1:
+        par_list = parents.tolist()
+        lowest_shared = [-1] * len(par_list)
+        ind = self.get_postorder_index(leaf1)
+        while ind != -1:
+            lowest_shared[ind] = ind
+            ind = par_list[ind]
+        for ind in range(len(par_list)-2, -1, -1): # Parents come after their children.
+            if lowest_shared[ind] == -1:
+                lowest_shared[ind] = lowest_shared[par_list[ind]]
+        leaf1_dists = depths + depths[self.get_postorder_index(leaf1)] - 2*depths[lowest_shared]
         leaf2, longest_dist = None, 0.0
         for leaf in self.leaves:
-            dist = self.node_distance(leaf1, leaf)
+            dist = leaf1_dists[self.get_postorder_index(leaf)]
             if dist > longest_dist:
                 leaf2 = leaf
                 longest_dist = dist
-        for ind, (n1, n2) in enumerate(zip(self.paths[leaf1], self.paths[leaf2])):
-            if n1 != n2:
-                break
-        rev_ind = ind - len(self.paths[leaf1]) - 1
-        nodes = self.paths[leaf1][-1:rev_ind-1:-1] + self.paths[leaf2][ind:]
-        dists = self.path_dists[leaf1][-1:rev_ind:-1] + self.path_dists[leaf2][ind:]
+        longest_dist = self.node_distance(leaf1, leaf2) # Subtracting depths loses a little precision.
+        rca = self.get_postorder_index(self.get_recent_common_ancestor([leaf1, leaf2]))
+        up_inds, down_inds = [self.get_postorder_index(leaf1)], [self.get_postorder_index(leaf2)]
+        while up_inds[-1] != rca:
+            up_inds.append(parents[up_inds[-1]])
+        while parents[down_inds[-1]] != rca:
+            down_inds.append(parents[down_inds[-1]])
+        down_inds.reverse()
+        postorder_nodes = self.get_postorder_nodes()
+        nodes = [postorder_nodes[i] for i in up_inds + down_inds]
+        dists = [float(branches[i]) for i in up_inds[:-1] + down_inds] # dists[i] is the branch between nodes[i] and nodes[i+1].
         mid_dist, cur_dist = longest_dist / 2.0, 0.0
         for i in range(len(nodes)-1):
             dist = dists[i]
@@ -1046,59 +1442,76 @@ class Tree(object):
         if comment:
             node.comment = comment
     def format_newick_string(self, node, replacer_fxn, all_names, support_as_comment, support_values, comments, internal_names, max_name_length):
-        name = replacer_fxn(node.name)[:max_name_length] if node.name != node.id else ''
-        if name != '':
-            if name in all_names:
-                raise PhyloUniqueNameError("Error: cannot save tree in Newick format. After removing restricted characters and truncating to {} characters, two nodes ended up with the name '{}'".format(max_name_length, name))
+        """Returns the subtree rooted at 'node' in Newick format. The nodes are visited in pre-order using a stack that also holds the '(', ',' and ')...' strings that join them, which are written out as they are reached."""
+        buff, to_visit = [], [node]
+        while to_visit:
+            node = to_visit.pop()
+            if not isinstance(node, TreeNode):
+                buff.append(node)
+                continue
+            name = replacer_fxn(node.name)[:max_name_length] if node.name != node.id else ''
+            if name != '':
+                if name in all_names:
+                    raise PhyloUniqueNameError("Error: cannot save tree in Newick format. After removing restricted characters and truncating to {} characters, two nodes ended up with the name '{}'".format(max_name_length, name))
+                else:
+                    all_names.add(name)
+            comment = '[{}]'.format(node.comment) if node.comment else ''
+            if node in self.leaves:
+                if comments:
+                    name += comment
+                if self.is_cladogram:
+                    buff.append(name)
+                else:
+                    buff.append('{}:{}'.format(name, self.format_branch(node.branch)))
             else:
-                all_names.add(name)
-        comment = '[{}]'.format(node.comment) if node.comment else ''
-        if node in self.leaves:
+                buff.append('(')
+                to_visit.append(self.format_newick_internal_data(node, name, comment, support_as_comment, support_values, comments, internal_names))
+                for i, child in enumerate(node.children[::-1]):
+                    if i > 0:
+                        to_visit.append(',')
+                    to_visit.append(child)
+        return ''.join(buff)
+    def format_newick_internal_data(self, node, name, comment, support_as_comment, support_values, comments, internal_names):
+        """Returns the closing bracket of an internal node, followed by its label and branch data."""
+        children_buff = [')']
+        if support_as_comment:
+            if internal_names and name:
+                children_buff.append(name)
             if comments:
-                name += comment
-            if self.is_cladogram:
-                return name
-            else:
-                return '{}:{}'.format(name, self.format_branch(node.branch))
+                children_buff.append(comment)
+            if not self.is_cladogram and (node!=self.root or node.branch!=0):
+                children_buff.append(':' + self.format_branch(node.branch))
+            if node.support != None:
+                children_buff.append('[{}]'.format(node.support))
         else:
-            children_buff = ['(', ','.join(self.format_newick_string(child, replacer_fxn, all_names, support_as_comment, support_values, comments, internal_names, max_name_length) for child in node.children), ')']
-            if support_as_comment:
-                if internal_names and name:
-                    children_buff.append(name)
-                if comments:
-                    children_buff.append(comment)
-                if not self.is_cladogram and (node!=self.root or node.branch!=0):
-                    children_buff.append(':' + self.format_branch(node.branch))
-                if node.support != None:
-                    children_buff.append('[{}]'.format(node.support))
-            else:
-                if support_values and node.support != None:
-                    children_buff.append(str(node.support))
-                elif internal_names and name:
-                    children_buff.append(name)
-                if comments:
-                    children_buff.append(comment)
-                if not self.is_cladogram and (node!=self.root or node.branch!=0):
-                    children_buff.append(':' + self.format_branch(node.branch))
-            return ''.join(children_buff)
+            if support_values and node.support != None:
+                children_buff.append(str(node.support))
+            elif internal_names and name:
+                children_buff.append(name)
+            if comments:
+                children_buff.append(comment)
+            if not self.is_cladogram and (node!=self.root or node.branch!=0):
+                children_buff.append(':' + self.format_branch(node.branch))
+        return ''.join(children_buff)
 
     # # #  Misc NEXUS parsing and saving functions
     def parse_nexus_blocks(self, nexus_str):
-        nexus_str = nexus_str.strip()
-        if nexus_str[:7].lower() != '#nexus\n':
-            raise PhyloParseError("Error: malformed NEXUS file.")
-        nexus_lines = [] # Ensures the only ; are outside of comments
-        for data_str in self.separate_square_comments(nexus_str[7:]):
-            if not data_str:
-                continue
-            elif data_str[0] == '[':
-                nexus_lines.append(data_str.replace(';','.'))
+        blocks = OrderedDict()
+        for block, command, data in self.iter_nexus_commands([nexus_str]):
+            if command == 'end':
+                blocks.setdefault(block, [])
             else:
-                nexus_lines.append(data_str)
-        nexus_lines = ''.join(nexus_lines).split(';')
-        blocks, block = OrderedDict(), None
-        commands = []
-        for line in nexus_lines:
+                blocks.setdefault(block, []).append((command, data))
+        return blocks
+    def iter_nexus_commands(self, nexus_chunks):
+        """Yields (block, command, data) for each command within a block of the NEXUS data, given as an iterable of strings. The end of each block is yielded as the command 'end'."""
+        blocks, block, header = set(), None, True
+        for line in self.iter_statements(nexus_chunks):
+            if header:
+                line = line.lstrip()
+                if line[:7].lower() != '#nexus\n':
+                    raise PhyloParseError("Error: malformed NEXUS file.")
+                line, header = line[7:], False
             line = line.strip()
             if not line:
                 continue
@@ -1108,37 +1521,49 @@ class Tree(object):
                     break
             else:
                 raise PhyloParseError("Error: malformed NEXUS file. No valid command found within line '{}'.".format(line))
-            cmd_line = ''.join(cmds[cmd_ind :]).strip()
+            cmd_line = ''.join(cmd.replace(';','.') if cmd[0] == '[' else cmd for cmd in cmds[cmd_ind :]).strip() # Ensures the only ; are outside of comments
             if cmd_line.lower().startswith('begin '):
                 block = cmd_line[6:].lower().strip()
                 if block in blocks:
                     raise PhyloParseError("Error: the NEXUS file contains multiple '{}' blocks.".format(block))
-                commands = []
             elif cmd_line.lower() == 'end':
-                blocks[block] = commands
-                block, commands = None, []
+                blocks.add(block)
+                yield block, 'end', ''
+                block = None
             elif block is not None:
                 command, _, data = cmd_line.strip().partition(' ')
-                commands.append((command.lower().strip(), data))
-            else:
-                pass
+                yield block, command.lower().strip(), data
+        if header:
+            raise PhyloParseError("Error: malformed NEXUS file.")
         if block is not None:
             raise PhyloParseError("Error: malformed NEXUS file. The final block had no end.")
-        return blocks
-    def parse_nexus_tree_commands(self, nexus_str):
-        tree_commands, translate_command = [], None
-        blocks = self.parse_nexus_blocks(nexus_str)
-        trees_block = blocks.get('trees', None)
-        if trees_block == None:
+    def iter_nexus_tree_commands(self, nexus_chunks):
+        """Yields (tree_command, translation) for each tree in the TREES block. The Translate command is parsed once, and the same dict is given with every tree."""
+        translation, trees_block, num_trees = None, False, 0
+        for block, command, data in self.iter_nexus_commands(nexus_chunks):
+            if block != 'trees':
+                continue
+            elif command == 'end':
+                trees_block = True
+            elif command == 'translate':
+                translation = self.format_nexus_translation(data)
+            elif command == 'tree':
+                num_trees += 1
+                yield data, translation
+        if not trees_block:
             raise PhyloParseError('Error: malformed NEXUS file. No TREES block in the given NEXUS file.')
-        for cmd, data in trees_block:
-            if cmd == 'translate':
-                translate_command = data
-            elif cmd == 'tree':
-                tree_commands.append(data)
-        if not tree_commands:
+        if not num_trees:
             raise PhyloParseError('Error: malformed NEXUS file. No trees found in the given NEXUS file.')
-        return tree_commands, translate_command
+    def parse_nexus_tree_command(self, tree_command, translation, internal_as_names):
+        self.reset_nodes()
+        tree_name, _, newick_str = tree_command.partition('=')
+        self.name = tree_name.strip()
+        self.parse_newick(newick_str.strip() + ';', internal_as_names)
+        #self.process_tree_nodes() #This is done in parse_newick()
+        if translation:
+            for node in self.nodes:
+                if node.name in translation:
+                    node.rename(translation[node.name])
     def format_nexus_translation(self, translate_command):
         trans = {}
         for entry in translate_command.split(','):
@@ -1161,24 +1586,6 @@ class Tree(object):
         return '{}Translate\n{};'.format(indent, ',\n'.join(trans_buff))
 
     # # #  Misc phyloxml parsing and saving functions
-    def parse_phyloxml_phylogenies(self, phylo_str):
-        try:
-            ET_root = ET.fromstring(phylo_str.strip())
-        except:
-            raise PhyloParseError("Error: malformed PhyloXML file.")
-        if 'phyloxml' not in ET_root.tag:
-            raise PhyloParseError("Error: malformed file format. The first element of a PhyloXML file must have the tag 'phyloxml'.")
-        ns, _, _ = ET_root.tag.rpartition('phyloxml')
-        phylos = ET_root.findall('phylogeny') + ET_root.findall(ns + 'phylogeny')
-        if len(phylos) == 0:
-            raise PhyloParseError("Error: malformed file format. No phylogenies were found.")
-        return phylos, ns
-    def traverse_phyloxml(self, node, element, ns):
-        for child_element in element.findall('clade') + element.findall(ns + 'clade'):
-            child_node = self.new_tree_node(node)
-            self.parse_phyloxml_element_info_to_node(child_node, child_element, ns)
-            node.children.append(child_node)
-            self.traverse_phyloxml(child_node, child_element, ns)
     def parse_phyloxml_element_info_to_node(self, node, element, ns):
         seq_element = element.find('sequence')
         if seq_element == None:
@@ -1206,86 +1613,54 @@ class Tree(object):
             if prop_e.get('applies_to') == 'clade' and prop_e.get('ref') == 'comment':
                 node.comment = prop_e.text
     def add_nodes_to_phyloxml(self, node, parent_element, replacer_fxn, all_names, support_values, comments, internal_names, max_name_length):
-        element = ET.SubElement(parent_element, 'clade')
-        name = replacer_fxn(node.name)[:max_name_length] if node.name != node.id else ''
-        if name != '':
-            if name in all_names:
-                raise PhyloUniqueNameError("Error: cannot save tree in PhyloXML format. After removing restricted characters and truncating to {} characters, two nodes ended up with the name '{}'".format(max_name_length, name))
-            else:
-                all_names.add(name)
-        if name and (internal_names or node in self.leaves):
-            name_e = ET.Element('name')
-            name_e.text = name
-            element.append(name_e)
-        if not self.is_cladogram:
-            branch_e = ET.Element('branch_length')
-            branch_e.text = self.format_branch(node.branch)
-            element.append(branch_e)
-        if support_values and node.support is not None and node.support_type:
-            conf_e = ET.Element('confidence', attrib={'type':node.support_type})
-            conf_e.text = str(node.support)
-            element.append(conf_e)
-        if comments and node.comment:
-            prop_e = ET.Element('property', attrib={'applies_to':'clade', 'datatype':'xsd:string', 'ref':'comment'})
-            prop_e.text = replacer_fxn(str(node.comment))
-            element.append(prop_e)
-        for child in node.children:
-            self.add_nodes_to_phyloxml(child, element, replacer_fxn, all_names, support_values, comments, internal_names, max_name_length)
+        """Adds a clade element for 'node' and each of its descendants, using an explicit stack so it can be used on trees of any depth."""
+        to_visit = [(node, parent_element)]
+        while to_visit:
+            node, parent_element = to_visit.pop()
+            element = ET.SubElement(parent_element, 'clade')
+            name = replacer_fxn(node.name)[:max_name_length] if node.name != node.id else ''
+            if name != '':
+                if name in all_names:
+                    raise PhyloUniqueNameError("Error: cannot save tree in PhyloXML format. After removing restricted characters and truncating to {} characters, two nodes ended up with the name '{}'".format(max_name_length, name))
+                else:
+                    all_names.add(name)
+            if name and (internal_names or node in self.leaves):
+                name_e = ET.Element('name')
+                name_e.text = name
+                element.append(name_e)
+            if not self.is_cladogram:
+                branch_e = ET.Element('branch_length')
+                branch_e.text = self.format_branch(node.branch)
+                element.append(branch_e)
+            if support_values and node.support is not None and node.support_type:
+                conf_e = ET.Element('confidence', attrib={'type':node.support_type})
+                conf_e.text = str(node.support)
+                element.append(conf_e)
+            if comments and node.comment:
+                prop_e = ET.Element('property', attrib={'applies_to':'clade', 'datatype':'xsd:string', 'ref':'comment'})
+                prop_e.text = replacer_fxn(str(node.comment))
+                element.append(prop_e)
+            to_visit.extend((child, element) for child in node.children[::-1])
 
     # # #  Misc NeXML parsing and saving functions
-    def parse_nexml_otus_trees(self, nexml_str):
-        try:
-            ET_root = ET.fromstring(nexml_str.strip())
-        except:
-            raise PhyloParseError("Error: malformed NeXML file.")
-        if 'nexml' not in ET_root.tag:
-            raise PhyloParseError("Error: malformed NeXML file. The first element of a NeXML file must have the tag 'nexml'.")
-        ns, _, _ = ET_root.tag.rpartition('nexml')
-        otus = ET_root.find('otus')
-        if otus == None:
-            otus = ET_root.find(ns + 'otus')
-        if otus == None:
-            if verbose:
-                print("Warning: malformed NeXML file. No 'otus' block was found, but parsing can continue.")
-        trees_e = ET_root.find('trees')
-        if trees_e == None:
-            trees_e = ET_root.find(ns + 'trees')
-        if trees_e == None:
-            raise PhyloParseError("Error: malformed NeXML file. No 'trees' block was found.")
-        trees = trees_e.findall('tree') + trees_e.findall(ns + 'tree')
-        if len(trees) == 0:
-            raise PhyloParseError("Error: malformed NeXML file. No 'tree' blocks were found.")
-        return otus, trees, ns
-    def parse_nexml_tree_element(self, tree_e, ns):
-        self.name = tree_e.get('id')
-        node_e_ids = {}
-        for node_e in tree_e.findall('node') + tree_e.findall(ns + 'node'):
-            e_id = node_e.get('id')
-            if e_id == None:
-                raise PhyloParseError("Error: malformed NeXML file. A node element was found with no 'id' attribute.")
-            node = self.new_tree_node()
-            self.parse_nexml_element_info_to_node(node, node_e, ns)
-            node_e_ids[e_id] = node
+    def add_nexml_edges_to_nodes(self, node_e_ids, edges, root_branch):
+        """Links the nodes of a parsed tree element. 'node_e_ids' maps each element id to its TreeNode, and 'edges' holds a (source, target, length) tuple for each edge element."""
         target_e_ids = set()
-        for edge_e in tree_e.findall('edge') + tree_e.findall(ns + 'edge'):
-            src, trg = edge_e.get('source'), edge_e.get('target')
+        for src, trg, length in edges:
             if src not in node_e_ids or trg not in node_e_ids:
                 raise PhyloParseError("Error: malformed NeXML file. An edge had an unrecognized source or target.")
             target_e_ids.add(trg)
-            node_e_ids[trg].branch = edge_e.get('length', None)
+            node_e_ids[trg].branch = length
             node_e_ids[trg].parent = node_e_ids[src]
             node_e_ids[src].children.append(node_e_ids[trg])
         if self.root == None:
             root_e_id = (set(node_e_ids) - target_e_ids).pop()
             self.root = node_e_ids[root_e_id]
-        root_edge_e = tree_e.find('rootedge')
-        if root_edge_e == None:
-            root_edge_e = tree_e.find(ns + 'rootedge')
-        if root_edge_e is not None:
-            self.root.branch = root_edge_e.get('length', None)
+        if root_branch is not None:
+            self.root.branch = root_branch
     def parse_nexml_element_info_to_node(self, node, node_e, ns):
         node.name = node_e.get('label', None)
-        for meta_e in node_e.findall('meta') + node_e.findall(ns + 'meta'): # comments and support
+        for meta_e in node_e.findall('meta') + (node_e.findall(ns + 'meta') if ns else []): # comments and support
             val = meta_e.get('content')
             prop_ns, _, prop = meta_e.get('property').partition(':')
             if not prop:
@@ -1379,24 +1754,26 @@ class Tree(object):
     def reset_nodes(self):
         self.root = None
         self.nodes = set()
+        self._paths = self._path_dists = self._postorder_nodes = None
+        self._postorder_arrays = self._postorder_inds = None
         self._node_ids = set()
         self._node_id_index = 0
-    def new_tree_node(self, parent=None, node_id=None):
-        if node_id == None:
-            node_id = self._node_id_template.format(self._node_id_index)
-        while node_id in self._node_ids:
+    def new_tree_node(self, parent=None, node_index=None):
+        if node_index == None:
+            node_index = self._node_id_index
+        while node_index in self._node_ids:
             self._node_id_index += 1
-            node_id = self._node_id_template.format(self._node_id_index)
-        self._node_ids.add(node_id)
+            node_index = self._node_id_index
+        self._node_ids.add(node_index)
         self._node_id_index += 1
-        node = TreeNode(self, node_id, parent)
+        node = TreeNode(self, node_index, parent)
         self.nodes.add(node)
         return node
     def remove_tree_node(self, node, remove_from_parent=True):
         """Expects process_tree_nodes() to be called afterwards, as does not modify self.leaves, self.internal or other such attributes."""
         if remove_from_parent and node != self.root:
             node.parent.children.remove(node)
-        self._node_ids.remove(node.id)
+        self._node_ids.remove(node.index)
         self.nodes.remove(node)
     def process_tree_nodes(self):
         """Cleans up the node names, differentiating between internal names and support values. Ensures all nodes have a numerical node.branch value. Sets self.is_binary, self.is_rooted, and self.is_cladogram. Fills out the self.leaves and self.internal sets and the self.node_names dict."""
@@ -1456,24 +1833,66 @@ class Tree(object):
                 node.name = name
             self.node_names[node.name] = node
             node._been_processed = True
-        self.calculate_paths()
+        self._paths = self._path_dists = None # Recalculated when next needed.
+        self._postorder_nodes = self._postorder_arrays = self._postorder_inds = None
     def calculate_paths(self):
-        """Fills out self.paths and self.path_dists."""
-        self.paths = {}
-        for node in self.nodes:
-            path = self.find_path_to_root(node)
-            self.paths[node] = path
-            self.path_dists[node] = [0.0] + [n.branch for n in path[1:]]
+        """Fills out self.paths and self.path_dists. Each path extends its parent's, so the tree is traversed once."""
+        paths, path_dists = {}, {}
+        for node in self.iter_preorder():
+            if node == self.root:
+                paths[node], path_dists[node] = [node], [0.0]
+            else:
+                paths[node] = paths[node.parent] + [node]
+                path_dists[node] = path_dists[node.parent] + [node.branch]
+        self._paths, self._path_dists = paths, path_dists
+    def calculate_postorder_arrays(self):
+        """Fills out the arrays returned by get_postorder_arrays(), and the index of each node. Children come before their parents, so each array is filled in a single pass."""
+        nodes = self.get_postorder_nodes()
+        num_nodes = len(nodes)
+        inds = dict((node, i) for i, node in enumerate(nodes))
+        parents = np.array([inds[node.parent] if node != self.root else -1 for node in nodes], dtype=np.int32)
+        branches = np.array([node.branch for node in nodes], dtype=np.float64)
+        depths = [0.0] * num_nodes
+        par_list, branch_list = parents.tolist(), branches.tolist()
+        for i in range(num_nodes-2, -1, -1): # The root is last.
+            depths[i] = depths[par_list[i]] + branch_list[i]
+        firsts = list(range(num_nodes))
+        for i in range(num_nodes-1):
+            par = par_list[i]
+            if firsts[i] < firsts[par]:
+                firsts[par] = firsts[i]
+        self._postorder_inds = inds
+        self._postorder_arrays = (parents, branches, np.array(depths, dtype=np.float64), np.array(firsts, dtype=np.int32))
     def find_path_to_root(self, node):
         path = []
         self.traverse_parents_to_root(node, path)
         return path[::-1]
     def traverse_parents_to_root(self, node, path):
         path.append(node)
-        if node == self.root:
-            return
-        else:
-            self.traverse_parents_to_root(node.parent, path)
+        while node != self.root:
+            node = node.parent
+            path.append(node)
+    def iter_statements(self, data_chunks):
+        """Given an iterable of strings, yields the text between each ';' that is outside of a comment, followed by any text after the final ';'. Statements may span any number of the strings."""
+        pending, depth = [], 0
+        for chunk in data_chunks:
+            start = 0
+            for match in self._statement_token_pattern.finditer(chunk):
+                char = match.group()
+                if char == '[':
+                    depth += 1
+                elif char == ']':
+                    if depth > 0:
+                        depth -= 1
+                elif depth == 0:
+                    pending.append(chunk[start:match.start()])
+                    yield ''.join(pending)
+                    pending, start = [], match.end()
+            pending.append(chunk[start:])
+        statement = ''.join(pending)
+        if depth > 0:
+            raise PhyloValueError("Error: mismatched square brackets: '{}'. Cannot extract comments.".format(statement))
+        yield statement
     def separate_square_comments(self, data_str):
         """Given a string, separates it into data and comments.
         Ex: 'some_data[a comment] data [now [a nested] comment]end' becomes ['some_data', '[a comment]', ' data ', '[now [a nested] comment]', 'end']."""
@@ -1496,6 +1915,44 @@ class Tree(object):
         return data_buff
 
     # # #  Misc functions
+    def xml_string(self, root_element):
+        """Returns the document rooted at the ElementTree element 'root_element' as a string, the same as ElementTree.tostring(). That function writes each nested element with a recursive call, so it fails on the clades of deep PhyloXML trees."""
+        attrib_entities = {'"':'&quot;', '\r':'&#13;', '\n':'&#10;', '\t':'&#09;'}
+        str_buff = []
+        to_visit = [(root_element, False)]
+        while to_visit:
+            element, children_done = to_visit.pop()
+            if children_done:
+                str_buff.append('</{}>'.format(element.tag))
+            else:
+                str_buff.append('<' + element.tag)
+                for key, value in element.items():
+                    str_buff.append(' {}="{}"'.format(key, xml_escape(value, attrib_entities)))
+                if not element.text and len(element) == 0:
+                    str_buff.append(' />')
+                else:
+                    str_buff.append('>')
+                    if element.text:
+                        str_buff.append(xml_escape(element.text))
+                    to_visit.append((element, True))
+                    to_visit.extend((child, False) for child in reversed(list(element)))
+                    continue
+            if element.tail:
+                str_buff.append(xml_escape(element.tail))
+        return ''.join(str_buff)
+    def iter_xml_events(self, source, format_name):
+        """Yields the ('start' or 'end', element) events of ElementTree.iterparse, where 'source' is a file name or file object."""
+        if not hasattr(source, 'read'):
+            source = process_path(source)
+        events = ET.iterparse(source, events=('start', 'end'))
+        while True:
+            try:
+                event, element = next(events)
+            except StopIteration:
+                return
+            except ET.ParseError:
+                raise PhyloParseError("Error: malformed {} file.".format(format_name))
+            yield event, element
     def create_string_replacer_function(self, replacements, ignore_case=False):
         """Returns a function to be used: new_name = fxn(name). If 'ignore_case' is True, the case of the given pattern will be ignored."""
         if ignore_case:
@@ -1506,6 +1963,9 @@ class Tree(object):
             pattern = re.compile("|".join([re.escape(k) for k, v in replacements.items()]))
             replacement_function = lambda match: replacements[match.group(0)]
         return lambda string: pattern.sub(replacement_function, string)
+    def hash_clade_data(self, data):
+        """Returns a 64-bit integer hash of the bytes 'data'. Unlike hash(), it is the same in every Python process."""
+        return int(hashlib.md5(data).hexdigest()[:16], 16)
     def format_branch(self, branch):
         if branch == 0:
             return '0'
@@ -1513,36 +1973,87 @@ class Tree(object):
             return '{:g}'.format(branch)
         else:
             return '{{:.{}f}}'.format(self._max_branch_precision).format(branch)
+    def add_transpose(self, mat, block_size=1024):
+        """Adds the transpose of the square matrix 'mat' to it in place. It is done in blocks, so only temporary arrays of 'block_size' squared elements are needed."""
+        size = len(mat)
+        for i in range(0, size, block_size):
+            for j in range(i, size, block_size):
+                block = mat[i:i+block_size, j:j+block_size] + mat[j:j+block_size, i:i+block_size].T
+                mat[i:i+block_size, j:j+block_size] = block
+                mat[j:j+block_size, i:i+block_size] = block.T
+    def fill_gram_matrix(self, sqrd_dist, max_block_size=2**20):
+        """Converts the squared distance matrix 'sqrd_dist' in place into the positive semi-definite matrix M, where M[i,j] = (sqrd_dist[0,i] + sqrd_dist[0,j] - sqrd_dist[i,j]) / 2. The rows are processed in chunks so the temporary arrays stay below 'max_block_size' elements."""
+        first_row = sqrd_dist[0].copy()
+        step = max(max_block_size // len(first_row), 1)
+        for i in range(0, len(first_row), step):
+            rows = sqrd_dist[i:i+step]
+            np.subtract(first_row[i:i+step,None] + first_row[None,:], rows, out=rows)
+        sqrd_dist /= 2.0
+    def fill_centred_gram_matrix(self, sqrd_dist):
+        """Converts the squared distance matrix 'sqrd_dist' in place into the double-centred Gram matrix G = -J * sqrd_dist * J / 2, where J is the centring matrix. The eigenvectors of G give the principal axes of the leaf points."""
+        row_means = sqrd_dist.mean(axis=1)
+        grand_mean = row_means.mean()
+        sqrd_dist -= row_means[:,None]
+        sqrd_dist -= row_means[None,:]
+        sqrd_dist += grand_mean
+        sqrd_dist *= -0.5
+    def randomized_eigh(self, g_mat, variance_target, max_dimensions=None, initial_dimensions=16, power_iters=3, seed=0):
+        """Approximates the largest eigenvalues and eigenvectors of the symmetric matrix 'g_mat' with a randomized subspace iteration. The eigenvalues are returned in ascending order, like numpy.linalg.eigh. The number of eigenpairs starts at 'initial_dimensions' and is doubled until their sum reaches 'variance_target' of the trace of 'g_mat', or until 'max_dimensions' is reached. The subspace is twice the number of eigenpairs, as the spectra of tree distances decay slowly and the trailing eigenpairs are otherwise inaccurate. A fixed 'seed' keeps the results reproducible."""
+        num_rows = g_mat.shape[0]
+        total_variance = np.trace(g_mat)
+        limit = min(max_dimensions, num_rows) if max_dimensions else num_rows
+        num_dims = min(initial_dimensions, limit)
+        rand_state = np.random.RandomState(seed)
+        while True:
+            subspace_size = num_dims * 2
+            if subspace_size * 2 >= num_rows: # The full decomposition is cheaper at this point.
+                values, vectors = np.linalg.eigh(g_mat)
+                captured = np.cumsum(np.maximum(values[::-1], 0.0))
+                num_dims = min(int(np.searchsorted(captured, variance_target * total_variance)) + 1, limit)
+                return values[-num_dims:], vectors[:,-num_dims:]
+            basis = np.linalg.qr(g_mat.dot(rand_state.standard_normal((num_rows, subspace_size))))[0]
+            for i in range(power_iters):
+                basis = np.linalg.qr(g_mat.dot(basis))[0]
+            values, small_vectors = np.linalg.eigh(basis.T.dot(g_mat.dot(basis)))
+            values, small_vectors = values[-num_dims:], small_vectors[:,-num_dims:]
+            if num_dims >= limit or np.sum(values[values > 0]) >= variance_target * total_variance:
+                return values, basis.dot(small_vectors)
+            num_dims = min(num_dims * 2, limit)
     def copy_nodes(self, old_parent, new_parent, new_tree):
-        new_children = []
-        for old_child in old_parent.children:
-            new_child = old_child.copy(new_tree)
-            new_child.parent = new_parent
-            new_children.append(new_child)
-            new_tree.nodes.add(new_child)
-            self.copy_nodes(old_child, new_child, new_tree)
-        new_parent.children = new_children
+        """Copies the descendants of 'old_parent' under 'new_parent', in pre-order."""
+        new_parent.children = []
+        to_copy = [(old_child, new_parent) for old_child in old_parent.children[::-1]]
+        while to_copy:
+            old_node, new_parent = to_copy.pop()
+            new_node = old_node.copy(new_tree)
+            new_node.parent = new_parent
+            new_node.children = []
+            new_parent.children.append(new_node)
+            new_tree.nodes.add(new_node)
+            to_copy.extend((old_child, new_node) for old_child in old_node.children[::-1])
     def traverse_rotate_children(self, node):
-        for child in node.children:
+        for child in list(self.iter_preorder(node))[1:]:
             if child not in self.leaves:
                 self.rotate_node(child, propagate_rotation=False)
-                self.traverse_rotate_children(child)
     def traverse_order_children(self, node, increasing):
-        order, total_children = {}, 0
-        for child in node.children:
-            if child in self.leaves:
-                order[child] = (0, child.branch)
-                total_children += 1
-            else:
-                sub_children = self.traverse_order_children(child, increasing)
-                order[child] = (sub_children, child.branch)
-                total_children += sub_children
-        node.children.sort(key=lambda nd: order[nd], reverse=not increasing)
-        return total_children
+        total_children = {} # Number of leaves under each processed internal node.
+        for parent in self.iter_postorder(node):
+            if parent in self.leaves:
+                continue
+            order, total = {}, 0
+            for child in parent.children:
+                if child in self.leaves:
+                    order[child] = (0, child.branch)
+                    total += 1
+                else:
+                    sub_children = total_children.pop(child)
+                    order[child] = (sub_children, child.branch)
+                    total += sub_children
+            parent.children.sort(key=lambda nd: order[nd], reverse=not increasing)
+            total_children[parent] = total
+        return total_children.get(node, 0)
     def build_nodes_list(self, node, lst):
-        lst.append(node)
-        for child in node.children:
-            self.build_nodes_list(child, lst)
+        lst.extend(self.iter_preorder(node))
     def __str__(self):
         _str = 'phylo.Tree leaves={}'.format(len(self.leaves))
         if self.name != None:
@@ -1554,10 +2065,120 @@ class Tree(object):
         return len(self.leaves)
 
 
+class BinaryTree(object):
+    """The arrays of a tree saved by Tree.binary_string(), read in place from a memory-mapped file or a bytes object; np.savez stores each array uncompressed, so they are not copied.
+    The names and structure of the nodes are taken straight from the arrays, and the Tree object is only built the first time self.tree or one of its other attributes is used."""
+    def __init__(self, buff, **kwargs):
+        self._tree_args = kwargs
+        self._tree = None
+        self._names = self._children = None
+        try:
+            arrays = self.read_arrays(buff)
+            offsets = arrays['string_offsets'].tolist()
+            string_data = arrays['string_data'].tobytes()
+            self.strings = [string_data[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(offsets) - 1)]
+            version, tree_name_ind, self.is_cladogram = arrays['version'][0], arrays['tree_name_ind'][0], bool(arrays['is_cladogram'][0])
+        except PhyloParseError:
+            raise
+        except Exception:
+            raise PhyloParseError("Error: malformed binary tree file.")
+        if version != Tree._binary_version:
+            raise PhyloParseError("Error: the binary tree file has version {}, but this software reads version {}.".format(version, Tree._binary_version))
+        self.parents, self.branches, self.supports = arrays['parents'], arrays['branches'], arrays['supports']
+        self.name_inds, self.support_type_inds, self.comment_inds = arrays['name_inds'], arrays['support_type_inds'], arrays['comment_inds']
+        num_nodes = len(self.parents)
+        if any(len(arrays[key]) != num_nodes for key in ('branches', 'supports', 'name_inds', 'support_type_inds', 'comment_inds')):
+            raise PhyloParseError("Error: malformed binary tree file. The node arrays have different lengths.")
+        if num_nodes == 0 or self.parents[0] != -1 or np.any(self.parents[1:] < 0) or np.any(self.parents[1:] >= np.arange(1, num_nodes)):
+            raise PhyloParseError("Error: malformed binary tree file. The nodes must be in pre-order, with the root first.")
+        self.name = self.strings[tree_name_ind] if tree_name_ind >= 0 else None
+        num_children = np.bincount(self.parents[1:], minlength=num_nodes)
+        self.num_leaves = int(np.count_nonzero(num_children == 0))
+        child_counts = set(num_children.tolist())
+        self.is_binary = child_counts == {0, 2} or (child_counts == {0, 2, 3} and np.count_nonzero(num_children == 3) == 1 and num_children[0] == 3) # As set by Tree.process_tree_nodes()
+    def read_arrays(self, buff):
+        """Returns a dict {key:array, ...} of the arrays in the .npz data 'buff', a bytes object or mmap. Each array is a view of 'buff', so they must be stored uncompressed, as np.savez does."""
+        arrays = {}
+        with zipfile.ZipFile(io.BytesIO(buff) if isinstance(buff, bytes) else buff) as archive: # BytesIO shares the memory of a bytes object.
+            infos = dict((key, archive.getinfo(key + '.npy')) for key in Tree._binary_arrays)
+        for key, info in infos.items():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise PhyloParseError("Error: malformed binary tree file. The arrays must be stored uncompressed.")
+            # The member's data follows its local file header, whose name and extra field lengths may differ from the central directory's.
+            name_len, extra_len = struct.unpack('<2H', buff[info.header_offset+26:info.header_offset+30])
+            start = info.header_offset + 30 + name_len + extra_len
+            version = np.lib.format.read_magic(io.BytesIO(buff[start:start+8]))
+            len_format = '<H' if version == (1, 0) else '<I'
+            header_end = start + 8 + struct.calcsize(len_format) + struct.unpack(len_format, buff[start+8:start+8+struct.calcsize(len_format)])[0]
+            header = io.BytesIO(buff[start:header_end])
+            np.lib.format.read_magic(header)
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header) if version == (1, 0) else np.lib.format.read_array_header_2_0(header)
+            if dtype.hasobject or len(shape) != 1 or header_end + dtype.itemsize*shape[0] > len(buff):
+                raise PhyloParseError("Error: malformed binary tree file.")
+            arrays[key] = np.frombuffer(buff, dtype=dtype, count=shape[0], offset=header_end)
+        return arrays
+    @property
+    def tree(self):
+        """The Tree object, built from the arrays when first needed."""
+        if self._tree is None:
+            tree = Tree(**self._tree_args)
+            tree.build_binary_nodes(self)
+            self._tree = tree
+        return self._tree
+    def __getattr__(self, attr):
+        if attr.startswith('_'): # Private and special attributes aren't passed on, so copying or pickling doesn't build the tree.
+            raise AttributeError(attr)
+        return getattr(self.tree, attr)
+    def __len__(self):
+        return self.num_leaves
+
+    # # #  Functions matching those of Tree, answered without building it
+    def get_preorder_names(self):
+        """Returns the names of the nodes as a list of strings, in the order they are stored. Unnamed nodes are named from their index, as process_tree_nodes() would name them. If that would change any names, they are instead taken from the built tree."""
+        if self._names is None:
+            template, strings = Tree()._node_id_template, self.strings
+            names = [strings[ind] if ind >= 0 and strings[ind] else template.format(i) for i, ind in enumerate(self.name_inds.tolist())]
+            remove_quotes = self._tree_args.get('remove_name_quotes', True)
+            if len(set(names)) != len(names) or (remove_quotes and any(name[0] == name[-1] in '\'"' for name in names)):
+                names = [node.name for node in self.tree.iter_preorder()]
+            self._names = names
+        return self._names
+    def get_child_bounds(self):
+        """Returns a list of the node indices ordered by their parent, and a list 'bounds' where the children of node i are found at positions bounds[i] to bounds[i+1] of the first list."""
+        if self._children is None:
+            parents = self.parents[1:]
+            child_inds = np.argsort(parents, kind='stable') + 1 # Stable, so each node's children keep their order.
+            bounds = np.concatenate(([0], np.cumsum(np.bincount(parents, minlength=len(self.parents)))))
+            self._children = (child_inds.tolist(), bounds.tolist())
+        return self._children
+    def get_named_leaves(self):
+        """Returns the names of the leaves as a list of strings, sorted alphabetically."""
+        names, (child_inds, bounds) = self.get_preorder_names(), self.get_child_bounds()
+        return sorted(names[i] for i in range(len(names)) if bounds[i] == bounds[i+1])
+    def get_named_children(self):
+        """Returns a dict {'name':['child1', 'child2', ...], ...}."""
+        names, (child_inds, bounds) = self.get_preorder_names(), self.get_child_bounds()
+        child_names = [names[i] for i in child_inds]
+        return dict((names[i], child_names[bounds[i]:bounds[i+1]]) for i in range(len(names)))
+    def get_postorder_names(self):
+        """Returns the names of the nodes in the same order as Tree.get_postorder_nodes(). The nodes before node i in a post-order traversal are its descendants, and the nodes before it in pre-order that aren't its ancestors."""
+        names, parents = self.get_preorder_names(), self.parents.tolist()
+        num_nodes = len(parents)
+        sizes, depths = [1]*num_nodes, [0]*num_nodes
+        for i in range(num_nodes-1, 0, -1): # Every node is stored after its parent.
+            sizes[parents[i]] += sizes[i]
+        for i in range(1, num_nodes):
+            depths[i] = depths[parents[i]] + 1
+        postorder = [None]*num_nodes
+        for i in range(num_nodes):
+            postorder[i - depths[i] + sizes[i] - 1] = names[i]
+        return postorder
+
 class TreeNode(object):
-    def __init__(self, tree, node_id, parent):
+    __slots__ = ('tree', 'index', 'parent', 'children', 'name', 'branch', 'support', 'support_type', 'comment', '_been_processed') # Large trees hold hundreds of thousands of nodes, so they don't each get a __dict__.
+    def __init__(self, tree, node_index, parent):
         self.tree = tree
-        self.id = node_id
+        self.index = node_index # Integer that is unique within the tree.
         self.parent = parent
         self.children = []
         self.name = None
@@ -1576,7 +2197,7 @@ class TreeNode(object):
         self.tree.node_names[new_name] = self
     def copy(self, new_tree):
         """Deep copies the current TreeNode, adding it to the Tree object 'new_tree'."""
-        new_node = new_tree.new_tree_node(parent=self.parent, node_id=self.id)
+        new_node = new_tree.new_tree_node(parent=self.parent, node_index=self.index)
         new_node.name = self.name
         new_node.branch = self.branch
         new_node.support = self.support
@@ -1585,6 +2206,10 @@ class TreeNode(object):
         new_node.children = self.children[::]
         new_node._been_processed = self._been_processed
         return new_node
+    @property
+    def id(self):
+        """The unique string identifying this node, formatted from self.index. It is used as the name of any unnamed node."""
+        return self.tree._node_id_template.format(self.index)
     def __str__(self):
         _str = 'phylo.TreeNode id={}'.format(self.id)
         if self.name != self.id:
@@ -0,0 +1,150 @@
+"""MIPhy class that clusters a set of gene trees, such as bootstrap replicates or Bayesian posterior samples, and measures how often each pair of sequences falls into the same MIG.
+"""
+
+import time, multiprocessing, itertools
+import numpy as np
+from miphy_resources.clusterer import Clusterer, CladeMemo
+from miphy_resources.miphy_instance import SpeciesInfo
+from miphy_resources.miphy_common import MiphyValidationError
+from miphy_resources import phylo
+
+
+class TreeSetInstance(SpeciesInfo):
+    def __init__(self, gene_trees_file, info_data, use_coords, verbose, processes=None, variance_target=None, tree_format='auto'):
+        self.gene_trees_file = gene_trees_file # A file name, or a seekable file object. The trees are streamed from it, so only a few are held in memory at once.
+        self.use_coords = use_coords
+        self.verbose = verbose
+        self.processes = processes # Number of worker processes clustering the trees; None uses one per CPU.
+        self.variance_target = variance_target # If given, the coordinate points of each tree are truncated; see Clusterer.variance_target.
+        self.species_tree_data = ''
+        self.species_mapping = {}
+        self.species_colours = {}
+        self.parse_species_tree_mapping_colours(info_data) # Parsed once for the whole set.
+        if self.verbose: print('Finished parsing the info file.')
+        self.species = sorted(list(set(self.species_mapping.values())))
+        self.tree_format = self.detect_tree_format(tree_format)
+        tree_string, translation = next(self.iter_gene_tree_strings(), (None, None))
+        if tree_string is None:
+            raise MiphyValidationError('no trees were found in the given file.')
+        first_tree = _load_tree_string(tree_string, self.tree_format, translation)
+        self.num_trees = 0 # Counted as the trees are clustered.
+        self.sequence_names = sorted(first_tree.get_named_leaves())
+        self.num_sequences = len(self.sequence_names)
+        self.co_clusters = None
+        if self.verbose: print('Found gene trees of %i sequences.' % self.num_sequences)
+
+    def detect_tree_format(self, tree_format):
+        """Returns 'nexus' or 'newick'. If 'tree_format' is 'auto', it is decided by the first character of the file."""
+        if tree_format in ('nexus', 'newick'):
+            return tree_format
+        elif tree_format != 'auto':
+            raise MiphyValidationError("the trees in a set must be in 'nexus' or 'newick' format, not '%s'." % tree_format)
+        self.rewind_gene_trees_file()
+        for chunk in phylo.read_file_chunks(self.gene_trees_file, 2**10):
+            chunk = chunk.lstrip()
+            if chunk:
+                return 'nexus' if chunk[0] == '#' else 'newick'
+        raise MiphyValidationError('the given file of gene trees is empty.')
+    def iter_gene_tree_strings(self):
+        """Returns a generator of (tree_string, translation) for each gene tree, reading the file from its start. The trees are parsed by the workers, so the text is passed on as it was read; 'translation' is the dict of any NEXUS Translate command. The file is read once for each set of parameters."""
+        self.rewind_gene_trees_file()
+        if self.tree_format == 'nexus':
+            return phylo.iter_nexus_tree_commands(self.gene_trees_file)
+        else:
+            return ((newick_str, None) for newick_str in phylo.iter_newick_tree_strings(self.gene_trees_file))
+    def rewind_gene_trees_file(self):
+        if hasattr(self.gene_trees_file, 'seek'):
+            self.gene_trees_file.seek(0)
+
+    def processed(self, params):
+        """Clusters every tree in the set with the weights in 'params' (ils, dup, loss, spread), filling out self.co_clusters with the results."""
+        t0 = time.time()
+        gene_tree_strings = self.iter_gene_tree_strings()
+        tree_string, translation = next(gene_tree_strings) # The translation is the same for every tree, so it is sent once to each worker.
+        tree_strings = itertools.chain([tree_string], (tree_string for tree_string, _ in gene_tree_strings))
+        init_args = (self.species_tree_data, self.species_mapping, self.sequence_names, self.use_coords, self.variance_target, tuple(params[:4]), self.tree_format, translation)
+        self.co_clusters = CoClusterAccumulator(self.sequence_names)
+        self.num_trees = 0
+        if self.processes == 1:
+            _init_tree_set_worker(*init_args)
+            for labels in map(_cluster_tree_string, tree_strings):
+                self.co_clusters.add(labels)
+                self.num_trees += 1
+        else:
+            batch_size = 8 * (self.processes or multiprocessing.cpu_count()) # The pool would otherwise read every tree before clustering them.
+            pool = multiprocessing.Pool(self.processes, _init_tree_set_worker, init_args)
+            try:
+                batch = list(itertools.islice(tree_strings, batch_size))
+                while batch:
+                    for labels in pool.imap_unordered(_cluster_tree_string, batch):
+                        self.co_clusters.add(labels)
+                        self.num_trees += 1
+                    batch = list(itertools.islice(tree_strings, batch_size))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        if self.verbose: print('Clustered %i trees in %.2f seconds' % (self.num_trees, time.time()-t0))
+
+
+class CoClusterAccumulator(object):
+    """Counts how often each pair of sequences is placed in the same cluster. Its size depends only on the number of sequences, so any number of clusterings can be added to it."""
+    def __init__(self, sequence_names):
+        self.sequence_names = list(sequence_names)
+        self.num_clusterings = 0
+        self.counts = np.zeros((len(self.sequence_names), len(self.sequence_names)), dtype=np.uint32)
+    def add(self, labels):
+        """Adds one clustering, given as a sequence of cluster numbers in the same order as self.sequence_names."""
+        labels = np.asarray(labels)
+        if len(labels) != len(self.sequence_names):
+            raise MiphyValidationError('expected a cluster number for each of the %i sequences, not %i.' % (len(self.sequence_names), len(labels)))
+        order = np.argsort(labels, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(labels[order])) + 1
+        for inds in np.split(order, bounds):
+            if len(inds) > 1:
+                self.counts[np.ix_(inds, inds)] += 1
+        self.num_clusterings += 1
+    def frequencies(self):
+        """Returns a matrix of the fraction of clusterings in which each pair of sequences shared a cluster."""
+        if self.num_clusterings == 0:
+            return np.zeros(self.counts.shape)
+        freqs = self.counts / float(self.num_clusterings)
+        np.fill_diagonal(freqs, 1.0)
+        return freqs
+
+
+# # # # #  Worker functions. These are module level so they can be sent to the worker processes.
+_worker_state = {}
+def _init_tree_set_worker(species_tree_data, species_mapping, sequence_names, use_coords, variance_target, params, tree_format, translation):
+    """Sets up a worker process, parsing the species tree once for every tree it will cluster, and starting the clade memo those trees share."""
+    _worker_state['species_tree'] = phylo.load_newick_string(species_tree_data)
+    _worker_state['species_mapping'] = species_mapping
+    _worker_state['sequence_inds'] = dict((name, i) for i, name in enumerate(sequence_names))
+    _worker_state['use_coords'] = use_coords
+    _worker_state['variance_target'] = variance_target
+    _worker_state['params'] = params
+    _worker_state['tree_format'] = tree_format
+    _worker_state['translation'] = translation
+    _worker_state['clade_memo'] = CladeMemo() # Related trees share most of their clades.
+def _load_tree_string(tree_string, tree_format, translation):
+    """Parses one gene tree, as yielded by TreeSetInstance.iter_gene_tree_strings()."""
+    gene_tree = phylo.Tree()
+    if tree_format == 'nexus':
+        gene_tree.parse_nexus_tree_command(tree_string, translation, False)
+    else:
+        gene_tree.parse_newick(tree_string)
+    return gene_tree
+def _cluster_tree_string(tree_string):
+    """Clusters one gene tree, given as a Newick string or NEXUS tree command, returning the number of the cluster each sequence was placed in."""
+    seq_inds = _worker_state['sequence_inds']
+    gene_tree = _load_tree_string(tree_string, _worker_state['tree_format'], _worker_state['translation'])
+    names = gene_tree.get_named_leaves()
+    if len(names) != len(seq_inds) or any(name not in seq_inds for name in names):
+        raise MiphyValidationError('every tree in the set must contain the same sequences.')
+    clusterer = Clusterer(gene_tree, _worker_state['species_tree'], _worker_state['species_mapping'], _worker_state['use_coords'], '', False, _worker_state['variance_target'], _worker_state['clade_memo'])
+    clusters, scores = clusterer.cluster(*_worker_state['params'])
+    labels = np.empty(len(seq_inds), dtype=np.int32)
+    for clstr_num, clstr in enumerate(clusters):
+        for name in clstr:
+            labels[seq_inds[name]] = clstr_num
+    return labels